@@ -0,0 +1,194 @@
+## @package alerts
+#  Coalescing of alerts into digests
+#
+#  Rather than every unsafe reading producing its own warning, alerts are
+#  collected by an AlertDigest and sent as one digest per window.  Alerts are
+#  deduplicated by (tank, sensor, condition):  a ph which stays too low for
+#  the whole window is one line of the digest, giving how many times it was
+#  seen, when it was first and last seen and its worst and latest values.
+#  Besides readings outside their safe range, alerts may forecast that a
+#  sensor is about to leave it (see ::forecast).
+#
+#  The first alert after a quiet window is sent straight away, so the user
+#  hears of a problem as soon as it is seen;  anything following it is held
+#  until the window closes.  At most max_entries distinct alerts are held per
+#  window, so memory stays bounded however many alerts fire:  alerts beyond
+#  that are only counted, and the digest reports how many were dropped.
+#
+#  Each digest's entries are recorded in the alerts table when it is taken,
+#  giving a history of alerts (for the ::status_site, say).
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import time
+import threading
+import collections
+import config
+
+## The condition of a reading below its safe range
+LOW = 'low'
+
+## The condition of a reading above its safe range
+HIGH = 'high'
+
+## The condition of a sensor forecast to fall below its safe range (see
+#  ::forecast), the alert's value being the hours until it does
+FALLING = 'falling'
+
+## The condition of a sensor forecast to rise above its safe range
+RISING = 'rising'
+
+## The text describing an alert of each condition, given its sensor and value
+descriptions = { LOW: '%s too low:  %r', HIGH: '%s too high:  %r',
+                 FALLING: '%s falling, forecast too low in %.1f hours',
+                 RISING: '%s rising, forecast too high in %.1f hours' }
+
+## One alert:  a sensor of a tank seen in a bad condition
+Alert = collections.namedtuple('Alert', 'tank sensor condition value time')
+
+## The alerts seen for one (tank, sensor, condition) within a window
+class Entry:
+
+    ## The constructor
+    #
+    #  @param alert the first Alert seen
+    def __init__(self, alert):
+        self.tank = alert.tank
+        self.sensor = alert.sensor
+        self.condition = alert.condition
+        self.count = 1
+        self.first = alert.time
+        self.last = alert.time
+        self.value = alert.value
+        self.worst = alert.value
+
+    ## Fold in another alert for the same key
+    #
+    #  @param alert the Alert
+    def add(self, alert):
+        self.count += 1
+        self.first = min(self.first, alert.time)
+        if alert.time >= self.last:
+            self.last = alert.time
+            self.value = alert.value
+        if (alert.value > self.worst) if self.condition == HIGH else (alert.value < self.worst):
+            self.worst = alert.value
+
+    ## Describe the entry as one line of a digest
+    #
+    #  @return the text
+    def describe(self):
+        text = 'tank %d ' %self.tank + descriptions[self.condition] %(self.sensor, self.value)
+        if self.count > 1:
+            worst = ('%.1f hours' if self.condition in (FALLING, RISING) else '%r') %self.worst
+            text += ' (seen %d times from %s to %s, worst %s)' %(self.count, time.strftime('%H:%M', time.localtime(self.first)),
+                                                                time.strftime('%H:%M', time.localtime(self.last)), worst)
+        return text
+
+## Collects alerts and hands them out once per window
+class AlertDigest:
+
+    ## The constructor
+    #
+    #  @param window seconds between digests
+    #  @param max_entries the most distinct alerts held in one window
+    def __init__(self, window, max_entries=100):
+        self.window = window
+        self.max_entries = max_entries
+        self.dropped = 0
+        self.next_digest = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    ## Add an alert to the current window
+    #
+    #  @param alert the Alert
+    #  @return True, if it was held, False if the window was full and it was
+    #          dropped
+    def add(self, alert):
+        key = (alert.tank, alert.sensor, alert.condition)
+        with self._lock:
+            if key in self._entries:
+                self._entries[key].add(alert)
+            elif len(self._entries) < self.max_entries:
+                self._entries[key] = Entry(alert)
+            else:
+                self.dropped += 1
+                return False
+        return True
+
+    ## The number of distinct alerts held
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    ## Take the alerts held if a digest is due
+    #
+    #  @param now the current time
+    #  @return a list of Entry objects in the order first seen, empty if no
+    #          digest is due, and the number of alerts dropped from it
+    def take(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if not self._entries or now < self.next_digest:
+                return [], 0
+            entries = list(self._entries.values())
+            dropped = self.dropped
+            self._entries.clear()
+            self.dropped = 0
+            self.next_digest = now + self.window
+        return entries, dropped
+
+## Format a digest for sending
+#
+#  @param entries the Entry objects taken from an AlertDigest
+#  @param dropped the number of alerts dropped from it
+#  @return a tuple of (subject, text)
+def format_digest(entries, dropped=0):
+    lines = [entry.describe() for entry in entries]
+    if dropped:
+        lines.append('%d further alerts were dropped' %dropped)
+    count = sum(entry.count for entry in entries) + dropped
+    subject = 'Fishtank monitor warning' if count == 1 else 'Fishtank monitor warnings (%d)' %count
+    return subject, 'Fishtank readings need attention:\n\n%s\n' %'\n'.join(lines)
+
+## Create the alerts table, recording the entries of every digest taken
+#
+#  @param conn the database connection to use
+def create_table(conn):
+    conn.execute('create table if not exists alerts (time REAL, tank INT, sensor TEXT, condition TEXT, count INT, '
+                 'first REAL, last REAL, value REAL, worst REAL)')
+
+## Record the entries of a digest
+#
+#  @param conn the database connection to use
+#  @param entries the Entry objects taken from an AlertDigest
+#  @param now the time the digest was taken
+def record(conn, entries, now):
+    with conn:
+        conn.executemany('insert into alerts values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(now, e.tank, e.sensor, e.condition, e.count, e.first, e.last, e.value, e.worst)
+                          for e in entries])
+
+## Read the most recently recorded alerts
+#
+#  @param conn the database connection to use
+#  @param count the most alerts to read
+#  @return a list of (time, tank, sensor, condition, count, first, last,
+#          value, worst) tuples, newest first
+def recent(conn, count):
+    return conn.execute('select * from alerts order by rowid desc limit ?', (count,)).fetchall()
+
+## The shared digest, created on first use by get_digest
+_digest = None
+
+## Lazy instantiator for the digest shared by the warning notifiers
+#
+#  @return the AlertDigest
+def get_digest():
+    global _digest
+    if _digest is None:
+        _digest = AlertDigest(config.warning_digest_window, config.warning_digest_size)
+    return _digest
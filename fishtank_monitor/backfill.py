@@ -0,0 +1,160 @@
+## @package backfill
+#  Bulk import of historical measurements
+#
+#  Used to restore from backups or to merge in the history of another
+#  monitor.  Files may be CSV (with a header line naming at least the time
+#  column) or any of the ::export formats, gzipped or not;  the format is
+#  detected from the content.
+#
+#  Rather than inserting rows one at a time, the import:
+#  * loads every row into an unindexed temporary staging table with large
+#    executemany batches
+#  * discards staged rows whose timestamp is repeated within the import or is
+#    already present in measurements
+#  * inserts what is left into the ::sensors readings table with one statement
+#    per sensor, each in time order so the inserts append to the sensor's
+#    range of the table
+#  * rebuilds the ::gaps index over the imported time range
+#  * invalidates the stored ::summaries covering the imported time range
+#
+#  all within one transaction, and then rebuilds the daily ::sketches of the
+#  days it covers.  A monitor running at the same time keeps its
+#  readings in its ::reading_log until the import commits.
+#
+#  Run as a script to import files from the command line:
+#
+#      python backfill.py [--database fishtank.db] file [file ...]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import io
+import csv
+import json
+import gzip
+import itertools
+import export
+import summaries
+import sensors
+import partitions
+import gaps
+import sketches
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The number of rows loaded by each executemany
+batch_rows = 50000
+
+## The column names accepted in imported files, in measurements column order
+column_names = [name for name, code in export.columns]
+
+## Read rows from CSV with a header line
+#
+#  @param stream the binary stream to read
+#  @return a generator of (time, temp, ph, ph_raw) tuples
+def read_csv(stream):
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='UTF8', newline=''))
+    header = [name.strip() for name in next(reader)]
+    if 'time' not in header:
+        raise ValueError('CSV import needs a time column')
+    positions = [header.index(name) if name in header else None for name in column_names]
+    for line in reader:
+        if line:
+            yield tuple(float(line[p]) if p is not None and line[p] != '' else None for p in positions)
+
+## Read rows from JSON lines
+#
+#  @param stream the binary stream to read
+#  @return a generator of (time, temp, ph, ph_raw) tuples
+def read_jsonl(stream):
+    for line in stream:
+        if line.strip():
+            record = json.loads(line.decode('UTF8'))
+            yield tuple(record.get(name) for name in column_names)
+
+## Read rows from a file of any supported format
+#
+#  @param stream the binary stream to read, which must support peek or be
+#         seekable
+#  @return a generator of (time, temp, ph, ph_raw) tuples
+def read_rows(stream):
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=stream, mode='rb'))
+    start = stream.peek(len(export.columnar_magic))
+    if start.startswith(export.columnar_magic):
+        return export.read_columnar(stream)
+    if start.lstrip()[:1] == b'{':
+        return read_jsonl(stream)
+    return read_csv(stream)
+
+## Import rows into the measurements table
+#
+#  @param conn the database connection to use
+#  @param rows an iterable of (time, temp, ph, ph_raw) tuples in any order
+#  @return a tuple of (rows imported, duplicate rows skipped)
+def import_rows(conn, rows):
+    rows = iter(rows)
+    with conn:
+        conn.execute('drop table if exists temp.import_staging')
+        conn.execute('create temp table import_staging (time INT, temp REAL, ph REAL, ph_raw REAL)')
+        staged = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_rows))
+            if not batch:
+                break
+            conn.executemany('insert into import_staging values (?, ?, ?, ?)', batch)
+            staged += len(batch)
+        conn.execute('create index temp.import_staging_time on import_staging (time)')
+        # the bare columns of a min() aggregate come from the row holding the
+        # minimum, so each timestamp keeps the first row staged for it
+        conn.execute('drop table if exists temp.import_new')
+        conn.execute('create temp table import_new as select time, temp, ph, ph_raw from '
+                     '(select time, temp, ph, ph_raw, min(rowid) from import_staging group by time) s '
+                     'where not exists (select 1 from readings r where r.tank=%d and r.sensor=%d and r.time=s.time)'
+                     %(sensors.local_tank, sensors.TEMPERATURE))
+        first, last = conn.execute('select min(time), max(time) from import_new').fetchone()
+        if first is not None:
+            # and those already archived
+            conn.executemany('delete from import_new where time=?', partitions.query(
+                conn, 'select time from readings where tank=? and sensor=? and time >= ? and time <= ?',
+                (sensors.local_tank, sensors.TEMPERATURE, first, last), first, last + 1, database=False))
+        count, first, last = conn.execute('select count(*), min(time), max(time) from import_new').fetchone()
+        for sensor, column in [(sensors.TEMPERATURE, 'temp'), (sensors.PH, 'ph'), (sensors.PH_RAW, 'ph_raw')]:
+            missing = '' if sensor == sensors.TEMPERATURE else 'where %s is not null ' %column
+            conn.execute('insert or replace into readings select %d, %d, time, %s from import_new %sorder by time'
+                         %(sensors.local_tank, sensor, column, missing))
+        conn.execute('drop table temp.import_new')
+        if count:
+            sensors.changed(conn)
+            gaps.rebuild(conn, first, last + 1)
+        conn.execute('drop table temp.import_staging')
+    if count:
+        summaries.invalidate(conn, first, last + 1)
+        sketches.rebuild(conn, first, last + 1)
+    logger.info("imported %d measurements, skipped %d duplicates" %(count, staged - count))
+    return count, staged - count
+
+## Import a file into the measurements table
+#
+#  @param conn the database connection to use
+#  @param filename the file to import
+#  @return a tuple of (rows imported, duplicate rows skipped)
+def import_file(conn, filename):
+    with open(filename, 'rb') as f:
+        return import_rows(conn, read_rows(f))
+
+if __name__ == "__main__":
+    import argparse
+    import fishtank_monitor
+    parser = argparse.ArgumentParser(description='Import measurements into the fishtank history')
+    parser.add_argument('--database', default=fishtank_monitor.database_filename)
+    parser.add_argument('files', nargs='+', help='CSV or exported files, optionally gzipped')
+    args = parser.parse_args()
+    conn = fishtank_monitor.open_database(args.database)
+    for filename in args.files:
+        imported, skipped = import_file(conn, filename)
+        print("%s:  imported %d, skipped %d duplicates" %(filename, imported, skipped))
@@ -0,0 +1,292 @@
+## @package backtest
+#  Backtesting of candidate alert configurations against the stored history
+#
+#  Choosing the safe ranges in ::notifications::NotifyWarnings, the digest
+#  window and the forecast settings by trying them out on the live tank is
+#  slow and hard on the fish.  Instead, backtest replays any number of
+#  candidate configurations over the stored readings and reports, for each:
+#
+#  * the digests it would have sent and when
+#  * the excursions from the safe range it would have seen
+#  * how early (or late) the user would have heard of each excursion, from the
+#    first alert of the run of alerts leading into it, threshold or forecast
+#
+#  Each sensor's whole history is evaluated at once with numpy rather than
+#  reading by reading:  the range checks are array comparisons, and the
+#  exponentially weighted trend fits of ::forecast are computed for every
+#  reading by solving their running sums as linear recurrences (see
+#  ::filters::recurrence), once per half life however many candidates share
+#  it.  Only the digests sent are stepped through one by one, so years of
+#  readings against dozens of candidates take seconds.
+#
+#  The replay assumes the warning notifier sees every stored reading, where
+#  the live one only sees the reading current each time it runs, so it can
+#  only be earlier than the live notifier, by at most the notifier's interval.
+#
+#  Candidates are written as comma separated settings, any not given being
+#  taken from the current configuration:
+#
+#      ph=6.2:7.8,temperature=22:27,window=3600,horizon=21600,half_life=10800
+#
+#  Run as a script to backtest from the command line:
+#
+#      python backtest.py [--start 2015-01-01] [--end 2015-07-01] candidate [candidate ...]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import time
+import collections
+import config
+import sensors
+import partitions
+import filters
+import notifications
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## One candidate alert configuration
+#
+#  The limits are a dict of sensor name to its safe (low, high) range, the
+#  window the seconds between digests, the horizon how far ahead to forecast
+#  breaches (0 for no forecasts) and the half life that of the trend fits.
+Candidate = collections.namedtuple('Candidate', 'name limits window horizon half_life')
+
+## The outcome of backtesting one Candidate
+#
+#  The fired are the times digests would have been sent, the excursions a list
+#  of (sensor, time) tuples of each time a sensor left its safe range and the
+#  leads the seconds between the user hearing of each excursion and its start
+#  (negative if they heard after it started, None if they never heard).
+Result = collections.namedtuple('Result', 'candidate fired excursions leads')
+
+## The most digest times listed for each candidate;  any later ones are only
+#  counted
+fired_listed = 10
+
+## Seconds between digests when neither a digest window nor a warning
+#  interval is configured
+default_window = 60*60
+
+## Build the candidate matching the current configuration
+#
+#  @param name the candidate's name
+#  @return the Candidate
+def current(name='current'):
+    window = config.warning_digest_window
+    if window is None:
+        window = default_window if config.send_warnings_interval is None else config.send_warnings_interval
+    return Candidate(name, dict(notifications.NotifyWarnings.limits), window,
+                     config.forecast_horizon, config.forecast_half_life)
+
+## Parse a candidate from its written form
+#
+#  @param text the settings, e.g. 'ph=6.2:7.8,window=3600'
+#  @return the Candidate, named by its text
+def parse_candidate(text):
+    candidate = current(text)
+    limits = dict(candidate.limits)
+    settings = {}
+    for setting in text.split(','):
+        key, sep, value = setting.partition('=')
+        key = key.strip()
+        if not sep:
+            raise ValueError('invalid candidate setting:  %r' %setting)
+        if key in limits:
+            low, sep, high = value.partition(':')
+            if not sep:
+                raise ValueError('limits must be written low:high:  %r' %setting)
+            limits[key] = (float(low), float(high))
+        elif key in ('window', 'horizon', 'half_life'):
+            settings[key] = float(value)
+        else:
+            raise ValueError('unknown candidate setting:  %r' %setting)
+    return candidate._replace(limits=limits, **settings)
+
+## Load the history of each checked sensor
+#
+#  @param np the numpy module
+#  @param conn the database connection to use
+#  @param names the sensors' names
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank
+#  @return a dict of sensor name to a tuple of (times, values) arrays
+def load(np, conn, names, start, end, tank=sensors.local_tank):
+    history = {}
+    for name in names:
+        series = [(t, v) for t, v in partitions.series(conn, name, start, end, tank) if v is not None]
+        history[name] = (np.array([t for t, v in series], dtype=float), np.array([v for t, v in series], dtype=float))
+    return history
+
+## Fit the trend of a series at each of its readings
+#
+#  Gives the same fits as feeding the readings one by one to a
+#  ::forecast::Trend.  The sums the fits are computed from are kept relative
+#  to the first reading's time rather than to each reading's own, so they are
+#  plain decaying sums, and shifted to each reading's time afterwards.
+#
+#  @param np the numpy module
+#  @param times the times of the readings, in increasing order
+#  @param values the values read
+#  @param half_life seconds over which a reading's weight halves
+#  @param min_readings the readings needed before a trend is trusted
+#  @return a tuple of arrays of the fitted value and slope, and of whether the
+#          fit is trusted
+def fit_trends(np, times, values, half_life, min_readings=4):
+    t = times - times[0] if len(times) else times
+    decay = np.concatenate(([1.0], np.power(0.5, np.diff(t) / half_life)))
+    s0, st, sv, stt, stv = (filters.recurrence(np, decay, term, 0.0)
+                            for term in (np.ones(len(t)), t, values, t * t, t * values))
+    stt = stt - 2 * t * st + t * t * s0
+    stv = stv - t * sv
+    st = st - t * s0
+    determinant = s0 * stt - st * st
+    trusted = (np.arange(len(t)) >= min_readings - 1) & (determinant > 1e-9 * s0 * s0)
+    determinant = np.where(trusted, determinant, 1.0)
+    slope = np.where(trusted, (s0 * stv - st * sv) / determinant, 0.0)
+    return (sv - slope * st) / s0, slope, trusted
+
+## Find the readings a candidate would have alerted on
+#
+#  As in ::notifications::NotifyWarnings, a reading outside the safe range is
+#  an alert, and so is one inside it whose trend is forecast to leave it
+#  within the horizon.
+#
+#  @param np the numpy module
+#  @param values the values read
+#  @param fit the trend fits of the readings, as returned by fit_trends
+#  @param low the low limit of the safe range
+#  @param high the high limit of the safe range
+#  @param horizon how far ahead to forecast breaches, 0 for not at all
+#  @return a tuple of boolean arrays of the readings out of range and of
+#          those alerted on
+def alert_mask(np, values, fit, low, high, horizon):
+    breach = (values < low) | (values > high)
+    if horizon <= 0:
+        return breach, breach
+    value, slope, trusted = fit
+    rising = trusted & (slope > 0) & (value <= high)
+    falling = trusted & (slope < 0) & (value >= low)
+    limit = np.where(rising, high, low)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        seconds = (limit - value) / np.where(slope == 0, 1.0, slope)
+    return breach, breach | ((rising | falling) & (seconds <= horizon))
+
+## Find when the digests holding a set of alerts would have been sent
+#
+#  As with an ::alerts::AlertDigest, the first alert after a quiet window is
+#  sent straight away and any following it within the window are held and
+#  sent the first time the notifier runs once the window has closed.
+#
+#  @param np the numpy module
+#  @param alerted the sorted times of the alerts
+#  @param runs the sorted times the notifier runs
+#  @param window seconds between digests
+#  @return a list of the times digests are sent
+def digest_times(np, alerted, runs, window):
+    fired = []
+    if not len(alerted):
+        return fired
+    sent = alerted[0]
+    while True:
+        fired.append(float(sent))
+        i = np.searchsorted(alerted, sent, side='right')
+        if i == len(alerted):
+            break
+        j = np.searchsorted(runs, max(alerted[i], sent + window))
+        if j == len(runs):
+            break
+        sent = runs[j]
+    return fired
+
+## Backtest candidate alert configurations over the stored history
+#
+#  @param conn the database connection to use
+#  @param candidates the Candidates
+#  @param start the start of the range, defaults to the beginning of time
+#  @param end the end of the range (exclusive), defaults to the end of time
+#  @param tank the tank
+#  @return a list of Results, one per candidate in the same order
+def backtest(conn, candidates, start=None, end=None, tank=sensors.local_tank):
+    import numpy as np
+    began = time.time()
+    names = sorted(set(name for candidate in candidates for name in candidate.limits))
+    history = load(np, conn, names, float('-inf') if start is None else start,
+                   float('inf') if end is None else end, tank)
+    runs = np.unique(np.concatenate([times for times, values in history.values()] + [np.empty(0)]))
+    fits = {}
+    results = []
+    for candidate in candidates:
+        masks = {}
+        for name, (low, high) in sorted(candidate.limits.items()):
+            times, values = history[name]
+            fit = None
+            if candidate.horizon > 0:
+                key = (name, candidate.half_life)
+                if key not in fits:
+                    fits[key] = fit_trends(np, times, values, candidate.half_life)
+                fit = fits[key]
+            masks[name] = alert_mask(np, values, fit, low, high, candidate.horizon)
+        alerted = np.unique(np.concatenate([history[name][0][alerts] for name, (breach, alerts) in masks.items()]
+                                           + [np.empty(0)]))
+        fired = digest_times(np, alerted, runs, candidate.window)
+        sent = np.array(fired)
+        excursions = []
+        leads = []
+        for name, (breach, alerts) in sorted(masks.items()):
+            times = history[name][0]
+            starts = np.flatnonzero(breach & ~np.concatenate(([False], breach[:-1])))
+            runs_start = np.flatnonzero(alerts & ~np.concatenate(([False], alerts[:-1])))
+            # each excursion is heard of with the first alert of the run leading into it
+            first = runs_start[np.searchsorted(runs_start, starts, side='right') - 1] if len(starts) else starts
+            heard = np.searchsorted(sent, times[first])
+            for k, h in zip(starts, heard):
+                excursions.append((name, float(times[k])))
+                leads.append(float(times[k] - sent[h]) if h < len(sent) else None)
+        results.append(Result(candidate, fired, excursions, leads))
+    logger.info("backtested %d candidates over %d readings in %.2f seconds"
+                %(len(candidates), sum(len(times) for times, values in history.values()), time.time() - began))
+    return results
+
+## Describe a backtest's result
+#
+#  @param result the Result
+#  @return the text
+def format_result(result):
+    def when(t):
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+    lines = ['%s:' %result.candidate.name,
+             '  %d digests sent' %len(result.fired)]
+    if result.fired:
+        listed = ', '.join(when(t) for t in result.fired[:fired_listed])
+        more = len(result.fired) - fired_listed
+        lines.append('  sent at %s%s' %(listed, ' and %d more' %more if more > 0 else ''))
+    heard = sorted(lead for lead in result.leads if lead is not None)
+    lines.append('  %d excursions, %d heard of in advance, %d as they began, %d late, %d not at all'
+                 %(len(result.excursions), len([lead for lead in heard if lead > 0]),
+                   len([lead for lead in heard if lead == 0]), len([lead for lead in heard if lead < 0]),
+                   len(result.leads) - len(heard)))
+    if heard:
+        lines.append('  median lead %.1f hours, longest %.1f hours'
+                     %(heard[len(heard) // 2] / (60*60), heard[-1] / (60*60)))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    import argparse
+    import export
+    import fishtank_monitor
+    parser = argparse.ArgumentParser(description='Backtest alert configurations against the fishtank history')
+    parser.add_argument('--start', type=export.parse_time, help='seconds since the epoch or YYYY-MM-DD')
+    parser.add_argument('--end', type=export.parse_time, help='seconds since the epoch or YYYY-MM-DD')
+    parser.add_argument('--database', default=fishtank_monitor.database_filename)
+    parser.add_argument('candidates', nargs='*', help='settings such as ph=6.2:7.8,window=3600;  '
+                                                      'the current configuration is always included')
+    args = parser.parse_args()
+    config.read_config()
+    conn = fishtank_monitor.open_database(args.database)
+    candidates = [current()] + [parse_candidate(text) for text in args.candidates]
+    for result in backtest(conn, candidates, args.start, args.end):
+        print(format_result(result))
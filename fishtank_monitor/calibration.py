@@ -0,0 +1,161 @@
+## @package calibration
+#  Versioned ph calibration history
+#
+#  The Alamode adds the configured ph calibration offset to each reading before
+#  sending it, so the raw sensor value is recovered by subtracting the offset
+#  that was sent.  Raw values are what the database keeps (in ph_raw) alongside
+#  the corrected ph, and every calibration ever used is kept in the
+#  calibrations table as (time, offset, slope), each applying from its time
+#  until the next:
+#
+#      ph = slope * ph_raw + offset
+#
+#  When a new calibration is recorded - even one dated in the past - recompute
+#  rewrites the corrected ph of the whole history in a single vectorized pass,
+#  so reports, which read the ph column, always show the corrected series.
+#  Stored ::summaries from the calibration's time on are invalidated.
+#
+#  Run as a script to record a calibration or to recompute the history:
+#
+#      python calibration.py record offset [slope] [time]
+#      python calibration.py recompute
+#      python calibration.py list
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import sys
+import time
+import config
+import summaries
+import sensors
+import partitions
+import sketches
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## Recover the raw ph sensor value from a reading made by the Alamode
+#
+#  @param ph the ph reported by the Alamode
+#  @param configuration the configuration sent to the Alamode, holding the
+#         ph_offset it applied
+#  @return the raw ph value
+def raw_ph(ph, configuration):
+    return ph - (configuration.get('ph_offset') or 0.0)
+
+## List every calibration, oldest first
+#
+#  @param conn the database connection to use
+#  @return a list of (time, offset, slope) tuples
+def calibrations(conn):
+    return conn.execute('select time, offset, slope from calibrations order by time').fetchall()
+
+## Find the calibration in effect at the given time
+#
+#  @param cals a list of (time, offset, slope) tuples, oldest first
+#  @param when the time of the reading
+#  @return the (offset, slope) pair in effect, defaulting to (0, 1) if there
+#          is no calibration
+def calibration_at(cals, when):
+    offset, slope = 0.0, 1.0
+    for t, o, s in cals:
+        if t > when:
+            break
+        offset, slope = o, s
+    return offset, slope
+
+## Build the measurements rows for a batch of raw readings
+#
+#  @param conn the database connection to use
+#  @param readings a list of (time, temp, ph_raw) tuples
+#  @return a list of (time, temp, ph, ph_raw) tuples, ph being corrected by
+#          the calibration in effect at each reading's time
+def corrected_rows(conn, readings):
+    cals = calibrations(conn)
+    rows = []
+    for t, temp, ph_raw in readings:
+        offset, slope = calibration_at(cals, t)
+        rows.append((t, temp, None if ph_raw is None else slope * ph_raw + offset, ph_raw))
+    return rows
+
+## Record a calibration, recomputing the history if it changes anything
+#
+#  Nothing is recorded when the latest calibration already has this offset
+#  and slope.  The first calibration ever recorded applies to the whole
+#  existing history, whose missing raw values are derived from it.  Recording
+#  a calibration also resets the calibration reminder.
+#
+#  @param conn the database connection to use
+#  @param offset the ph calibration offset
+#  @param slope the ph calibration slope
+#  @param when the time from which the calibration applies, defaults to now
+#  @return True, if a calibration was recorded
+def record_calibration(conn, offset, slope=1.0, when=None):
+    cals = calibrations(conn)
+    if when is None and cals and cals[-1][1:] == (offset, slope):
+        return False
+    if not cals:
+        when = 0
+        conn.execute('insert into readings select tank, ?, time, (value-?)/? from readings p '
+                     'where tank=? and sensor=? and value is not null and not exists '
+                     '(select 1 from readings r where r.tank=p.tank and r.sensor=? and r.time=p.time)',
+                     (sensors.PH_RAW, offset, slope, sensors.local_tank, sensors.PH, sensors.PH_RAW))
+        sensors.changed(conn)
+    elif when is None:
+        when = time.time()
+    logger.info("recording ph calibration offset %r slope %r from %r" %(offset, slope, when))
+    conn.execute('insert into calibrations values (?, ?, ?)', (when, offset, slope))
+    conn.commit()
+    summaries.invalidate(conn, when)
+    if when:
+        config.last_calibration = when
+        conn.execute('update settings set last_calibration=?', (when,))
+        conn.commit()
+    recompute(conn)
+    sketches.rebuild(conn, when, names=['ph'])
+    return True
+
+## Recompute the corrected ph of every measurement from its raw value
+#
+#  Each measurement is matched to the calibration in effect at its time with a
+#  single vectorized search over the calibration times, the correction is
+#  applied to the whole series at once and the results written back in one
+#  transaction.  Archived ::partitions are recomputed in place, one at a
+#  time.
+#
+#  @param conn the database connection to use
+#  @return the number of measurements recomputed
+def recompute(conn):
+    import numpy
+    cals = calibrations(conn)
+    if not cals:
+        return 0
+    cal_times, offsets, slopes = (numpy.array(c, dtype=float) for c in zip(*cals))
+    def correct(rows):
+        times, raw = (numpy.array(c) for c in zip(*rows))
+        which = numpy.searchsorted(cal_times, times.astype(float), side='right') - 1
+        which = numpy.clip(which, 0, len(cals) - 1)
+        ph = slopes[which] * raw.astype(float) + offsets[which]
+        return [(sensors.local_tank, sensors.PH, t, v) for t, v in zip(times.tolist(), ph.tolist())]
+    count = partitions.rewrite(conn, 'select time, value from readings where tank=? and sensor=? and value is not null',
+                               (sensors.local_tank, sensors.PH_RAW), correct)
+    logger.info("recomputed ph for %d measurements over %d calibrations" %(count, len(cals)))
+    return count
+
+if __name__ == "__main__":
+    import fishtank_monitor
+    conn = fishtank_monitor.open_database()
+    command = sys.argv[1] if len(sys.argv) > 1 else 'list'
+    if command == 'record' and len(sys.argv) > 2:
+        record_calibration(conn, float(sys.argv[2]),
+                           float(sys.argv[3]) if len(sys.argv) > 3 else 1.0,
+                           float(sys.argv[4]) if len(sys.argv) > 4 else None)
+    elif command == 'recompute':
+        print("recomputed %d measurements" %recompute(conn))
+    elif command == 'list':
+        for t, offset, slope in calibrations(conn):
+            print("%s  offset %r  slope %r" %(time.ctime(t), offset, slope))
+    else:
+        sys.exit("usage: calibration.py record offset [slope] [time] | recompute | list")
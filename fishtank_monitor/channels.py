@@ -0,0 +1,313 @@
+## @package channels
+#  Pluggable notification channels
+#
+#  Notifiers compose a Message and pass it to send, which fans it out to every
+#  configured channel at once:
+#
+#  Name    | Channel         | Delivers each message by
+#  ------- | --------------- | -------------------------------------------------
+#  smtp    | SMTPChannel     | email, using the [SMTP] and [email] settings
+#  webhook | WebhookChannel  | an HTTP POST of a JSON object to a URL
+#  syslog  | SyslogChannel   | a datagram to the local syslog UNIX socket
+#  file    | FileDropChannel | writing it, and its attachments, to a directory
+#
+#  Every channel has its own bounded queue and delivery thread, so a slow or
+#  failing channel (an unreachable mail server, say) neither delays nor breaks
+#  delivery on the others.  A failed delivery is logged and counted, and the
+#  channel moves on to its next message.  The channels to use are listed in
+#  the [notifications] section of the config file.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import time
+import json
+import base64
+import socket
+import threading
+import collections
+import config
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## A notification to deliver
+class Message:
+
+    ## The constructor
+    #
+    #  @param subject the subject line
+    #  @param text the body text
+    #  @param attachments a list of (filename, bytes) tuples
+    #  @param urgent True, for warnings about the tank's safety
+    def __init__(self, subject, text, attachments=(), urgent=False):
+        self.subject = subject
+        self.text = text
+        self.attachments = list(attachments)
+        self.urgent = urgent
+        self.time = time.time()
+
+## The base class of the notification channels
+#
+#  Derived classes implement deliver, which is only ever called from the
+#  channel's own delivery thread.
+class Channel:
+
+    ## The name the channel is configured and logged under
+    name = 'channel'
+
+    ## The constructor starts the channel's delivery thread
+    #
+    #  @param queue_size the most messages to hold;  further messages are
+    #         dropped until the channel catches up
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._busy = False
+        self._stopped = False
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='channel-%s' %self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    ## Queue a message for delivery
+    #
+    #  @param message the Message to deliver
+    #  @return True, if it was queued
+    def post(self, message):
+        with self._changed:
+            if len(self._queue) >= self.queue_size:
+                self.dropped += 1
+                logger.error("%s channel queue is full, dropping %r" %(self.name, message.subject))
+                return False
+            self._queue.append(message)
+            self._changed.notify_all()
+        return True
+
+    ## Wait until every queued message has been delivered or has failed
+    #
+    #  @param timeout the most seconds to wait, None to wait indefinitely
+    #  @return True, if the queue is empty
+    def flush(self, timeout=None):
+        with self._changed:
+            return self._changed.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    ## Deliver one message, raising an exception on failure
+    #
+    #  @param message the Message to deliver
+    def deliver(self, message):
+        raise NotImplementedError
+
+    ## Get the channel's delivery counts
+    #
+    #  @return a dict of sent, failed, dropped and queued counts
+    def stats(self):
+        with self._changed:
+            return { 'sent': self.sent, 'failed': self.failed, 'dropped': self.dropped, 'queued': len(self._queue) }
+
+    ## Stop the delivery thread once it finishes its current message
+    def shutdown(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+
+    ## The delivery thread's main loop
+    def _run(self):
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._queue or self._stopped)
+                if self._stopped:
+                    return
+                message = self._queue.popleft()
+                self._busy = True
+            try:
+                self.deliver(message)
+                delivered = True
+            except Exception as e:
+                delivered = False
+                logger.exception("%s channel failed to deliver %r:  %r" %(self.name, message.subject, e))
+            with self._changed:
+                if delivered:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._busy = False
+                self._changed.notify_all()
+
+## Deliver messages by email
+class SMTPChannel(Channel):
+
+    name = 'smtp'
+
+    ## Seconds to wait on the mail server before giving up
+    timeout = 60
+
+    ## Build the email for a message
+    #
+    #  @param message the Message to send
+    #  @return the MIME message
+    @staticmethod
+    def _email(message):
+        from email.mime.text import MIMEText
+        from email.mime.image import MIMEImage
+        from email.mime.multipart import MIMEMultipart
+        if message.attachments:
+            email = MIMEMultipart()
+            email.attach(MIMEText(message.text))
+            for filename, data in message.attachments:
+                email.attach(MIMEImage(data, name=filename, _subtype=os.path.splitext(filename)[1][1:] or 'png'))
+        else:
+            email = MIMEText(message.text)
+        email['Subject'] = message.subject
+        email['From'] = config.email_from_address
+        email['To'] = config.email_to_address
+        return email
+
+    def deliver(self, message):
+        import smtplib
+        s = smtplib.SMTP(config.SMTP_host, config.SMTP_port, timeout=self.timeout)
+        s.ehlo()
+        if config.SMTP_use_ttls:
+            s.starttls()
+        s.ehlo()
+        s.login(config.SMTP_user, config.SMTP_password)
+        logger.info("sending emails")
+        s.sendmail(config.email_to_address, [config.email_to_address], self._email(message).as_string())
+        s.quit()
+
+## Deliver messages as JSON POSTed to a URL
+#
+#  The object has subject, text, time and urgent members and a list of
+#  attachments, each with a filename and base64 encoded content.
+class WebhookChannel(Channel):
+
+    name = 'webhook'
+
+    ## Seconds to wait on the web server before giving up
+    timeout = 30
+
+    ## The constructor
+    #
+    #  @param url the URL to POST to
+    def __init__(self, url):
+        self.url = url
+        super().__init__()
+
+    def deliver(self, message):
+        import urllib.request
+        body = json.dumps({ 'subject': message.subject, 'text': message.text, 'time': message.time,
+                            'urgent': message.urgent,
+                            'attachments': [{ 'filename': filename, 'content': base64.b64encode(data).decode('ascii') }
+                                            for filename, data in message.attachments] })
+        request = urllib.request.Request(self.url, body.encode('UTF8'), { 'Content-Type': 'application/json' })
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+## Deliver messages to the local syslog daemon
+#
+#  Each message is sent as one line to the daemon's UNIX datagram socket, at
+#  warning severity if urgent and info otherwise.  Attachments are not sent.
+class SyslogChannel(Channel):
+
+    name = 'syslog'
+
+    ## The syslog facility used (user-level messages)
+    facility = 1
+
+    ## The most bytes sent in one message
+    max_length = 1024
+
+    ## The constructor
+    #
+    #  @param address the path of the syslog socket
+    def __init__(self, address='/dev/log'):
+        self.address = address
+        super().__init__()
+
+    def deliver(self, message):
+        severity = 4 if message.urgent else 6
+        line = '<%d>fishtank_monitor: %s: %s' %(self.facility * 8 + severity, message.subject,
+                                                ' '.join(message.text.split()))
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            s.sendto(line.encode('UTF8')[:self.max_length], self.address)
+        finally:
+            s.close()
+
+## Deliver messages as files dropped into a directory
+#
+#  Each message is written as <time>-<n>.txt, holding the subject line, a
+#  blank line and the text, and each attachment as <time>-<n>-<filename>.  Files
+#  are written under a temporary name and then renamed, so anything watching
+#  the directory only ever sees complete files.
+class FileDropChannel(Channel):
+
+    name = 'file'
+
+    ## The constructor
+    #
+    #  @param directory the directory to write to, created if need be
+    def __init__(self, directory):
+        self.directory = directory
+        self._count = 0
+        super().__init__()
+
+    ## Write a file atomically
+    #
+    #  @param filename the name of the file within the directory
+    #  @param data the bytes to write
+    def _write(self, filename, data):
+        path = os.path.join(self.directory, filename)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def deliver(self, message):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._count += 1
+        stem = '%s-%d' %(time.strftime('%Y%m%d%H%M%S', time.localtime(message.time)), self._count)
+        for filename, data in message.attachments:
+            self._write('%s-%s' %(stem, os.path.basename(filename)), data)
+        self._write(stem + '.txt', ('%s\n\n%s' %(message.subject, message.text)).encode('UTF8'))
+
+## Build a channel from its configured name
+#
+#  @param name one of smtp, webhook, syslog or file
+#  @return the started Channel
+def create_channel(name):
+    if name == 'smtp':
+        return SMTPChannel()
+    if name == 'webhook':
+        return WebhookChannel(config.webhook_url)
+    if name == 'syslog':
+        return SyslogChannel(config.syslog_address)
+    if name == 'file':
+        return FileDropChannel(config.drop_directory)
+    raise ValueError('unknown notification channel:  %r' %name)
+
+## The configured channels, created on first use by get_channels
+_channels = None
+
+## Lazy instantiator for the configured channels
+#
+#  @return the list of Channel objects
+def get_channels():
+    global _channels
+    if _channels is None:
+        _channels = [create_channel(name) for name in config.notification_channels]
+    return _channels
+
+## Send a message on every channel
+#
+#  Returns as soon as the message is queued on each channel.
+#
+#  @param message the Message to send
+#  @param channels the channels to send on, defaults to the configured ones
+def send(message, channels=None):
+    for channel in get_channels() if channels is None else channels:
+        channel.post(message)
@@ -0,0 +1,335 @@
+## @package collector
+#  Collection of the readings of many monitors into one store
+#
+#  Each monitor keeps its own database.  To see every tank in one place, each
+#  runs a PushAgent sending its readings over TCP to a Collector, which
+#  ingests the readings of any number of agents at once into a single
+#  database, each agent's readings under a tank of its own.
+#
+#  Every message is a frame:  its length (uint32, little-endian) followed by
+#  that many bytes of zlib compressed JSON.  A session goes:
+#
+#  From      | Message                          | Meaning
+#  --------- | -------------------------------- | --------------------------------------------
+#  agent     | {"agent": name}                  | the agent's name, which it is known by for good
+#  collector | {"tank": n, "watermarks": {...}} | the agent's tank in the store and the time of the latest reading stored of each sensor
+#  agent     | {"seq": n, "rows": [...]}        | a batch of [sensor name, time, value] readings, each later than its sensor's watermark
+#  collector | {"ack": n, "watermarks": {...}}  | the batch is committed
+#
+#  the last two repeating until the agent has sent everything it has.  The
+#  agent sends each batch once the one before is acknowledged, and batches
+#  hold each sensor's readings in time order from its watermark on, so the
+#  watermarks are exactly what is stored.  Each sensor has a watermark of its
+#  own because a monitor does not store its sensors' readings of one time
+#  together:  the extra sensors are stored as they are read while the
+#  temperature and ph wait in the ::reading_log, or are held back by a
+#  ::compression::Compressor.  After a disconnect, or a restart of either
+#  end, the agent simply starts a new session and resumes from the
+#  watermarks the collector gives it:  a batch which was stored but never
+#  acknowledged is sent again, and storing it again changes nothing.
+#  Readings added to an agent's history behind a watermark (by a ::backfill,
+#  say) are not sent.
+#
+#  The collector serves each agent on a thread of its own, so decompressing
+#  and decoding batches happens concurrently;  only the writes to the store
+#  are taken one at a time.
+#
+#  Run as a script to start a collector:
+#
+#      python collector.py [--database collector.db] [--port 5117]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import json
+import zlib
+import socket
+import struct
+import itertools
+import threading
+import socketserver
+import config
+import sensors
+import partitions
+import gaps
+import sketches
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The port collectors listen on by default
+default_port = 5117
+
+## The most readings of each sensor sent in one batch
+batch_rows = 2000
+
+## The most batches sent by one push, so catching up on a long history is
+#  spread over several pushes rather than holding up the caller
+batches_per_push = 10
+
+## Seconds either end waits on the other before giving up on the session
+timeout = 30
+
+## The largest frame accepted, in bytes
+max_frame = 16*1024*1024
+
+_length = struct.Struct('<I')
+
+## Send one message
+#
+#  @param sock the connected socket
+#  @param message the message, anything JSON can encode
+def send_message(sock, message):
+    data = zlib.compress(json.dumps(message, separators=(',', ':')).encode('utf-8'))
+    sock.sendall(_length.pack(len(data)) + data)
+
+## Read exactly n bytes
+#
+#  @param sock the connected socket
+#  @param n the number of bytes
+#  @return the bytes, or None if the connection was closed before any arrived
+def _receive_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 65536))
+        if not chunk:
+            if chunks:
+                raise IOError('connection closed mid-frame')
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+## Receive one message
+#
+#  @param sock the connected socket
+#  @return the message, or None if the connection was closed
+def receive_message(sock):
+    header = _receive_exactly(sock, _length.size)
+    if header is None:
+        return None
+    size = _length.unpack(header)[0]
+    if size > max_frame:
+        raise ValueError('frame of %d bytes is too large' %size)
+    data = _receive_exactly(sock, size) if size else b''
+    if data is None:
+        raise IOError('connection closed mid-frame')
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+## Parse a host:port address
+#
+#  @param address the address, the port defaulting to default_port
+#  @return a (host, port) tuple
+def parse_address(address):
+    host, sep, port = address.strip().rpartition(':')
+    return (host, int(port)) if sep else (address.strip(), default_port)
+
+## Create the table of the agents known to a collector
+#
+#  @param conn the database connection to use
+def create_table(conn):
+    conn.execute('create table if not exists agents (name TEXT PRIMARY KEY, tank INT UNIQUE NOT NULL)')
+
+## Find the tank an agent's readings are stored under, assigning the next one
+#  if the agent is new
+#
+#  The collector's own tank, ::sensors::local_tank, is never assigned.
+#
+#  @param conn the database connection to use
+#  @param name the agent's name
+#  @return the tank
+def agent_tank(conn, name):
+    row = conn.execute('select tank from agents where name=?', (name,)).fetchone()
+    if row is not None:
+        return row[0]
+    with conn:
+        tank = max(sensors.local_tank, conn.execute('select max(tank) from agents').fetchone()[0] or 0) + 1
+        conn.execute('insert into agents values (?, ?)', (name, tank))
+    logger.info("agent %r is new, storing its readings as tank %d" %(name, tank))
+    return tank
+
+## The time of the latest reading stored of each sensor of a tank
+#
+#  @param conn the database connection to use
+#  @param tank the tank
+#  @return a dict of sensor name to the time, for each sensor with readings
+def watermarks(conn, tank):
+    marks = {}
+    for sensor, name, unit in sensors.registered(conn):
+        # one index seek per sensor, where the tank alone would need a scan
+        found = [row[0] for row in partitions.query(conn, 'select max(time) from readings where tank=? and sensor=?',
+                                                    (tank, sensor), float('-inf'), float('inf'), tank)
+                 if row[0] is not None]
+        if found:
+            marks[name] = max(found)
+    return marks
+
+## Receives readings from agents and stores them
+class Collector(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    ## The constructor binds the listening socket
+    #
+    #  @param address the (host, port) to listen on, port 0 for any free one
+    #  @param conn the database connection to store into
+    def __init__(self, address, conn):
+        self.conn = conn
+        create_table(conn)
+        conn.commit()
+        ## Serialises the writes of the agents' sessions
+        self.lock = threading.Lock()
+        ## The readings stored, for stats
+        self.stored = 0
+        socketserver.TCPServer.__init__(self, address, _Session)
+
+    ## Store a batch of readings
+    #
+    #  The daily ::sketches and the ::gaps index of the agent's tank are kept
+    #  up to date as they would be on the agent.  Readings no later than
+    #  their sensor's watermark are from a batch already stored and are
+    #  skipped, so they are not added to the sketches twice.
+    #
+    #  @param tank the agent's tank
+    #  @param rows a list of (sensor name, time, value) readings
+    #  @return the tank's watermarks once they are stored
+    def store(self, tank, rows):
+        with self.lock:
+            marks = watermarks(self.conn, tank)
+            rows = [row for row in rows if row[0] not in marks or row[1] > marks[row[0]]]
+            with self.conn:
+                ids = dict((name, sensors.sensor_id(self.conn, name)) for name in set(row[0] for row in rows))
+                self.conn.executemany('insert or replace into readings values (?, ?, ?, ?)',
+                                      [(tank, ids[name], t, value) for name, t, value in rows])
+                if rows:
+                    sensors.changed(self.conn)
+                    times = [row[1] for row in rows]
+                    gaps.rebuild(self.conn, min(times), max(times) + 1, tank)
+                    sketches.record(self.conn, rows, tank)
+            self.stored += len(rows)
+            return watermarks(self.conn, tank)
+
+## One agent's session with the collector
+class _Session(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.request.settimeout(timeout)
+        collector = self.server
+        try:
+            hello = receive_message(self.request)
+            if not hello or 'agent' not in hello:
+                return
+            with collector.lock:
+                tank = agent_tank(collector.conn, hello['agent'])
+                marks = watermarks(collector.conn, tank)
+            send_message(self.request, { 'tank': tank, 'watermarks': marks })
+            while True:
+                batch = receive_message(self.request)
+                if batch is None:
+                    return
+                marks = collector.store(tank, batch['rows'])
+                send_message(self.request, { 'ack': batch['seq'], 'watermarks': marks })
+        except (IOError, ValueError, zlib.error) as e:
+            logger.warning("session with %r ended:  %r" %(self.client_address, e))
+
+## Sends a monitor's readings to a collector
+class PushAgent:
+
+    ## The constructor
+    #
+    #  @param address the collector's (host, port)
+    #  @param name the name the collector knows this monitor by
+    #  @param tank the tank whose readings are sent
+    def __init__(self, address, name, tank=sensors.local_tank):
+        self.address = address
+        self.name = name
+        self.tank = tank
+        ## The collector's watermarks as of the last acknowledgement, a dict of
+        #  sensor name to the time of its latest reading stored
+        self.watermarks = {}
+
+    ## Read the next batch of readings to send
+    #
+    #  Each sensor's readings after its watermark are read in time order, up
+    #  to batch_rows of them.
+    #
+    #  @param conn the database connection to use
+    #  @param marks a dict of sensor name to the time after which to read, all
+    #         time for sensors not in it
+    #  @return a list of (sensor name, time, value) readings in time order
+    def _batch(self, conn, marks):
+        rows = []
+        for sensor, name, unit in sensors.registered(conn):
+            after = marks.get(name, float('-inf'))
+            rows.extend((name, t, value) for t, value in itertools.islice(partitions.ordered_query(
+                conn, 'select time, value from readings where tank=? and sensor=? and time > ? order by time limit ?',
+                (self.tank, sensor, after, batch_rows), after, float('inf'), self.tank), batch_rows))
+        return sorted(rows, key=lambda row: row[1])
+
+    ## Send what the collector does not have yet, up to batches_per_push
+    #  batches of it
+    #
+    #  @param conn the database connection to read from
+    #  @return the number of readings acknowledged, even if the session then
+    #          failed
+    def push(self, conn):
+        sent = 0
+        try:
+            with socket.create_connection(self.address, timeout) as sock:
+                send_message(sock, { 'agent': self.name })
+                reply = receive_message(sock)
+                if reply is None:
+                    raise IOError('collector closed the connection')
+                self.watermarks = reply['watermarks']
+                for seq in range(batches_per_push):
+                    rows = self._batch(conn, self.watermarks)
+                    if not rows:
+                        break
+                    send_message(sock, { 'seq': seq, 'rows': rows })
+                    ack = receive_message(sock)
+                    if ack is None or ack.get('ack') != seq:
+                        raise IOError('batch %d was not acknowledged' %seq)
+                    self.watermarks = ack['watermarks']
+                    sent += len(rows)
+        except (IOError, ValueError, zlib.error) as e:
+            logger.warning("pushing readings to %r failed:  %r" %(self.address, e))
+        if sent:
+            logger.info("pushed %d readings to %r, watermarks %r" %(sent, self.address, self.watermarks))
+        return sent
+
+## The agent, created on first use by get_agent
+_agent = None
+
+## Lazy instantiator for the agent pushing to the configured collector
+#
+#  @return the PushAgent, or None if no collector is configured
+def get_agent():
+    global _agent
+    if not config.collector_address:
+        return None
+    address = parse_address(config.collector_address)
+    if _agent is None or _agent.address != address or _agent.name != config.agent_name:
+        _agent = PushAgent(address, config.agent_name)
+    return _agent
+
+## Push the readings to the configured collector, if there is one
+#
+#  @param conn the database connection to read from
+def push(conn):
+    agent = get_agent()
+    if agent is not None:
+        agent.push(conn)
+
+if __name__ == "__main__":
+    import argparse
+    import fishtank_monitor
+    parser = argparse.ArgumentParser(description='Collect the readings of many fishtank monitors')
+    parser.add_argument('--database', default='collector.db')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=default_port)
+    args = parser.parse_args()
+    server = Collector((args.host, args.port), fishtank_monitor.open_database(args.database))
+    logger.info("collecting on %r" %(server.server_address,))
+    server.serve_forever()
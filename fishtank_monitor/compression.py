@@ -0,0 +1,307 @@
+## @package compression
+#  Lossy compression of the measurements as they are stored
+#
+#  The temperature and ph change slowly, so most measurements only repeat
+#  what the ones either side of them already say.  When tolerances are
+#  configured in the [compression] section of the config file, for these or
+#  any other sensor, the ::reading_log passes the measurements through a
+#  Compressor on their way to the database, which stores only those needed for
+#  the series to be rebuilt, by interpolating linearly between the stored
+#  measurements, to within each sensor's tolerance.  Two methods are offered:
+#
+#  Method         | A measurement is stored when
+#  -------------- | ------------------------------------------------------------
+#  swinging door  | no straight line from the last stored measurement passes within the tolerance of every measurement since
+#  deadband       | a sensor has moved more than half its tolerance from the last stored measurement
+#
+#  and in either case at least every max_interval seconds, which is never
+#  more than config.gap_threshold, so compression is not mistaken for an
+#  outage by the ::gaps index.  The swinging door keeps far fewer measurements
+#  of a steady drift;  the deadband is simpler to reason about.
+#
+#  The measurements are compressed as a whole rather than each sensor on its
+#  own:  a measurement is kept (all of its sensors) when any sensor needs it,
+#  so the measurements view, the ph ::calibration and the ::gaps index, which
+#  all work a whole measurement at a time, are unchanged.  A sensor with no
+#  tolerance is stored only with the measurements the others need.
+#
+#  Whether a measurement is needed is only known once the next arrives, so the
+#  newest is held back.  It stays in the reading log, which does not count it
+#  as applied, and so it is not lost should the monitor stop.
+#
+#  interpolate reads a sensor's value at any times from what was stored.
+#
+#  Everything derived from the measurements is derived from those stored, so
+#  it does not change when it is rebuilt:  the ::summaries count only the
+#  measurements kept, and the ::sketches weight each by the time since the one
+#  before, spread along the line between them.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import bisect
+import config
+import sensors
+import partitions
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The column of the temperature and ph in a (time, temp, ph, ph_raw, others)
+#  row, others the (sensor name, value) pairs of any other sensors
+columns = { 'temperature': 1, 'ph': 2 }
+
+## Whether a value is missing, None and NaN alike
+def _missing(value):
+    return value is None or value != value
+
+## A sensor's value in a measurement
+#
+#  @param row the (time, temp, ph, ph_raw) or (time, temp, ph, ph_raw, others)
+#         measurement
+#  @param name the sensor's name
+#  @return the value, or None if the measurement has none
+def _value(row, name):
+    if name in columns:
+        return row[columns[name]]
+    for other, value in row[4] if len(row) > 4 else ():
+        if other == name:
+            return value
+    return None
+
+## Keeps a sensor's measurements within half its tolerance of the last stored
+class Deadband:
+
+    ## The constructor
+    #
+    #  @param tolerance the largest error allowed in the rebuilt series
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.value = None
+
+    ## Start again from a stored measurement
+    #
+    #  @param t the time of the measurement
+    #  @param value the sensor's value
+    def start(self, t, value):
+        self.value = value
+
+    ## Determine whether a measurement can be left out
+    #
+    #  @param t the time of the measurement
+    #  @param value the sensor's value
+    #  @return True, if the series can be rebuilt without it so far
+    def admit(self, t, value):
+        return abs(value - self.value) <= self.tolerance / 2.0
+
+## Keeps a sensor's measurements within its tolerance of a line from the last
+#  stored
+#
+#  The door is the range of slopes of the lines from the last stored
+#  measurement passing within the tolerance of every measurement since;  each
+#  measurement narrows it, and once it is shut the measurement before is
+#  stored and the door reopened from there.
+class SwingingDoor:
+
+    ## The constructor
+    #
+    #  @param tolerance the largest error allowed in the rebuilt series
+    def __init__(self, tolerance):
+        self.tolerance = tolerance
+        self.time = self.value = None
+        self.low = self.high = None
+
+    def start(self, t, value):
+        self.time, self.value = t, value
+        self.low, self.high = float('-inf'), float('inf')
+
+    def admit(self, t, value):
+        elapsed = t - self.time
+        low = max(self.low, (value - self.tolerance - self.value) / elapsed)
+        high = min(self.high, (value + self.tolerance - self.value) / elapsed)
+        if low > high:
+            return False
+        self.low, self.high = low, high
+        return True
+
+## The compression methods by configured name
+methods = { 'swinging door': SwingingDoor, 'deadband': Deadband }
+
+## Decides which of a stream of measurements need to be stored
+class Compressor:
+
+    ## The constructor
+    #
+    #  @param tolerances a dict of sensor name to the largest error allowed in
+    #         its rebuilt series
+    #  @param method the compression method, one of the keys of methods
+    #  @param max_interval the most seconds between stored measurements
+    def __init__(self, tolerances, method='swinging door', max_interval=2*60*60):
+        if method not in methods:
+            raise ValueError('unknown compression method:  %r' %method)
+        if 'ph_raw' in tolerances:
+            raise ValueError("sensor cannot be compressed:  'ph_raw'")
+        self.doors = dict((name, methods[method](tolerance)) for name, tolerance in tolerances.items())
+        ## The sensors whose values must all be present for a measurement to
+        #  be left out
+        self.names = sorted(set(columns) | set(self.doors))
+        self.max_interval = max_interval
+        ## The last measurement stored
+        self.stored = None
+        ## The newest measurement, held back until it is known whether it is
+        #  needed, or None if it was stored
+        self.held = None
+        ## The counts of the measurements seen and stored, for stats
+        self.seen = self.kept = 0
+
+    ## Start again from a stored measurement
+    #
+    #  @param row the (time, temp, ph, ph_raw, others) measurement
+    def _start(self, row):
+        self.stored = row
+        if not any(_missing(_value(row, name)) for name in self.names):
+            for name, door in self.doors.items():
+                door.start(row[0], _value(row, name))
+
+    ## Determine whether a measurement can be left out, as far as is known
+    #
+    #  @param row the (time, temp, ph, ph_raw, others) measurement
+    #  @return True, if it can be left out should the next one allow it
+    def _admit(self, row):
+        if row[0] - self.stored[0] > self.max_interval:
+            return False
+        # a measurement missing a value, or following one, is always kept
+        if any(_missing(_value(row, name)) or _missing(_value(self.stored, name)) for name in self.names):
+            return False
+        admitted = True
+        for name, door in sorted(self.doors.items()):
+            admitted = door.admit(row[0], _value(row, name)) and admitted
+        return admitted
+
+    ## Add a measurement
+    #
+    #  Measurements no later than the last seen are stored as they are, save
+    #  for the held measurement itself, which is ignored should it be added
+    #  again.
+    #
+    #  @param row the (time, temp, ph, ph_raw, others) measurement
+    #  @return a list of the measurements to store now
+    def add(self, row):
+        latest = self.held or self.stored
+        if latest is not None and row[0] <= latest[0]:
+            return [] if row[0] == latest[0] else [row]
+        self.seen += 1
+        if self.stored is None:
+            self._start(row)
+            self.kept += 1
+            return [row]
+        if self._admit(row):
+            self.held = row
+            return []
+        out = []
+        if self.held is not None:
+            out.append(self.held)
+            self._start(self.held)
+            self.held = None
+            if self._admit(row):
+                self.held = row
+                self.kept += 1
+                return out
+        out.append(row)
+        self._start(row)
+        self.kept += len(out)
+        return out
+
+    ## Add measurements, starting from the last one stored if this is the first
+    #  time
+    #
+    #  @param conn the database connection to use
+    #  @param rows a list of (time, temp, ph, ph_raw, others) measurements in
+    #         time order
+    #  @return a list of the measurements to store now
+    def feed(self, conn, rows):
+        if self.stored is None:
+            row = conn.execute('select time, temp, ph, ph_raw from measurements order by time desc limit 1').fetchone()
+            if row is not None:
+                others = conn.execute('select s.name, r.value from readings r join sensors s on s.id = r.sensor '
+                                      'where r.tank=? and r.time=? and s.name not in (?, ?, ?)',
+                                      (sensors.local_tank, row[0], 'temperature', 'ph', 'ph_raw')).fetchall()
+                self._start(tuple(row) + (tuple(others),))
+        out = []
+        for row in rows:
+            out.extend(self.add(row))
+        return out
+
+## Build the compressor from the configuration
+#
+#  @return the Compressor, or None if no tolerances are configured
+def from_config():
+    if not config.compression_tolerances:
+        return None
+    max_interval = min(config.compression_max_interval or config.gap_threshold, config.gap_threshold)
+    return Compressor(config.compression_tolerances, config.compression_method, max_interval)
+
+## The time of the reading of a sensor nearest a time on one side
+#
+#  @param conn the database connection to use
+#  @param sensor the sensor's id
+#  @param when the time
+#  @param after True for the first reading at or after when, False for the
+#         last at or before it
+#  @param tank the tank
+#  @return the time, or None if there is no such reading
+def _neighbour(conn, sensor, when, after, tank):
+    sql = 'select %s(time) from readings where tank=? and sensor=? and time %s ? and value is not null' \
+          %(('min', '>=') if after else ('max', '<='))
+    start, end = (when, float('inf')) if after else (float('-inf'), when + 1)
+    found = [row[0] for row in partitions.query(conn, sql, (tank, sensor, when), start, end, tank)
+             if row[0] is not None]
+    return (min(found) if after else max(found)) if found else None
+
+## Read a sensor's value at any times, interpolating between its readings
+#
+#  Times before the first reading, after the last or within a gap longer than
+#  config.gap_threshold have no value.
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param times the times to read at
+#  @param tank the tank
+#  @return a list of the values at each time, None where there is none
+def interpolate(conn, name, times, tank=sensors.local_tank):
+    if not times:
+        return []
+    sensor = sensors.sensor_id(conn, name)
+    low = _neighbour(conn, sensor, min(times), False, tank)
+    high = _neighbour(conn, sensor, max(times), True, tank)
+    low = min(times) if low is None else low
+    high = max(times) if high is None else high
+    points = list(partitions.ordered_query(conn, 'select time, value from readings where tank=? and sensor=? '
+                                                 'and time >= ? and time <= ? and value is not null order by time',
+                                           (tank, sensor, low, high), low, high + 1, tank))
+    stamps = [t for t, v in points]
+    values = []
+    for t in times:
+        i = bisect.bisect_left(stamps, t)
+        if i < len(stamps) and stamps[i] == t:
+            values.append(points[i][1])
+        elif 0 < i < len(stamps) and stamps[i] - stamps[i - 1] <= config.gap_threshold:
+            (t0, v0), (t1, v1) = points[i - 1], points[i]
+            values.append(v0 + (v1 - v0) * (t - t0) / float(t1 - t0))
+        else:
+            values.append(None)
+    return values
+
+## Rebuild a sensor's series at regular intervals
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param step seconds between the times read at
+#  @param tank the tank
+#  @return a list of (time, value) tuples, the value None where there is none
+def resample(conn, name, start, end, step, tank=sensors.local_tank):
+    times = list(range(int(start), int(end), int(step)))
+    return list(zip(times, interpolate(conn, name, times, tank)))
@@ -40,6 +40,8 @@ IP_address = None
 
 ## The serialdevice to use for communicating with the alamode (e.g. /dev/ttyS0)
 serial_device = None
+## The framing to offer the alamode:  json, or binary for compact binary frames
+serial_framing = 'json'
 SMTP_host = None
 SMTP_port = None
 SMTP_user = None
@@ -53,6 +55,48 @@ send_reports_interval = None
 send_warnings_interval = None
 email_to_address = None
 email_from_address = None
+## The periods to send informational reports for:  any of day, week, month and year
+report_periods = ['day']
+## The channels to send notifications on:  any of smtp, webhook, syslog and file
+notification_channels = ['smtp']
+## The URL the webhook channel POSTs notifications to
+webhook_url = None
+## The syslog socket the syslog channel sends notifications to
+syslog_address = '/dev/log'
+## The directory the file channel drops notifications into
+drop_directory = './notifications'
+## Seconds unsafe readings are collected for before a warning digest is sent
+warning_digest_window = None
+## The most distinct alerts held in one warning digest
+warning_digest_size = 100
+## How far ahead, in seconds, to warn of readings forecast to become unsafe, zero to disable
+forecast_horizon = 6*60*60
+## Seconds over which a reading's weight in the forecast trend halves
+forecast_half_life = 6*60*60
+## The noise filter of each sensor as a dict of sensor name to filter description (see ::filters)
+sensor_filters = {}
+## The shortest interval without measurements recorded as a gap (see ::gaps)
+gap_threshold = 2*60*60
+## The directory old readings are archived to (see ::partitions)
+partition_directory = './partitions'
+## Whole months of readings kept in the database besides the current one, zero to never archive them
+partition_after_months = 0
+## The directory the static status site is written to (see ::status_site), empty to not write it
+site_directory = ''
+## Seconds between builds of the status site
+site_interval = 60
+## The host:port of the ::collector to push readings to, empty to not push them
+collector_address = ''
+## The name this monitor is known by to the collector
+agent_name = socket.gethostname()
+## Seconds between pushes of the readings to the collector
+push_interval = 60
+## The largest error allowed in each sensor's stored series, as a dict of sensor name to tolerance;  empty to store every measurement (see ::compression)
+compression_tolerances = {}
+## The compression method:  swinging door or deadband
+compression_method = 'swinging door'
+## The most seconds between stored measurements when compressing, None for the gap threshold
+compression_max_interval = None
 ## How often the user wishes to recalibrate their ph sensor
 months_between_calibrations = None
 ## The X10 house and device code for controlling the lights (for example I8)
@@ -73,6 +117,11 @@ ph_pin = None
 temperature_pin = None
 ## The linear PH calibration offset to use on PH measurements
 ph_offset = None
+## The PH calibration slope applied to raw PH measurements (see the calibration module)
+ph_slope = 1.0
+
+## Whether to split the work across several processes (see the processes module)
+multiprocess = False
 
 ## The last time we calibrated the ph sensor
 last_calibration = None
@@ -83,9 +132,14 @@ config_filename = './cfg/fishtank_monitor.cfg'
 ## Read the config file and parse its contents into a series of global variables
 def read_config():
     global SMTP_host, SMTP_port, SMTP_user, SMTP_password, SMTP_use_ttls, send_reports_interval
-    global send_warnings_interval, email_to_address, email_from_address, months_between_calibrations
-    global last_calibration, serial_device, x10_retries, x10_light_code, lights_on_times, lights_off_times
-    global daylight_tz, standard_tz, ph_pin, temperature_pin, ph_offset, IP_address
+    global send_warnings_interval, email_to_address, email_from_address, months_between_calibrations, report_periods
+    global notification_channels, webhook_url, syslog_address, drop_directory, warning_digest_window, warning_digest_size
+    global forecast_horizon, forecast_half_life, sensor_filters, gap_threshold
+    global partition_directory, partition_after_months, site_directory, site_interval
+    global collector_address, agent_name, push_interval
+    global compression_tolerances, compression_method, compression_max_interval
+    global last_calibration, serial_device, serial_framing, x10_retries, x10_light_code, lights_on_times, lights_off_times
+    global daylight_tz, standard_tz, ph_pin, temperature_pin, ph_offset, ph_slope, IP_address, multiprocess
     lights_on_times = []
     lights_off_times = []
     try:
@@ -93,9 +147,11 @@ def read_config():
         cfg = configparser.ConfigParser()
         cfg.read(config_filename)
         serial_device = cfg.get('hardware', 'serial device')
+        serial_framing = cfg.get('hardware', 'serial framing', fallback='json').strip()
         ph_pin = cfg.get('hardware', 'ph pin')
         temperature_pin = cfg.get('hardware', 'temperature pin')
         ph_offset = cfg.getfloat('hardware', 'ph calibration offset')
+        ph_slope = cfg.getfloat('hardware', 'ph calibration slope', fallback=1.0)
         SMTP_host = cfg.get('SMTP', 'host')
         SMTP_port = cfg.getint('SMTP', 'port')
         SMTP_user = cfg.get('SMTP', 'user')
@@ -105,11 +161,37 @@ def read_config():
         send_warnings_interval = cfg.getint('email', 'send warnings interval')
         email_to_address = cfg.get('email', 'email to address')
         email_from_address = cfg.get('email', 'email from address')
+        report_periods = [p.strip() for p in cfg.get('email', 'report periods', fallback='day').split(',') if p.strip()]
+        notification_channels = [c.strip() for c in cfg.get('notifications', 'channels', fallback='smtp').split(',')
+                                 if c.strip()]
+        webhook_url = cfg.get('notifications', 'webhook url', fallback=None)
+        syslog_address = cfg.get('notifications', 'syslog address', fallback='/dev/log')
+        drop_directory = cfg.get('notifications', 'drop directory', fallback='./notifications')
+        warning_digest_window = cfg.getint('notifications', 'warning digest window', fallback=send_warnings_interval)
+        warning_digest_size = cfg.getint('notifications', 'warning digest size', fallback=100)
+        forecast_horizon = cfg.getint('notifications', 'forecast horizon', fallback=6*60*60)
+        forecast_half_life = cfg.getint('notifications', 'forecast half life', fallback=6*60*60)
         months_between_calibrations = cfg.getint('calibration', 'months_between_calibrations')
         x10_retries = cfg.getint('lights', 'x10 retries')
         x10_light_code = cfg.get('lights', 'x10 light code')
         daylight_tz = cfg.getint('time', 'daylight timezone offset')
         standard_tz = cfg.getint('time', 'standard timezone offset')
+        multiprocess = cfg.getboolean('system', 'multiprocess', fallback=False)
+        gap_threshold = cfg.getint('system', 'gap threshold', fallback=2*60*60)
+        partition_directory = cfg.get('storage', 'partition directory', fallback='./partitions')
+        partition_after_months = cfg.getint('storage', 'partition after months', fallback=0)
+        site_directory = cfg.get('site', 'site directory', fallback='').strip()
+        site_interval = cfg.getint('site', 'site interval', fallback=60)
+        collector_address = cfg.get('collector', 'collector address', fallback='').strip()
+        agent_name = cfg.get('collector', 'agent name', fallback='').strip() or socket.gethostname()
+        push_interval = cfg.getint('collector', 'push interval', fallback=60)
+        compression_tolerances = dict((name, float(value)) for name, value in cfg.items('compression')
+                                      if name not in ('method', 'max interval') and value.strip()) \
+            if cfg.has_section('compression') else {}
+        compression_method = cfg.get('compression', 'method', fallback='swinging door').strip()
+        compression_max_interval = cfg.getint('compression', 'max interval', fallback=None)
+        sensor_filters = dict((name, spec.strip()) for name, spec in cfg.items('filters') if spec.strip()) \
+            if cfg.has_section('filters') else {}
         if cfg.get('lights', 'lights on times').strip():
             for t in cfg.get('lights', 'lights on times').split(','):
                 lights_on_times.append(t.strip())
@@ -117,9 +199,11 @@ def read_config():
             for t in cfg.get('lights', 'lights off times').split(','):
                 lights_off_times.append(t.strip())
         logger.info("serial device from config is %r" %serial_device)
+        logger.info("serial framing from config is %r" %serial_framing)
         logger.info("ph pin from config is %r" %ph_pin)
         logger.info("temperature pin from config is %r" %temperature_pin)
         logger.info("ph calibration offset from config is %r" %ph_offset)
+        logger.info("ph calibration slope from config is %r" %ph_slope)
         logger.info("standard timezone offset from config is %r" %daylight_tz)
         logger.info("daylight timezone offset from config is %r" %standard_tz)
         logger.info("smtp host from config is %r" %SMTP_host)
@@ -130,11 +214,33 @@ def read_config():
         logger.info("send_warnings_interval from config is %r" %send_warnings_interval)
         logger.info("email_to_address from config is %r" %email_to_address)
         logger.info("email_from_address from config is %r" %email_from_address)
+        logger.info("report_periods from config is %r" %report_periods)
+        logger.info("notification_channels from config is %r" %notification_channels)
+        logger.info("webhook_url from config is %r" %webhook_url)
+        logger.info("syslog_address from config is %r" %syslog_address)
+        logger.info("drop_directory from config is %r" %drop_directory)
+        logger.info("warning_digest_window from config is %r" %warning_digest_window)
+        logger.info("warning_digest_size from config is %r" %warning_digest_size)
+        logger.info("forecast_horizon from config is %r" %forecast_horizon)
+        logger.info("forecast_half_life from config is %r" %forecast_half_life)
+        logger.info("sensor_filters from config is %r" %sensor_filters)
+        logger.info("gap_threshold from config is %r" %gap_threshold)
+        logger.info("partition_directory from config is %r" %partition_directory)
+        logger.info("partition_after_months from config is %r" %partition_after_months)
+        logger.info("site_directory from config is %r" %site_directory)
+        logger.info("site_interval from config is %r" %site_interval)
+        logger.info("collector_address from config is %r" %collector_address)
+        logger.info("agent_name from config is %r" %agent_name)
+        logger.info("push_interval from config is %r" %push_interval)
+        logger.info("compression_tolerances from config is %r" %compression_tolerances)
+        logger.info("compression_method from config is %r" %compression_method)
+        logger.info("compression_max_interval from config is %r" %compression_max_interval)
         logger.info("months_between_calibrations from config is %r" %months_between_calibrations)
         logger.info("x10_retries from config is %r" %x10_retries)
         logger.info("x10_light_code from config is %r" %x10_light_code)
         logger.info("lights_on_times from config is %r" %lights_on_times)
         logger.info("lights_off_times from config is %r" %lights_off_times)
+        logger.info("multiprocess from config is %r" %multiprocess)
         logger.info("ip address computed dynamically is %r" %IP_address)
 
 
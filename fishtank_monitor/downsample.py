@@ -0,0 +1,109 @@
+## @package downsample
+#  Reduce long series of measurements to a fixed number of points for charting
+#
+#  Charting every sample of a long time range is slow and produces enormous
+#  images, so charts are drawn from a downsampled series instead.  Both
+#  downsamplers here make a single pass over their input, holding only a
+#  bounded amount of it at once, so they can be fed straight from a database
+#  cursor:
+#
+#  * MinMaxDownsampler divides the time range into buckets (one per pixel,
+#    say) and keeps the lowest and highest sample in each, so that every spike
+#    remains visible.  Its memory use is proportional to the number of buckets.
+#  * lttb implements Largest-Triangle-Three-Buckets, which picks the single
+#    most visually significant sample from each bucket of equal sample count.
+#    It needs to know the number of samples up front and holds two buckets at
+#    a time.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import itertools
+
+## Keep the minimum and maximum sample within each of a fixed number of time buckets
+class MinMaxDownsampler:
+
+    ## The constructor
+    #
+    #  @param start the start of the time range
+    #  @param end the end of the time range
+    #  @param points the point budget;  the range is split into points/2 buckets,
+    #         each contributing at most two points
+    def __init__(self, start, end, points):
+        self.start = start
+        self.buckets = max(1, points // 2)
+        self.width = float(end - start) / self.buckets or 1.0
+        self._low = {}
+        self._high = {}
+
+    ## Add a sample
+    #
+    #  @param t the time of the sample
+    #  @param v the value of the sample, ignored if None
+    def add(self, t, v):
+        if v is None:
+            return
+        b = min(self.buckets - 1, max(0, int((t - self.start) / self.width)))
+        low = self._low.get(b)
+        if low is None:
+            self._low[b] = self._high[b] = (t, v)
+        elif v < low[1]:
+            self._low[b] = (t, v)
+        elif v > self._high[b][1]:
+            self._high[b] = (t, v)
+
+    ## The downsampled series
+    #
+    #  @return a list of (time, value) tuples in time order
+    def points(self):
+        result = []
+        for b in sorted(self._low):
+            pair = sorted(set([self._low[b], self._high[b]]))
+            result.extend(pair)
+        return result
+
+## Downsample a series with Largest-Triangle-Three-Buckets
+#
+#  The first and last samples are always kept.  The rest are split into
+#  threshold - 2 buckets of equal sample count and from each the sample making
+#  the largest triangle with the sample chosen from the previous bucket and the
+#  average of the next bucket is kept.
+#
+#  @param samples an iterable of (time, value) tuples in time order
+#  @param count the number of samples the iterable will produce
+#  @param threshold the number of points to produce
+#  @return a generator of (time, value) tuples in time order
+def lttb(samples, count, threshold):
+    samples = iter(samples)
+    if threshold >= count or threshold < 3:
+        for s in samples:
+            yield s
+        return
+    every = float(count - 2) / (threshold - 2)
+
+    # bucket i holds samples int(i*every)+1 up to int((i+1)*every)+1;  the
+    # final sample forms a bucket of its own
+    def read_bucket(i):
+        if i >= threshold - 2:
+            return list(itertools.islice(samples, 1))
+        first = int(i * every) + 1
+        last = min(count - 1, int((i + 1) * every) + 1)
+        return list(itertools.islice(samples, last - first))
+
+    chosen = next(samples)
+    yield chosen
+    current = read_bucket(0)
+    for i in range(threshold - 2):
+        following = read_bucket(i + 1)
+        avg_t = sum(s[0] for s in following) / len(following)
+        avg_v = sum(s[1] for s in following) / len(following)
+        best, best_area = current[0], -1.0
+        for s in current:
+            area = abs((chosen[0] - avg_t) * (s[1] - chosen[1]) - (chosen[0] - s[0]) * (avg_v - chosen[1]))
+            if area > best_area:
+                best, best_area = s, area
+        chosen = best
+        yield chosen
+        current = following
+    yield current[-1]
@@ -0,0 +1,238 @@
+## @package export
+#  Streaming export of the measurement history
+#
+#  The measurements in a time range are read in batches, each in its own short
+#  query continuing from where the last left off, so memory use is constant
+#  and no read lock is held long enough to hold up the writer.  The batches
+#  are read through the ::partitions router, so archived months are exported
+#  too.  The rows are
+#  piped through a writer for one of these formats, optionally gzip
+#  compressed on the fly:
+#
+#  Format    | Contents
+#  --------- | ----------------------------------------------------------------
+#  csv       | a header line of column names then one line per measurement
+#  jsonl     | one JSON object per measurement
+#  columnar  | a binary format holding blocks of up to block_rows rows, each
+#            | block storing the values of one column after another
+#
+#  The columnar format starts with the magic line "FTMC1", then the number of
+#  columns (uint32) and for each column a length-prefixed name and an array
+#  type code ('q' for int64, 'd' for double).  Blocks follow, each a row count
+#  (uint32) then each column's values in turn, all little-endian.  A block of
+#  zero rows ends the file.  Missing values are stored as NaN.
+#
+#  Run as a script to export from the command line:
+#
+#      python export.py --format csv --gzip --start 2015-01-01 --output history.csv.gz
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import sys
+import io
+import csv
+import json
+import gzip
+import struct
+import array
+import itertools
+import datetime
+import time
+import sensors
+import partitions
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The exported columns and their columnar array type codes
+columns = [('time', 'q'), ('temp', 'd'), ('ph', 'd'), ('ph_raw', 'd')]
+
+## The number of rows fetched by each query
+batch_rows = 10000
+
+## The number of rows in each block of the columnar format
+block_rows = 4096
+
+## The magic line starting a columnar file
+columnar_magic = b'FTMC1\n'
+
+_count = struct.Struct('<I')
+
+## Read the measurements in a time range, oldest first, in batches
+#
+#  @param conn the database connection to use
+#  @param start the start of the range, defaults to the beginning of time
+#  @param end the end of the range (exclusive), defaults to the end of time
+#  @return a generator of (time, temp, ph, ph_raw) tuples
+def rows(conn, start=None, end=None):
+    start = float('-inf') if start is None else start
+    end = float('inf') if end is None else end
+    # the measurements view, which only the database has, spelt out over readings
+    query = 'select t.time, t.value, p.value, r.value from readings t ' \
+            'left join readings p on p.tank = t.tank and p.sensor = %d and p.time = t.time ' \
+            'left join readings r on r.tank = t.tank and r.sensor = %d and r.time = t.time ' \
+            'where t.tank = %d and t.sensor = %d and t.time %%s ? and t.time < ? order by t.time limit ?' \
+            %(sensors.PH, sensors.PH_RAW, sensors.local_tank, sensors.TEMPERATURE)
+    def read(op, after):
+        return list(itertools.islice(partitions.ordered_query(conn, query %op, (after, end, batch_rows),
+                                                              after, end), batch_rows))
+    batch = read('>=', start)
+    while True:
+        for row in batch:
+            yield row
+        if len(batch) < batch_rows:
+            return
+        # there is one measurement per time, so each batch continues after the last
+        batch = read('>', batch[-1][0])
+
+## Write rows as CSV
+#
+#  @param rows an iterable of row tuples
+#  @param out the binary stream to write to
+#  @return the number of rows written
+def write_csv(rows, out):
+    text = io.TextIOWrapper(out, encoding='UTF8', newline='')
+    writer = csv.writer(text)
+    writer.writerow([name for name, code in columns])
+    count = 0
+    for row in rows:
+        writer.writerow(['' if v is None else v for v in row])
+        count += 1
+    text.flush()
+    text.detach()
+    return count
+
+## Write rows as JSON lines
+#
+#  @param rows an iterable of row tuples
+#  @param out the binary stream to write to
+#  @return the number of rows written
+def write_jsonl(rows, out):
+    names = [name for name, code in columns]
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(names, row))).encode('UTF8') + b'\n')
+        count += 1
+    return count
+
+## Write one block of the columnar format
+#
+#  @param block a list of row tuples
+#  @param out the binary stream to write to
+def _write_block(block, out):
+    out.write(_count.pack(len(block)))
+    for i, (name, code) in enumerate(columns):
+        if code == 'q':
+            values = array.array(code, (int(row[i]) for row in block))
+        else:
+            values = array.array(code, (float('nan') if row[i] is None else row[i] for row in block))
+        if sys.byteorder != 'little':
+            values.byteswap()
+        out.write(values.tobytes())
+
+## Write rows in the columnar format
+#
+#  @param rows an iterable of row tuples
+#  @param out the binary stream to write to
+#  @return the number of rows written
+def write_columnar(rows, out):
+    out.write(columnar_magic)
+    out.write(_count.pack(len(columns)))
+    for name, code in columns:
+        out.write(struct.pack('<B', len(name)) + name.encode('UTF8') + code.encode('UTF8'))
+    count = 0
+    block = []
+    for row in rows:
+        block.append(row)
+        if len(block) == block_rows:
+            _write_block(block, out)
+            count += len(block)
+            block = []
+    if block:
+        _write_block(block, out)
+        count += len(block)
+    out.write(_count.pack(0))
+    return count
+
+## Read a file in the columnar format
+#
+#  @param stream the binary stream to read from
+#  @return a generator of row tuples, with NaN values returned as None
+def read_columnar(stream):
+    if stream.read(len(columnar_magic)) != columnar_magic:
+        raise ValueError('not a columnar export')
+    header = []
+    for i in range(_count.unpack(stream.read(_count.size))[0]):
+        length = stream.read(1)[0]
+        name = stream.read(length).decode('UTF8')
+        header.append((name, stream.read(1).decode('UTF8')))
+    while True:
+        n = _count.unpack(stream.read(_count.size))[0]
+        if not n:
+            return
+        values = []
+        for name, code in header:
+            a = array.array(code)
+            a.frombytes(stream.read(n * a.itemsize))
+            if sys.byteorder != 'little':
+                a.byteswap()
+            values.append([None if v != v else v for v in a])
+        for row in zip(*values):
+            yield row
+
+## The writer for each export format
+writers = { 'csv': write_csv, 'jsonl': write_jsonl, 'columnar': write_columnar }
+
+## Export the measurements in a time range
+#
+#  @param conn the database connection to use
+#  @param out the binary stream to write to
+#  @param fmt the export format, one of the keys of writers
+#  @param start the start of the range, defaults to the beginning of time
+#  @param end the end of the range (exclusive), defaults to the end of time
+#  @param compress True, to gzip the output on the fly
+#  @return the number of rows exported
+def export(conn, out, fmt='csv', start=None, end=None, compress=False):
+    if fmt not in writers:
+        raise ValueError('unknown export format:  %r' %fmt)
+    if compress:
+        out = gzip.GzipFile(fileobj=out, mode='wb')
+    try:
+        count = writers[fmt](rows(conn, start, end), out)
+    finally:
+        if compress:
+            out.close()
+    logger.info("exported %d measurements as %s" %(count, fmt))
+    return count
+
+## Parse a command line time, either seconds since the epoch or a local date
+#
+#  @param text the time as given, for example "1425168000" or "2015-03-01"
+#  @return seconds since the epoch
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        return time.mktime(datetime.datetime.strptime(text, '%Y-%m-%d').timetuple())
+
+if __name__ == "__main__":
+    import argparse
+    import fishtank_monitor
+    parser = argparse.ArgumentParser(description='Export the fishtank measurement history')
+    parser.add_argument('--format', choices=sorted(writers), default='csv')
+    parser.add_argument('--gzip', action='store_true', help='compress the output')
+    parser.add_argument('--start', type=parse_time, help='seconds since the epoch or YYYY-MM-DD')
+    parser.add_argument('--end', type=parse_time, help='seconds since the epoch or YYYY-MM-DD')
+    parser.add_argument('--database', default=fishtank_monitor.database_filename)
+    parser.add_argument('--output', help='the file to write, defaults to standard output')
+    args = parser.parse_args()
+    conn = fishtank_monitor.open_database(args.database)
+    out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        export(conn, out, args.format, args.start, args.end, args.gzip)
+    finally:
+        out.flush()
+        if args.output:
+            out.close()
@@ -0,0 +1,223 @@
+## @package filters
+#  Noise filters applied to sensor readings as they arrive
+#
+#  A single noisy thermistor or ph reading should not be enough to trigger a
+#  warning, so each sensor's readings may be passed through a filter between
+#  being parsed and being published, stored and checked.  The filter for each
+#  sensor is configured in the [filters] section of the config file, as the
+#  filter's name and its parameters:
+#
+#  Filter             | Example          | Each output is
+#  ------------------ | ---------------- | ------------------------------------
+#  median size        | median 5         | the median of the last size readings
+#  ewma alpha         | ewma 0.3         | alpha of the reading plus 1 - alpha of the last output
+#  kalman q r         | kalman 1e-4 0.01 | the estimate of a random walk of variance q per reading, read with noise of variance r
+#
+#  Every filter costs the same per reading however long it runs.  Each also
+#  has a batch form, filter_series, working on a whole array of readings with
+#  numpy and giving the same outputs (to within rounding), so history can be
+#  re-filtered consistently with what was filtered as it arrived.  numpy is
+#  comparatively slow to import and only needed for that, so it is imported
+#  lazily.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import math
+import collections
+import sensors
+
+## The median of a short list of values
+def _median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2.0
+
+## Solve the recurrence y[n] = c[n] * y[n-1] + d[n] for a whole array
+#
+#  The array is solved in chunks, within each of which y is the running
+#  product of c times the running sum of d divided by that product;  each chunk
+#  ends before the product can underflow, so a run of coefficients near 1
+#  is solved in one chunk however long it is.
+#
+#  @param np the numpy module
+#  @param c the array of coefficients, each in [0, 1]
+#  @param d the array of terms
+#  @param y the value before the first
+#  @return the array of y
+def recurrence(np, c, d, y):
+    out = np.empty(len(d))
+    # the running log10 of the product, so each chunk's end can be searched for
+    logs = np.cumsum(np.log10(np.maximum(c, 1e-300)))
+    i = 0
+    while i < len(d):
+        base = logs[i - 1] if i else 0.0
+        j = max(i + 1, int(np.searchsorted(-logs, 250 - base, side='right')))
+        product = np.cumprod(c[i:j])
+        if product[-1] > 0:
+            out[i:j] = product * (y + np.cumsum(d[i:j] / product))
+        else:
+            out[i] = c[i] * y + d[i]
+            j = i + 1
+        y = out[j - 1]
+        i = j
+    return out
+
+## Median-of-N filter, rejecting isolated spikes outright
+class MedianFilter:
+
+    ## The constructor
+    #
+    #  @param size the number of readings the median is taken over
+    def __init__(self, size=5):
+        if size < 1:
+            raise ValueError('median filter size must be at least 1:  %r' %size)
+        self.size = int(size)
+        self._window = collections.deque(maxlen=self.size)
+
+    ## Filter one reading
+    #
+    #  @param value the reading
+    #  @return the filtered value
+    def __call__(self, value):
+        self._window.append(value)
+        return _median(self._window)
+
+    ## Filter a whole series
+    #
+    #  @param values a sequence of readings
+    #  @return a numpy array of the filtered values
+    def filter_series(self, values):
+        import numpy as np
+        values = np.asarray(values, dtype=float)
+        out = np.empty(len(values))
+        head = min(len(values), self.size - 1)
+        for i in range(head):
+            out[i] = _median(values[:i + 1])
+        if len(values) >= self.size:
+            windows = np.vstack([values[k:len(values) - self.size + 1 + k] for k in range(self.size)])
+            out[head:] = np.median(windows, axis=0)
+        return out
+
+## Exponentially weighted moving average filter
+class EWMAFilter:
+
+    ## The constructor
+    #
+    #  @param alpha the weight of each new reading, between 0 and 1
+    def __init__(self, alpha=0.3):
+        if not 0 < alpha < 1:
+            raise ValueError('ewma filter alpha must be between 0 and 1:  %r' %alpha)
+        self.alpha = alpha
+        self._value = None
+
+    def __call__(self, value):
+        if self._value is None:
+            self._value = value
+        else:
+            self._value += self.alpha * (value - self._value)
+        return self._value
+
+    def filter_series(self, values):
+        import numpy as np
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return values
+        c = np.full(len(values) - 1, 1 - self.alpha)
+        return np.concatenate((values[:1], recurrence(np, c, self.alpha * values[1:], values[0])))
+
+## One dimensional Kalman filter, modelling the reading as a random walk
+class KalmanFilter:
+
+    ## The constructor
+    #
+    #  @param process_variance the variance of the true value's change
+    #         between readings
+    #  @param measurement_variance the variance of the noise in each reading
+    def __init__(self, process_variance=1e-4, measurement_variance=1e-2):
+        if process_variance < 0 or measurement_variance <= 0:
+            raise ValueError('kalman filter variances must be positive:  %r, %r'
+                             %(process_variance, measurement_variance))
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self._value = None
+        self._variance = None
+
+    ## Advance the estimate's variance by one reading
+    #
+    #  @param variance the estimate's variance after the last reading
+    #  @return a tuple of (gain, variance after this reading)
+    def _step(self, variance):
+        variance += self.process_variance
+        gain = variance / (variance + self.measurement_variance)
+        return gain, (1 - gain) * variance
+
+    def __call__(self, value):
+        if self._value is None:
+            self._value, self._variance = value, self.measurement_variance
+        else:
+            gain, self._variance = self._step(self._variance)
+            self._value += gain * (value - self._value)
+        return self._value
+
+    def filter_series(self, values):
+        import numpy as np
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return values
+        # the gains do not depend on the readings and settle quickly, so they
+        # are only stepped until they stop changing
+        gains = np.empty(len(values) - 1)
+        variance = self.measurement_variance
+        for i in range(len(gains)):
+            gain, variance = self._step(variance)
+            gains[i] = gain
+            if i and gain == gains[i - 1]:
+                gains[i:] = gain
+                break
+        return np.concatenate((values[:1], recurrence(np, 1 - gains, gains * values[1:], values[0])))
+
+## The filters by configured name
+filter_types = { 'median': MedianFilter, 'ewma': EWMAFilter, 'kalman': KalmanFilter }
+
+## Build a filter from its configured description
+#
+#  @param spec the filter's name followed by its parameters, e.g. 'median 5'
+#  @return the filter
+def parse_filter(spec):
+    words = spec.split()
+    if not words or words[0] not in filter_types:
+        raise ValueError('unknown filter:  %r' %spec)
+    return filter_types[words[0]](*[float(word) for word in words[1:]])
+
+## The filters of a set of sensors
+class FilterBank:
+
+    ## The constructor
+    #
+    #  @param specs a dict of sensor name to filter description, sensors not
+    #         listed being left unfiltered
+    def __init__(self, specs):
+        self.filters = dict((name, parse_filter(spec)) for name, spec in specs.items())
+
+    ## Filter the readings of one message
+    #
+    #  @param values a dict of sensor name to value
+    #  @return a dict of sensor name to filtered value
+    def __call__(self, values):
+        return dict((name, self.filters[name](value) if name in self.filters else value)
+                    for name, value in values.items())
+
+## Filter a stored series consistently with the configured filters
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param spec the filter's description
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @return a list of (time, filtered value) tuples, oldest first
+def refilter(conn, name, spec, start, end):
+    series = [(t, v) for t, v in sensors.series(conn, name, start, end) if v is not None]
+    filtered = parse_filter(spec).filter_series([v for t, v in series])
+    return [(t, float(f)) for (t, v), f in zip(series, filtered)]
@@ -51,18 +51,31 @@
 #    hardware ::setup
 #  * The Alamode then enters a ::loop where it periodically:
 #      * updates the LCD with the current time and sensor measurements in ::loop
-#      * sends the Raspberry Pi JSON-formatted sensor measurements and logs
+#      * sends the Raspberry Pi JSON-formatted sensor measurements and logs, or
+#        compact binary frames of them once the Pi has asked for those
 #      * receives the possibly updated configuration data and applies it
 #
 #  @subsection Pi The Raspberry Pi
-#  * The Raspberry Pi reads the config file makes the configuration parameters available
+#  * Importing the Python modules performs no I/O;  all start-up work is done
+#    explicitly by ::fishtank_monitor::bootstrap
+#  * The Raspberry Pi opens its log, reads the config file makes the configuration
+#    parameters available and opens the sqlite database
 #  * It creates the notifiers used to publish emailed reports and warnings
 #    via ::notifications::get_notifiers
-#  * It creates the ::serial_monitor::SerialMonitor and immediately uses it to send
-#    the alamode configuration data
-#  * It creates the ::scheduler::LightScheduler and starts it to manage the lights
-#  * Thereafter, it enters a loop of writing measurement data to the sqlite database,
-#    triggering the notifiers and detecting and recovering from certain errors
+#  * It creates a ::supervisor::Supervisor which starts and thereafter watches:
+#      * the ::serial_monitor::SerialMonitor, which immediately sends the alamode
+#        configuration data
+#      * the ::scheduler::LightScheduler, which manages the lights
+#      * the writer, which periodically appends measurement data to the durable
+#        ::reading_log::ReadingLog
+#      * the applier, which moves logged measurements into the sqlite database
+#      * the notifiers
+#      * the pusher, which sends the readings to any configured ::collector
+#      * the site builder, which rebuilds any configured ::status_site
+#  * Thereafter, the supervisor restarts any of these which dies or stops
+#    heartbeating, backing off exponentially while restarts keep failing
+#  * Optionally, the same work is split across several processes by
+#    ::processes::main_loop
 #
 #  @subsection Acknowledgements
 #  This software has benefitted from the work of many other open source developers and
@@ -79,6 +92,7 @@
 #  python           | https://www.python.org/
 #  schedule         | https://pypi.python.org/pypi/schedule
 #  pygal            | http://pygal.org/
+#  numpy            | http://www.numpy.org/
 #  virtualenv       | https://pypi.python.org/pypi/virtualenv
 #  pip              | https://pypi.python.org/pypi/pip
 #
@@ -107,18 +121,325 @@
 
 import time
 import sqlite3
+import threading
 from serial_monitor import SerialMonitor
 from notifications import get_notifiers
+from notifier_pool import NotifierPool
 import config
 import scheduler
+import supervisor
+import reading_log
+import calibration
+import sensors
+import query_cache
+import gaps
+import partitions
+import sketches
+import alerts
+import status_site
+import collector
+import compression
+import forecast
+import log
 from log import get_logger
 
 logger = get_logger(__name__)
 
-conn = sqlite3.Connection('./fishtank.db')
+## The path to the sqlite database holding measurements and settings
+database_filename = './fishtank.db'
 
-conn.execute('create table if not exists measurements (time INT, temp REAL, ph REAL)')
-conn.execute('create table if not exists settings (last_calibration REAL)')
+## The database connection, opened by bootstrap rather than at import time
+conn = None
+
+## Seconds a connection waits for another's write to finish before giving up
+database_timeout = 30
+
+## The connections of the component threads, one per thread
+_connections = threading.local()
+
+## The directory holding the reading log segments
+reading_log_directory = './reading_log'
+
+## The reading log every measurement is written through, opened by bootstrap
+readings = None
+
+## The ::notifier_pool::NotifierPool the notifiers run on, started on first use
+notifier_pool = None
+
+## Connect to the sqlite database
+#
+#  @param filename the database file to open, defaults to database_filename
+#  @return the open database connection
+def connect(filename=None):
+    return sqlite3.Connection(filename or database_filename, timeout=database_timeout, check_same_thread=False)
+
+## Get the calling thread's own database connection, connecting on first use
+#
+#  sqlite transactions belong to a connection rather than a thread, so
+#  threads sharing a connection could commit or roll back each other's half
+#  done work.  Each component thread, and each notifier pool worker, uses a
+#  connection of its own instead, waiting up to database_timeout for any
+#  other's write to finish.
+#
+#  @return the open database connection
+def thread_connection():
+    if getattr(_connections, 'conn', None) is None:
+        _connections.conn = connect()
+    return _connections.conn
+
+## Open the sqlite database, creating the tables on first use
+#
+#  Readings are stored in the ::sensors tables, migrating an old measurements
+#  table if there is one.
+#
+#  @param filename the database file to open (':memory:' works for tests)
+#  @return the open database connection
+def open_database(filename=None):
+    c = connect(filename)
+    sensors.create_tables(c)
+    gaps.create_table(c)
+    sketches.create_table(c)
+    alerts.create_table(c)
+    status_site.create_table(c)
+    c.execute('create table if not exists settings (last_calibration REAL)')
+    c.execute('create table if not exists reading_log_state (applied_seq INT)')
+    c.execute('create table if not exists calibrations (time REAL, offset REAL, slope REAL)')
+    c.execute('create table if not exists summaries (period TEXT, start INT, count INT, temp_min REAL, temp_max REAL, '
+              'temp_sum REAL, ph_min REAL, ph_max REAL, ph_sum REAL, primary key (period, start))')
+    c.commit()
+    return c
+
+## Load the time of the last ph calibration from the database into config
+#
+#  If calibration reminders are enabled but no calibration has been recorded
+#  yet, now is recorded as the last calibration.
+#
+#  @param c the database connection to use
+def load_last_calibration(c):
+    if config.months_between_calibrations:
+        try:
+            config.last_calibration = c.execute('select last_calibration from settings').fetchall()[0][0]
+        except:
+            pass
+        if not config.last_calibration:
+            config.last_calibration = time.time()
+            c.execute('insert into settings values (%r)' %config.last_calibration)
+            c.commit()
+    logger.info("last_calibration from database is %r" %config.last_calibration)
+
+## Record the ph calibration from the config file if it has changed
+#
+#  @param c the database connection to use
+def update_calibration(c):
+    if config.ph_offset is not None:
+        calibration.record_calibration(c, config.ph_offset, config.ph_slope)
+
+## Open the reading log with the compressor configured, as read from the
+#  config file
+#
+#  @param log_directory the reading log directory, defaults to
+#         reading_log_directory
+#  @return the ::reading_log::ReadingLog
+def open_reading_log(log_directory=None):
+    return reading_log.ReadingLog(log_directory or reading_log_directory, compressor=compression.from_config())
+
+## Bring the application up
+#
+#  Importing the fishtank monitor modules has no side effects - no files are
+#  opened and nothing is read.  This function performs all of the start-up
+#  I/O in one place:  opening the log file, reading the config file, opening
+#  the database, replaying any readings the reading log holds that never made
+#  it to the database, loading the last calibration time and recording the
+#  configured ph calibration.
+#
+#  @param db_filename the database file to open, defaults to database_filename,
+#         which the components then connect to
+#  @param log_directory the reading log directory, defaults to
+#         reading_log_directory
+#  @return the list of notifier functors to pass to main_loop
+def bootstrap(db_filename=None, log_directory=None):
+    global conn, readings, database_filename
+    log.init_logging()
+    logger.info("getting parameters from config file")
+    config.read_config()
+    database_filename = db_filename or database_filename
+    conn = open_database()
+    readings = open_reading_log(log_directory)
+    load_last_calibration(conn)
+    update_calibration(conn)
+    readings.replay(conn)
+    return get_notifiers()
+
+## Seconds between measurements written to the database (and notifier runs)
+measurement_interval = 60*60
+
+## Seconds between applying the reading log to the database
+apply_interval = 10
+
+## Seconds without hearing from the Alamode before the serial link is reopened
+serial_heartbeat_timeout = 10*60
+
+## Seconds to wait for the first reading from a newly started serial monitor
+first_reading_timeout = 60
+
+## Build the configuration object sent to the Alamode from the config file
+#
+#  @return a dict to be JSON encoded and sent to the Alamode
+def alamode_configuration():
+    return {
+             "thermistor_pin": config.temperature_pin,
+             "ph_pin": config.ph_pin,
+             "daylight": config.daylight_tz,
+             "standard": config.standard_tz,
+             "ph_offset": config.ph_offset,
+             "ip_address": config.IP_address,
+             "framing": config.serial_framing
+           }
+
+## Get the current serial monitor, once it has a complete reading
+#
+#  @param sup the Supervisor owning the serial monitor
+#  @return the SerialMonitor, or None if it has no readings yet
+def reading_monitor(sup):
+    monitor = sup['serial'].instance
+    if monitor is None or not monitor.started.wait(first_reading_timeout):
+        return None
+    if monitor.temperature is None or monitor.ph is None:
+        return None
+    return monitor
+
+## Build the readings of every sensor to store from a reading
+#
+#  The temperature and the ph, made raw again with the configuration the
+#  reading was taken with, are followed by the readings of any sensors beyond
+#  the required ones.
+#
+#  @param reading the ::serial_monitor::Reading to store
+#  @param monitor the ::serial_monitor::SerialMonitor the reading came from
+#  @return a tuple of (time, a list of (sensor name, value) pairs)
+def sensor_readings(reading, monitor):
+    ph_raw = calibration.raw_ph(reading.ph, monitor.configuration)
+    others = [(name, value) for name, value in reading.values if name not in monitor.required_sensors]
+    return int(reading.time), [('temperature', reading.temperature), ('ph_raw', ph_raw)] + others
+
+## Write the most recent readings to the reading log
+#
+#  The readings of every sensor reach the database when the reading log is
+#  next applied, and are added to the shared ::forecast::TrendForecaster
+#  straight away.  Readings old enough are then archived to their
+#  ::partitions.
+#
+#  @param sup the Supervisor owning the serial monitor
+#  @param conn the database connection to use
+def write_measurements(sup, conn):
+    monitor = reading_monitor(sup)
+    if monitor is not None:
+        reading = monitor.reading
+        logger.info("logging measurements ph is %r, temperature is %r" %(reading.ph, reading.temperature))
+        readings.append(sensor_readings(reading, monitor))
+        forecast.get_forecaster().add_reading(sensors.local_tank, reading)
+        logger.info("re-reading config in case anything's changed")
+        config.read_config()
+        update_calibration(conn)
+        partitions.archive(conn)
+
+## Apply the reading log to the database and discard what is no longer needed
+#
+#  @param conn the database connection to use
+def apply_readings(conn):
+    if readings.apply(conn):
+        readings.compact()
+
+## Trigger the notifiers concurrently, isolating them from each other's failures
+#
+#  Every notifier is handed the same snapshot of the latest reading and run on
+#  the notifier_pool, in priority order and each with its own deadline, so
+#  warnings never wait behind reports.  Returns once every notifier is done or
+#  has missed its deadline.
+#
+#  @param monitor the source of the current reading, or None if there are no
+#         readings yet
+#  @param notifiers the list of notifier functors to call
+def run_notifiers(monitor, notifiers):
+    global notifier_pool
+    reading = monitor.reading if monitor is not None else None
+    if reading is not None:
+        logger.info("checking notifications")
+        if notifier_pool is None:
+            notifier_pool = NotifierPool()
+        jobs = [notifier_pool.submit(n.name, notify, (n, reading), n.priority, n.timeout) for n in notifiers]
+        notifier_pool.wait([job for job in jobs if job is not None])
+        logger.info("notifier stats:  %r" %notifier_pool.stats())
+        logger.info("query cache stats:  %r" %query_cache.stats())
+
+## Run one notifier on the calling pool worker's own database connection
+#
+#  @param notifier the notifier functor
+#  @param reading the ::serial_monitor::Reading to notify of
+def notify(notifier, reading):
+    notifier(thread_connection(), reading)
+
+## Build and start the light scheduler thread
+#
+#  @return the started LightScheduler
+def start_scheduler():
+    light_scheduler = scheduler.LightScheduler()
+    light_scheduler.start()
+    return light_scheduler
+
+## Build and start a periodic task thread
+#
+#  @param name the name of the task
+#  @param function the callable to run each period
+#  @param interval seconds between calls
+#  @return the started ::supervisor::PeriodicTask
+def start_task(name, function, interval=None):
+    task = supervisor.PeriodicTask(name, function, interval or measurement_interval)
+    task.start()
+    return task
+
+## Build the supervised serial monitor component
+#
+#  @return the ::supervisor::Component for the serial monitor
+def serial_component():
+    return supervisor.Component('serial',
+                                lambda: SerialMonitor.create_and_start_monitor(alamode_configuration()),
+                                serial_heartbeat_timeout)
+
+## Build the supervisor owning every component of the fishtank monitor
+#
+#  The components are the serial monitor, the light scheduler, the measurement
+#  writer, the applier moving logged readings into the database, the
+#  notifiers, the pusher sending the readings to any configured ::collector
+#  and the builder of any configured ::status_site.  None are started until
+#  the supervisor's first check.  Each runs on a thread_connection of its own.
+#
+#  @param notifiers the list of notifier functors to call each period
+#  @return the Supervisor
+def build_supervisor(notifiers):
+    sup = supervisor.Supervisor([
+        serial_component(),
+        supervisor.Component('scheduler', start_scheduler, 60),
+        supervisor.Component('writer',
+                             lambda: start_task('writer', lambda: write_measurements(sup, thread_connection())),
+                             2*measurement_interval + first_reading_timeout),
+        supervisor.Component('applier',
+                             lambda: start_task('applier', lambda: apply_readings(thread_connection()),
+                                                apply_interval),
+                             6*apply_interval),
+        supervisor.Component('notifiers',
+                             lambda: start_task('notifiers', lambda: run_notifiers(reading_monitor(sup), notifiers)),
+                             2*measurement_interval + first_reading_timeout),
+        supervisor.Component('pusher',
+                             lambda: start_task('pusher', lambda: collector.push(thread_connection()),
+                                                config.push_interval),
+                             2*config.push_interval + 4*collector.timeout),
+        supervisor.Component('site',
+                             lambda: start_task('site', lambda: status_site.build(thread_connection()),
+                                                config.site_interval),
+                             config.site_interval + status_site.build_timeout),
+    ])
+    return sup
 
 ## The main functional loop of ithe fishtank monitor.
 #
@@ -126,62 +447,30 @@ conn.execute('create table if not exists settings (last_calibration REAL)')
 #  * Set up serial monitoring
 #  * Configure the parameters to use on the alamode
 #  * Set up and start the light scheduler
-#  And then enter the main loop where we:
-#  * Read temperature and PH readings from the alamode
-#  * Log the readings to our database
-#  * Trigger the notifiers to send out warnings or informational messages
-#  This function is also responsible for monitoring the health of the serial
-#  monitor thread and restarting it on failures.
+#  * Start the writer, which periodically logs the readings to the reading log
+#  * Start the applier, which moves logged readings into our database
+#  * Start the notifiers, which periodically send out warnings or
+#    informational messages
+#  All of these are owned by a ::supervisor::Supervisor, which this function
+#  then runs forever, monitoring the health of every component and restarting
+#  (reopening the serial port where necessary) those which fail.
 #
 #  @param notifiers the list of notifier functors to call each iteration
 def main_loop(notifiers):
-    logger.debug("starting serial monitor")
-    alamode_cfg = { 
-                    "thermistor_pin": config.temperature_pin, 
-                    "ph_pin": config.ph_pin, 
-                    "daylight": config.daylight_tz, 
-                    "standard": config.standard_tz,
-                    "ph_offset": config.ph_offset,
-                    "ip_address": config.IP_address
-                  }
-    monitor = SerialMonitor.create_monitor(alamode_cfg)
-    monitor.start_monitor()
-    monitor.started.wait()
-    logger.debug("starting light scheduler")
-    light_scheduler = scheduler.LightScheduler()
-    light_scheduler.start()
-    logger.info("prior to while loop in main_loop, temperature is %r, ph is %r" %(monitor.temperature, monitor.ph))
-    while True:
-        if monitor.temperature is not None and monitor.ph is not None:
-            logger.info("writing measurements to database ph is %r, temperature is %r" %(monitor.ph, monitor.temperature))
-            conn.execute('insert into measurements values(?, ?, ?)',(int(time.time()), monitor.temperature, monitor.ph))
-            conn.commit()
-            logger.info("re-reading config in case anything's changed")
-            config.read_config()
-            logger.info("checking notifications")
-            for notifier in notifiers:
-                notifier(conn, monitor)
-            if not monitor.is_alive():
-                logger.error("serial monitor died, restarting")
-                monitor = SerialMonitor.create_and_start_monitor()
-        logger.info("sleeping until next check")
-        time.sleep(60*60)
+    logger.debug("starting supervisor")
+    sup = build_supervisor(notifiers)
+    sup.run()
 
 if __name__ == "__main__":
-    logger.info("getting parameters from config file")
-    config.read_config()
-    notifiers = get_notifiers()
-    if config.months_between_calibrations:
-        try:
-            config.last_calibration = conn.execute('select last_calibration from settings').fetchall()[0][0]
-        except:
-            pass
-        if not config.last_calibration:
-            config.last_calibration = time.time()
-            conn.execute('insert into settings values (%r)' %config.last_calibration)
-    logger.info("last_calibration from database is %r" %config.last_calibration)
+    notifiers = bootstrap()
     try:
-        logger.info("calling main_loop")
-        main_loop(notifiers)
+        if config.multiprocess:
+            import processes
+            logger.info("calling processes.main_loop")
+            processes.main_loop(conn, readings)
+        else:
+            logger.info("calling main_loop")
+            main_loop(notifiers)
     except Exception as e:
-        logger.exception("encountered exception in main_loop, retrying:  %r" %e)
+        logger.exception("encountered exception in main_loop, exiting:  %r" %e)
+        raise
@@ -0,0 +1,154 @@
+## @package forecast
+#  Forecasting when a sensor will leave its safe range
+#
+#  A TrendForecaster fits a straight line to the recent readings of each
+#  sensor of each tank and extrapolates it to estimate when the sensor will
+#  cross one of its limits, so the user can be warned before the tank is
+#  unsafe rather than after.
+#
+#  The fit is an exponentially weighted least squares regression:  each
+#  reading's weight halves every half_life seconds, so the line follows the
+#  recent trend while older readings fade out.  Rather than keeping a window of
+#  readings, each sensor's state is just the five weighted sums the fit is
+#  computed from, kept relative to the time of its latest reading, so an
+#  update costs the same however many readings the trend spans and the
+#  memory used is fixed per sensor, however many tanks are monitored.
+#
+#  The forecaster shared by the warning notifiers, from get_forecaster, is fed
+#  every reading as it is taken, by the measurement writer or in multiprocess
+#  mode by the notification process as each is published, so the notifiers
+#  only ever ask it for a forecast.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import math
+import threading
+import collections
+import config
+
+## A forecast breach of a sensor's limits
+Forecast = collections.namedtuple('Forecast', 'tank sensor value slope limit seconds')
+
+## The running fit of one sensor
+#
+#  The sums are of the weights w, w*t, w*v, w*t*t and w*t*v over the readings,
+#  where t is each reading's time less that of the latest.
+class Trend:
+
+    ## The constructor
+    def __init__(self):
+        self.time = None
+        self.count = 0
+        self.s0 = self.st = self.sv = self.stt = self.stv = 0.0
+
+    ## Add a reading
+    #
+    #  @param when the time of the reading
+    #  @param value the value read
+    #  @param half_life seconds over which a reading's weight halves
+    def add(self, when, value, half_life):
+        if self.time is not None:
+            d = when - self.time
+            decay = math.pow(0.5, d / half_life)
+            # move the origin to the new reading, then age the old ones
+            self.stt = (self.stt - 2 * d * self.st + d * d * self.s0) * decay
+            self.stv = (self.stv - d * self.sv) * decay
+            self.st = (self.st - d * self.s0) * decay
+            self.s0 *= decay
+            self.sv *= decay
+        self.time = when
+        self.count += 1
+        self.s0 += 1
+        self.sv += value
+
+    ## The fitted line at the latest reading
+    #
+    #  @return a tuple of (value, slope per second), or None if the readings
+    #          all share one time
+    def line(self):
+        determinant = self.s0 * self.stt - self.st * self.st
+        if determinant <= 1e-9 * self.s0 * self.s0:
+            return None
+        slope = (self.s0 * self.stv - self.st * self.sv) / determinant
+        return (self.sv - slope * self.st) / self.s0, slope
+
+## Forecasts limit breaches from the trends of many sensors
+class TrendForecaster:
+
+    ## The constructor
+    #
+    #  @param half_life seconds over which a reading's weight halves
+    #  @param horizon how far ahead, in seconds, to warn of breaches
+    #  @param min_readings the readings needed before a trend is trusted
+    def __init__(self, half_life=6*60*60, horizon=6*60*60, min_readings=4):
+        self.half_life = half_life
+        self.horizon = horizon
+        self.min_readings = min_readings
+        self._trends = {}
+        self._lock = threading.Lock()
+
+    ## Add a reading
+    #
+    #  Readings no newer than the sensor's latest are ignored.
+    #
+    #  @param tank the tank read
+    #  @param sensor the sensor read
+    #  @param when the time of the reading
+    #  @param value the value read
+    def add(self, tank, sensor, when, value):
+        with self._lock:
+            trend = self._trends.get((tank, sensor))
+            if trend is None:
+                trend = self._trends[(tank, sensor)] = Trend()
+            if trend.time is None or when > trend.time:
+                trend.add(when, value, self.half_life)
+
+    ## Add the reading of every sensor in a reading
+    #
+    #  @param tank the tank read
+    #  @param reading the ::serial_monitor::Reading
+    def add_reading(self, tank, reading):
+        for sensor, value in reading.values:
+            if value is not None:
+                self.add(tank, sensor, reading.time, value)
+
+    ## Forecast whether a sensor will leave its safe range within the horizon
+    #
+    #  @param tank the tank
+    #  @param sensor the sensor
+    #  @param low the low limit of the safe range
+    #  @param high the high limit of the safe range
+    #  @return a Forecast, or None if no breach is forecast
+    def forecast(self, tank, sensor, low, high):
+        with self._lock:
+            trend = self._trends.get((tank, sensor))
+            if trend is None or trend.count < self.min_readings:
+                return None
+            fit = trend.line()
+        if fit is None:
+            return None
+        value, slope = fit
+        if slope > 0 and value <= high:
+            limit = high
+        elif slope < 0 and value >= low:
+            limit = low
+        else:
+            return None
+        seconds = (limit - value) / slope
+        if seconds > self.horizon:
+            return None
+        return Forecast(tank, sensor, value, slope, limit, seconds)
+
+## The shared forecaster, created on first use by get_forecaster
+_forecaster = None
+
+## Lazy instantiator for the forecaster shared by the warning notifiers
+#
+#  @return the TrendForecaster
+def get_forecaster():
+    global _forecaster
+    if _forecaster is None:
+        _forecaster = TrendForecaster(config.forecast_half_life, config.forecast_horizon)
+    return _forecaster
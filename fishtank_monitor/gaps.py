@@ -0,0 +1,131 @@
+## @package gaps
+#  The index of gaps in the measurement series
+#
+#  When the Alamode or the serial link dies, the only trace left in the
+#  database is readings which are missing.  Rather than finding them by
+#  scanning the history, every interval between consecutive measurements of
+#  a tank longer than config.gap_threshold seconds is recorded in the gaps
+#  table as it arises:
+#
+#  Column | Contents
+#  ------ | ---------------------------------------------------------------
+#  tank   | the tank
+#  start  | the time of the last measurement before the gap
+#  end    | the time of the first measurement after it
+#
+#  The table is keyed by (tank, start), and as gaps never overlap, the gaps
+#  within any time range are found with one index seek.  A tank's
+#  measurements are its temperature readings, as in the measurements view of
+#  ::sensors.
+#
+#  The index is kept up to date by note, as the ::reading_log stores each
+#  batch of readings, and by rebuild, which recomputes it over a time range
+#  with one sequential scan of the readings, archived ::partitions included
+#  (as after a ::backfill).  A
+#  database without the table has it built from its whole history on open.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import config
+import sensors
+import partitions
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## Create the gaps table, building it from the existing history if it is new
+#
+#  @param conn the database connection to use
+def create_table(conn):
+    exists = conn.execute("select 1 from sqlite_master where type='table' and name='gaps'").fetchone()
+    conn.execute('create table if not exists gaps (tank INT NOT NULL, start INT NOT NULL, end INT NOT NULL, '
+                 'primary key (tank, start)) without rowid')
+    if not exists:
+        tanks = [row[0] for row in conn.execute('select distinct tank from readings')]
+        with conn:
+            for tank in tanks:
+                rebuild(conn, tank=tank)
+
+## The time of the measurement nearest a time on one side
+#
+#  @param conn the database connection to use
+#  @param when the time
+#  @param after True for the first measurement after when, False for the last
+#         before it
+#  @param tank the tank
+#  @param archived True to look in the archived ::partitions too
+#  @return the time, or None if there is no such measurement
+def _neighbour(conn, when, after, tank, archived=False):
+    sql = 'select %s(time) from readings where tank=? and sensor=? and time %s ?' %(('min', '>') if after else ('max', '<'))
+    params = (tank, sensors.TEMPERATURE, when)
+    if not archived:
+        return conn.execute(sql, params).fetchone()[0]
+    start, end = (when, float('inf')) if after else (float('-inf'), when)
+    found = [row[0] for row in partitions.query(conn, sql, params, start, end, tank) if row[0] is not None]
+    return (min(found) if after else max(found)) if found else None
+
+## Update the index for newly stored measurements
+#
+#  Each measurement may end a gap, start one or split an existing one in two.
+#
+#  @param conn the database connection to use, within the caller's transaction
+#  @param times the times of the measurements
+#  @param tank the tank they are from
+#  @param threshold the shortest interval recorded as a gap
+def note(conn, times, tank=sensors.local_tank, threshold=None):
+    threshold = config.gap_threshold if threshold is None else threshold
+    for when in sorted(set(times)):
+        before = _neighbour(conn, when, False, tank)
+        after = _neighbour(conn, when, True, tank)
+        if before is not None:
+            conn.execute('delete from gaps where tank=? and start=?', (tank, before))
+            if when - before > threshold:
+                conn.execute('insert or replace into gaps values (?, ?, ?)', (tank, before, when))
+        if after is not None and after - when > threshold:
+            conn.execute('insert or replace into gaps values (?, ?, ?)', (tank, when, after))
+
+## Recompute the index over a time range
+#
+#  The range is widened to the measurements either side of it, so gaps
+#  spanning its ends are found.
+#
+#  @param conn the database connection to use, within the caller's transaction
+#  @param start the start of the range, None for the beginning of the history
+#  @param end the end of the range (exclusive), None for the end of the history
+#  @param tank the tank
+#  @param threshold the shortest interval recorded as a gap
+#  @return the number of gaps in the range
+def rebuild(conn, start=None, end=None, tank=sensors.local_tank, threshold=None):
+    threshold = config.gap_threshold if threshold is None else threshold
+    low = None if start is None else _neighbour(conn, start, False, tank, True)
+    low = start if low is None else low
+    high = None if end is None else _neighbour(conn, end - 1, True, tank, True)
+    high = end if high is None else high
+    low = float('-inf') if low is None else low
+    high = float('inf') if high is None else high
+    conn.execute('delete from gaps where tank=? and start >= ? and start < ?', (tank, low, high))
+    found = []
+    previous = None
+    for (when,) in partitions.ordered_query(conn, 'select time from readings where tank=? and sensor=? and time >= ? '
+                                            'and time <= ? order by time', (tank, sensors.TEMPERATURE, low, high),
+                                            low, high + 1, tank):
+        if previous is not None and when - previous > threshold:
+            found.append((tank, previous, when))
+        previous = when
+    conn.executemany('insert into gaps values (?, ?, ?)', found)
+    logger.info("found %d gaps in the readings of tank %d" %(len(found), tank))
+    return len(found)
+
+## Find the gaps overlapping a time range
+#
+#  @param conn the database connection to use
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank
+#  @return a list of (start, end) tuples, oldest first
+def find(conn, start, end, tank=sensors.local_tank):
+    first = conn.execute('select max(start) from gaps where tank=? and start <= ?', (tank, start)).fetchone()[0]
+    return conn.execute('select start, end from gaps where tank=? and start >= ? and start < ? and end > ? '
+                        'order by start', (tank, start if first is None else first, end, start)).fetchall()
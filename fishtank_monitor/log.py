@@ -1,19 +1,45 @@
 ## @package log
 #  Log utilities ensuring a common formatting for logging
 #
+#  Loggers may be obtained at import time but no log file is opened until
+#  init_logging is called by the application bootstrap.  Until then records
+#  are simply not written to the log file.
+#
 #  @author  Ed Willis
 #  @copyright Ed Willis, 2015, all rights reserved
 #  @license  This software is released into the public domain
 
 import logging, logging.handlers
 
-log_handler = logging.handlers.TimedRotatingFileHandler("log/fishtank_monitor.log",
-                                                         backupCount=5,
-                                                         when="midnight")
+## The path to the log file opened by init_logging
+log_filename = "log/fishtank_monitor.log"
+
+## The shared file handler, created on the first call to init_logging
+log_handler = None
 
 ## The log format tracks time and module in addition to the message
 log_formatter = logging.Formatter('%(asctime)s | %(module)16s | %(levelname)5s | %(message)s')
-log_handler.setFormatter(log_formatter)
+
+## Every logger handed out by get_logger, so init_logging can attach to them
+_loggers = []
+
+## Open the log file and attach it to every logger handed out so far
+#
+#  Calling this more than once is harmless - the handler is only created the
+#  first time.
+#
+#  @param filename the log file to write to
+#  @return the file handler
+def init_logging(filename=None):
+    global log_handler
+    if log_handler is None:
+        log_handler = logging.handlers.TimedRotatingFileHandler(filename or log_filename,
+                                                                 backupCount=5,
+                                                                 when="midnight")
+        log_handler.setFormatter(log_formatter)
+        for l in _loggers:
+            l.addHandler(log_handler)
+    return log_handler
 
 ## Get a logger object specific to the calling module
 #
@@ -21,7 +47,9 @@ log_handler.setFormatter(log_formatter)
 #  @return the logger object
 def get_logger(name):
     l = logging.getLogger(name)
-    l.addHandler(log_handler)
+    if l not in _loggers:
+        _loggers.append(l)
+    if log_handler is not None:
+        l.addHandler(log_handler)
     l.setLevel(logging.INFO)
     return l
-
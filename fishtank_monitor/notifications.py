@@ -1,8 +1,8 @@
 ## @package notifications
 #  Functor class hierarchy responsible for user notification of significant events
 #
-#  This module defines a class hierarchy of functors used to send emailed
-#  communications to the user when:
+#  This module defines a class hierarchy of functors used to notify the user,
+#  on each of the configured ::channels, when:
 #
 #  * conditions in the tank become unsafe
 #  * the user-specified informational period has arrived
@@ -11,143 +11,359 @@
 #  @author  Ed Willis
 #  @copyright Ed Willis, 2015, all rights reserved
 #  @license  This software is released into the public domain
+#
+#  pygal is comparatively slow to import and is only needed when a report is
+#  actually sent, so it is imported lazily inside the method that uses it.
 
-import smtplib
-import pygal
-import pygal.style
 import time
 import datetime
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.multipart import MIMEMultipart
 from log import get_logger
 import config
+import channels
+import alerts
+import forecast
+import sensors
+import summaries
+import query_cache
+import gaps
+import sketches
 
 logger = get_logger(__name__)
 
 ## The notification base class
 #
-#  Defines email helper methods and a common template method functor
+#  Defines notification helper methods and a common template method functor
 #  interface for callers to trigger evaluation of the notification
-#  schedule and emailed communications should the conditions meet the
+#  schedule and notifications should the conditions meet the
 #  notifier-specific criteria.
 class NotifierBase:
 
+    ## The order notifiers are run in when more are due than there are
+    #  workers, lowest first (see ::notifier_pool)
+    priority = 10
+
+    ## Seconds a notifier has to finish before it is reported as late
+    timeout = 10*60
+
+    ## The name the notifier's stats are kept under
+    @property
+    def name(self):
+        return type(self).__name__
+
     ## The functor method to be provided by derived classes
     #
     #  @param conn the database connection to use if needed
-    #  @param monitor the serial monitor from which to see the current
-    #         temperature and ph
+    #  @param monitor the source of the current temperature and ph, usually
+    #         a ::serial_monitor::Reading snapshot
     def __call__(self, conn, monitor):
         pass
 
-    ## Email sending helper method
+    ## Notification sending helper method
     #
-    #  Using the configuration specified in the config file, open a
-    #  connection to the user's mail server and send the argument email
-    #  using the user's credentials.
+    #  Queues the notification on every configured channel and returns without
+    #  waiting for it to be delivered.
     #
-    # @param [in] email the MIMETest object to send
+    #  @param subject the subject line
+    #  @param text the body text
+    #  @param attachments a list of (filename, bytes) tuples
+    #  @param urgent True, for warnings about the tank's safety
     @staticmethod
-    def _send_email(email):
-        s = smtplib.SMTP(config.SMTP_host, config.SMTP_port)
-        s.ehlo()
-        if config.SMTP_use_ttls:
-            s.starttls()
-        s.ehlo()
-        s.login(config.SMTP_user, config.SMTP_password)
-        logger.info("sending emails")
-        s.sendmail(config.email_to_address, [config.email_to_address], email.as_string())
-        s.quit()
-
-## Send emails when bad temperature or ph readings are seen
+    def _send(subject, text, attachments=(), urgent=False):
+        channels.send(channels.Message(subject, text, attachments, urgent))
+
+## Send warnings when bad temperature or ph readings are seen or forecast
 #
-#  Examine the current ph and temperature values and warn the user by email if
-#  they exceed limits
+#  Examine the current ph and temperature values and alert the user if they
+#  fall outside the safe limits, or if their recent trend is forecast to take
+#  them outside within config.forecast_horizon seconds (see ::forecast).  The
+#  forecaster is fed the readings as they are taken, not by the notifier.
+#  Alerts are coalesced into one digest per window (see ::alerts), shared by
+#  every instance.
 class NotifyWarnings(NotifierBase):
 
-    ## The last time we warned the user by email
-    time_last_warned = 0
+    ## Warnings are safety-critical, so run ahead of everything else
+    priority = 0
+
+    ## Warnings should go out promptly
+    timeout = 2*60
+
+    ## The safe range of each sensor checked, as (low, high)
+    limits = { 'ph': (6.0, 8.0), 'temperature': (20, 28) }
+
+    ## The constructor
+    #
+    #  @param digest the AlertDigest to collect alerts in, defaults to the
+    #         shared one
+    #  @param forecaster the ::forecast::TrendForecaster to ask for forecasts,
+    #         defaults to the shared one
+    def __init__(self, digest=None, forecaster=None):
+        self.digest = alerts.get_digest() if digest is None else digest
+        self.forecaster = forecast.get_forecaster() if forecaster is None else forecaster
+        ## The last time we sent the user a digest
+        self.time_last_warned = 0
+
+    ## Check one sensor's reading, adding any alert to the digest
+    #
+    #  @param sensor the sensor's name
+    #  @param value the value read
+    #  @param now the current time
+    def _check(self, sensor, value, now):
+        low, high = self.limits[sensor]
+        if value < low or value > high:
+            logger.warning("%s is bad: %r" %(sensor, value))
+            self.digest.add(alerts.Alert(sensors.local_tank, sensor, alerts.LOW if value < low else alerts.HIGH,
+                                         value, now))
+        elif config.forecast_horizon > 0:
+            breach = self.forecaster.forecast(sensors.local_tank, sensor, low, high)
+            if breach is not None:
+                logger.warning("%s is forecast to reach %r in %d seconds" %(sensor, breach.limit, breach.seconds))
+                self.digest.add(alerts.Alert(sensors.local_tank, sensor,
+                                             alerts.FALLING if breach.slope < 0 else alerts.RISING,
+                                             breach.seconds/(60*60), now))
 
     def __call__(self, conn, monitor):
-        ph_bad = False
-        temp_bad = False
-        msg = ''
-        if monitor.ph and (monitor.ph < 6.0 or monitor.ph > 8.0):
-            logger.warning("ph is bad: %r" %monitor.ph)
-            ph_bad = True
-        if monitor.temperature and (monitor.temperature < 20 or monitor.temperature > 28):
-            logger.warning("temperature is bad: %r" %monitor.temperature)
-            temp_bad = True
-        if ph_bad:
-            msg += 'Fishtank PH level is unsafe:  %r\n'%monitor.ph
-            logger.warn("unsafe ph, will email")
-        if temp_bad:
-            msg += 'Fishtank temperature is unsafe:  %r\n'%monitor.temperature
-            logger.warn("unsafe temperature, will email")
-        if msg and time.time() - self.time_last_warned > config.send_warnings_interval:
-            self.time_last_warned = time.time()
+        now = time.time()
+        # accept the monitor itself as well as a snapshot of its reading
+        reading = getattr(monitor, 'reading', monitor)
+        if reading is not None:
+            for sensor in sorted(self.limits):
+                value = reading.get(sensor)
+                if value is not None:
+                    self._check(sensor, value, now)
+        entries, dropped = self.digest.take(now)
+        if entries:
+            alerts.record(conn, entries, now)
+            self.time_last_warned = now
             logger.info("setting time_last_warned to %r" %self.time_last_warned)
-            msg += "\nWarning emailed notifications will continue every %r hours until the readings fall within expected ranges."\
-                    %(config.send_warnings_interval/(60*60))
+            subject, msg = alerts.format_digest(entries, dropped)
+            msg += "\nWarning notifications will continue every %r hours until the readings fall within expected ranges."\
+                    %(self.digest.window/(60*60))
             if config.send_warnings_interval > 0:
-                logger.info("sending warning email")
-                msg = MIMEText(msg)
-                msg['Subject'] = 'Fishtank monitor warning'
-                msg['From'] = config.email_from_address
-                msg['To'] = config.email_to_address
-                self._send_email(msg)
+                logger.info("sending warning digest of %d alerts" %len(entries))
+                self._send(subject, msg, urgent=True)
 
 ## Send the user periodic informational reports (with graphs)
 #
-#  Determine how long it's been since we sent the user an informational
-#  report if one is due.  Include a graphic plotting ph and temperature
-#  values over time.
+#  Each instance reports on one period:  a day, week, month or year.  The daily
+#  report is sent every send_reports_interval seconds, the others once each
+#  time a new period begins.  Every report tabulates the summaries of the
+#  sub-periods making up its window (see report_layout), which are computed
+#  once and stored, so even the yearly report only combines twelve monthly
+#  summaries with the current month's.  The chart covers the same window,
+#  downsampled with a ::downsample::MinMaxDownsampler so that it has at most
+#  chart_points points per series however long the window, without losing any
+#  spikes, and read through the ::query_cache.  Gaps in the readings over the
+#  window (see ::gaps) are listed and break the chart's lines, and the
+#  percentiles of the readings and the share of them in the safe range are
+#  tabulated from the daily ::sketches.
 class NotifyInformationalReports(NotifierBase):
 
     time_last_informed = 0
     number_of_recent_measurements_to_include = 5
 
+    ## The most gaps in the readings listed in a report;  any earlier ones are
+    #  only counted
+    outages_listed = 10
+
+    ## The sub-period each report is tabulated by and how many of them it covers
+    report_layout = { 'day': ('hour', 24), 'week': ('day', 7), 'month': ('day', 30), 'year': ('month', 12) }
+
+    ## How each sub-period is labelled in reports
+    label_formats = { 'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'month': '%Y-%m' }
+
+    ## The number of points each charted series is reduced to
+    chart_points = 500
+
+    ## The adjective used in each report's subject and text
+    adjectives = { 'day': 'Daily', 'week': 'Weekly', 'month': 'Monthly', 'year': 'Yearly' }
+
+    ## The constructor
+    #  @param period the period reported on, one of the keys of report_layout
+    def __init__(self, period='day'):
+        if period not in self.report_layout:
+            raise ValueError('invalid report period:  %r' %period)
+        self.period = period
+
+    ## The name the notifier's stats are kept under, distinguishing periods
+    @property
+    def name(self):
+        return '%s(%s)' %(type(self).__name__, self.period)
+
+    ## Determine whether this report is due
+    #
+    #  @param now the current time
+    #  @return True, if the report should be sent
+    def _is_due(self, now):
+        if self.period == 'day':
+            return now - self.time_last_informed > config.send_reports_interval
+        return summaries.period_start(self.period, now) > self.time_last_informed
+
+    ## Get the summaries of each sub-period in the report's window
+    #
+    #  @param conn the database connection to use
+    #  @param now the current time
+    #  @return a list of ::summaries::Summary objects, oldest first, the last
+    #          covering the current, partial sub-period
+    def _history(self, conn, now):
+        child, count = self.report_layout[self.period]
+        start = summaries.period_start(child, now)
+        for i in range(count):
+            start = summaries.previous_start(child, start)
+        return summaries.children(conn, child, start, now, now)
+
+    ## Read and downsample the measurements to chart
+    #
+    #  The end is rounded up to the end of its sub-period, so that charting up
+    #  to the present reads the same range, and so the same cached result, for
+    #  as long as the sub-period lasts.
+    #
+    #  @param conn the database connection to use
+    #  @param start the start of the time range to chart
+    #  @param end the end of the time range to chart
+    #  @return a list of (label, [(time, value), ...]) series
+    def _chart_series(self, conn, start, end):
+        child = self.report_layout[self.period][0]
+        end = summaries.next_start(child, summaries.period_start(child, end - 1))
+        ph, temp = query_cache.range_series(conn, ['ph', 'temperature'], start, end, self.chart_points)
+        outages = gaps.find(conn, start, end)
+        return [('PH', self._interrupt(ph, outages)), ('Temperature', self._interrupt(temp, outages))]
+
+    ## Break a series at each gap in the readings, so it is not charted as a
+    #  line joining the readings either side
+    #
+    #  @param series a list of (time, value) tuples in time order
+    #  @param outages a list of (start, end) gaps in time order
+    #  @return the series with a (time, None) point within each gap
+    @staticmethod
+    def _interrupt(series, outages):
+        breaks = [((start + end) / 2, None) for start, end in outages]
+        return sorted(series + breaks, key=lambda point: point[0])
+
+    ## Tabulate the distribution of the readings over the report's window
+    #
+    #  Built from the daily ::sketches, so its cost does not grow with the
+    #  number of readings.
+    #
+    #  @param conn the database connection to use
+    #  @param start the start of the window
+    #  @param end the end of the window (exclusive)
+    #  @return the table as text, empty if there were no readings
+    def _distribution_text(self, conn, start, end):
+        txt = ''
+        for label, name in [('Temperature', 'temperature'), ('PH', 'ph')]:
+            sketch = sketches.combine(conn, name, start, end)
+            if sketch.seconds:
+                low, high = NotifyWarnings.limits[name]
+                txt += '%-16s  %5.2f %5.2f %5.2f   %5.1f%%\n' %(label, sketch.quantile(0.05), sketch.quantile(0.5),
+                                                             sketch.quantile(0.95),
+                                                             100 * sketch.fraction_between(low, high))
+        if txt:
+            txt = '\n%-16s  %5s %5s %5s   %s\n' %('', '5%', '50%', '95%', 'in range') + txt
+        return txt
+
+    ## Describe the gaps in the readings over the report's window
+    #
+    #  @param outages a list of (start, end) gaps in time order
+    #  @return the text, empty if there were none
+    def _outage_text(self, outages):
+        if not outages:
+            return ''
+        txt = '\nThere were no readings between:\n'
+        for start, end in outages[-self.outages_listed:]:
+            txt += '  %s and %s (%.1f hours)\n' %(time.strftime('%Y-%m-%d %H:%M', time.localtime(start)),
+                                                 time.strftime('%Y-%m-%d %H:%M', time.localtime(end)),
+                                                 (end - start) / (60.0*60))
+        if len(outages) > self.outages_listed:
+            txt += '  and %d earlier gaps\n' %(len(outages) - self.outages_listed)
+        return txt
+
+    ## The file the report's chart is rendered to, one per period as reports
+    #  may run concurrently
+    @property
+    def chart_filename(self):
+        return 'chart_%s.png' %self.period
+
+    ## Build the report's chart
+    #
+    #  @param pairs a list of (label, [(time, value), ...]) series to plot
+    #  @return the pygal chart, or None if there was nothing to chart
+    @staticmethod
+    def _chart(pairs):
+        time_values = sorted(t for label, series in pairs for t, v in series if v is not None)
+        if not time_values:
+            return None
+        import pygal
+        import pygal.style
+        style = pygal.style.Style(font_family='Arial')
+        chart = pygal.DateY(title='Fishtank PH and Temperature over Time', style=style, x_label_rotation=20,
+                            allow_interruptions=True)
+        timespan = time_values[-1] - time_values[0]
+        x_label_intervals = 10
+        x_label_span = timespan/x_label_intervals
+        x_labels = [ datetime.datetime.fromtimestamp(time_values[0] + i * x_label_span) for i in range(x_label_intervals) ]
+        for label, series in pairs:
+            chart.add(label, series)
+            logger.debug("%s:  %r" %(label, series))
+        chart.x_label_format = "%Y-%m-%d"
+        chart.x_labels = x_labels
+        return chart
+
+    ## Render the report's chart to a file
+    #
+    #  @param pairs a list of (label, [(time, value), ...]) series to plot
+    #  @param filename the PNG file to write
+    #  @return True, if there was anything to chart
+    @classmethod
+    def _render_chart(cls, pairs, filename='chart.png'):
+        chart = cls._chart(pairs)
+        if chart is None:
+            return False
+        chart.render_to_png(filename)
+        return True
+
+    ## Tabulate the summaries of the report's window
+    #
+    #  @param history the summaries of each sub-period
+    #  @return the table as text
+    def _summary_text(self, history):
+        overall = summaries.Summary.merge(history)
+        child_format = self.label_formats[self.report_layout[self.period][0]]
+        line = '%-16s  %5.1f %5.1f %5.1f   %4.2f %4.2f %4.2f\n'
+        txt = '\n%-16s  %-17s   %s\n' %('', 'Temperature', 'PH')
+        txt += '%-16s  %5s %5s %5s   %4s %4s %4s\n' %('', 'min', 'mean', 'max', 'min', 'mean', 'max')
+        for s in history + [overall]:
+            if s.count:
+                label = 'Overall' if s is overall else time.strftime(child_format, time.localtime(s.start))
+                txt += line %(label, s.temp_min, s.temp_mean, s.temp_max, s.ph_min, s.ph_mean, s.ph_max)
+        return txt
+
     def __call__(self, conn, monitor):
-        if time.time() - self.time_last_informed > config.send_reports_interval:
-            self.time_last_informed = time.time()
+        now = time.time()
+        if self._is_due(now):
+            self.time_last_informed = now
             logger.info("setting time_last_informed to %r" %self.time_last_informed)
             if config.send_reports_interval > 0:
-                logger.info("sending daily report (time_last_informed is %r)"%self.time_last_informed)
-                style = pygal.style.Style(font_family='Arial')
-                chart = pygal.DateY(title='Fishtank PH and Temperature over Time', style=style, x_label_rotation=20)
-                values = conn.execute('select ph, temp, time from measurements order by time desc limit 1000').fetchall()
-                ph_values = [ i[0] for i in values ]
-                temp_values = [ i[1] for i in values ]
-                time_values = [ i[2] for i in values ]
-                timespan = time_values[0] - time_values[-1]
-                x_label_intervals = 10
-                x_label_span = timespan/x_label_intervals
-                x_labels = [ datetime.datetime.fromtimestamp(time_values[0] + i * x_label_span) for i in range(x_label_intervals) ]
-                ph_pairs = list(zip(time_values, ph_values))
-                temp_pairs = list(zip(time_values, temp_values))
-                chart.add('PH', ph_pairs)
-                logger.debug("PH:  %r" %ph_pairs)
-                chart.add('Temperature', temp_pairs)
-                logger.debug("Temperature:  %r" %temp_pairs)
-                chart.x_label_format = "%Y-%m-%d"
-                chart.x_labels = x_labels
-                chart.render_to_png('chart.png')
-                msg = MIMEMultipart()
-                txt = 'Daily measurements from your fishtank monitor.\n\n\
-The most recent temperature measurments are:  %r\n\
+                adjective = self.adjectives[self.period]
+                logger.info("sending %s report (time_last_informed is %r)"%(adjective.lower(), self.time_last_informed))
+                history = self._history(conn, now)
+                charted = self._render_chart(self._chart_series(conn, history[0].start, now + 1), self.chart_filename)
+                txt = '%s measurements from your fishtank monitor.\n\n' %adjective
+                if self.period == 'day':
+                    values = query_cache.recent_measurements(conn, self.number_of_recent_measurements_to_include)
+                    txt += 'The most recent temperature measurments are:  %r\n\
 The most recent ph measurements are:  %r\n'\
-                       %(temp_values[:self.number_of_recent_measurements_to_include],\
-                         ph_values[:self.number_of_recent_measurements_to_include])
-                msg.attach(MIMEText(txt))
-                msg['Subject'] = 'Fishtank status'
-                msg['From'] = config.email_from_address
-                msg['To'] = config.email_to_address
-                with open('chart.png', 'rb') as f:
-                    msg.attach(MIMEImage(f.read(), name='chart.png', _subtype="png"))
-                self._send_email(msg)
-
-## Send the user reminder emails when their PH monitor is due for calibration
+                           %([ i[1] for i in values ], [ i[0] for i in values ])
+                txt += self._summary_text(history)
+                txt += self._distribution_text(conn, history[0].start, now + 1)
+                txt += self._outage_text(gaps.find(conn, history[0].start, now + 1))
+                attachments = []
+                if charted:
+                    with open(self.chart_filename, 'rb') as f:
+                        attachments.append(('chart.png', f.read()))
+                self._send('Fishtank status' if self.period == 'day' else 'Fishtank %s status' %adjective.lower(),
+                           txt, attachments)
+
+## Send the user reminders when their PH monitor is due for calibration
 class NotifyCalibration(NotifierBase):
 
     def __call__(self, conn, monitor):
@@ -160,15 +376,11 @@ class NotifyCalibration(NotifierBase):
                 logger.info("calibration noifications are enabled, writing last cal to db")
                 conn.execute('update settings set last_calibration=%r' %config.last_calibration)
                 conn.commit()
-                logger.info("it's time to calibrate, sending email")
+                logger.info("it's time to calibrate, sending reminder")
                 txt = 'The calibration period for the PH sensor has been exceeded.  Please calibrate \
 the PH sensor at your earliest convenience.  Failure to do so may result in inaccurate PH sensor \
 readings.'
-                msg = MIMEText(txt)
-                msg['Subject'] = 'Fishtank ph monitor calibration is due'
-                msg['From'] = config.email_from_address
-                msg['To'] = config.email_to_address
-                self._send_email(msg)
+                self._send('Fishtank ph monitor calibration is due', txt)
 
 ## Global list of notitification functors
 _notifiers = None
@@ -177,5 +389,7 @@ _notifiers = None
 def get_notifiers():
     global _notifiers
     if _notifiers is None:
-        _notifiers = [NotifyCalibration(), NotifyInformationalReports(), NotifyWarnings()]
+        _notifiers = [NotifyCalibration()]
+        _notifiers += [NotifyInformationalReports(period) for period in config.report_periods]
+        _notifiers += [NotifyWarnings()]
     return _notifiers
@@ -0,0 +1,175 @@
+## @package notifier_pool
+#  Concurrent execution of the notifiers
+#
+#  The notifiers run on a small pool of worker threads rather than one after
+#  another, so a slow report (rendering a chart and talking to the mail
+#  server) cannot hold up a warning.  Jobs are taken in priority order, lowest
+#  first, and some workers are reserved for jobs of critical_priority or below
+#  so that safety-critical notifiers never wait behind reports even when every
+#  other worker is busy.
+#
+#  Each job has a deadline.  A thread cannot be interrupted, so a job which
+#  misses its deadline is reported and left to finish;  until it does, further
+#  submissions of the same notifier are skipped rather than piling up behind
+#  it.  The latency of every notifier (from submission to completion, which
+#  includes any time spent queued) is kept for stats.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import time
+import heapq
+import itertools
+import threading
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## Jobs with a priority at or below this are safety-critical
+critical_priority = 0
+
+## One submission of a function to the pool
+class Job:
+
+    ## The constructor
+    #
+    #  @param name the name the job's stats are kept under
+    #  @param function the function to call
+    #  @param args the arguments to call it with
+    #  @param priority the job's priority, lowest first
+    #  @param timeout seconds from submission by which the job should be done
+    def __init__(self, name, function, args, priority, timeout):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.priority = priority
+        self.submitted = time.time()
+        self.deadline = self.submitted + timeout
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.done = threading.Event()
+
+## A pool of worker threads running jobs in priority order
+class NotifierPool:
+
+    ## The constructor starts the workers
+    #
+    #  @param workers the number of workers running jobs of any priority
+    #  @param critical_workers the number of workers reserved for critical jobs
+    def __init__(self, workers=2, critical_workers=1):
+        self._heap = []
+        self._order = itertools.count()
+        self._available = threading.Condition()
+        self._in_flight = {}
+        self._stats = {}
+        self._stopped = False
+        self._threads = []
+        for i in range(workers + critical_workers):
+            thread = threading.Thread(target=self._work, args=(i < critical_workers,),
+                                      name='notifier-%d' %i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    ## Submit a job
+    #
+    #  @param name the name the job's stats are kept under
+    #  @param function the function to call
+    #  @param args the arguments to call it with
+    #  @param priority the job's priority, lowest first
+    #  @param timeout seconds from now by which the job should be done
+    #  @return the Job, or None if the last job of this name is still running
+    def submit(self, name, function, args=(), priority=10, timeout=60):
+        with self._available:
+            if name in self._in_flight:
+                logger.warning("notifier %s is still running, skipping it" %name)
+                self._stat(name)['skipped'] += 1
+                return None
+            job = Job(name, function, args, priority, timeout)
+            self._in_flight[name] = job
+            heapq.heappush(self._heap, (priority, next(self._order), job))
+            self._available.notify_all()
+        return job
+
+    ## Wait for jobs to finish, each until its deadline
+    #
+    #  @param jobs the jobs to wait for
+    #  @return the jobs which missed their deadlines
+    def wait(self, jobs):
+        late = []
+        for job in sorted(jobs, key=lambda j: j.deadline):
+            if not job.done.wait(max(0, job.deadline - time.time())):
+                logger.error("notifier %s missed its deadline" %job.name)
+                with self._available:
+                    self._stat(job.name)['timeouts'] += 1
+                late.append(job)
+        return late
+
+    ## Get the latency stats of every notifier
+    #
+    #  @return a dict mapping each name to a dict of runs, failures, timeouts,
+    #          skipped, and the last, max and mean latency and last queued time
+    #          in seconds
+    def stats(self):
+        with self._available:
+            result = {}
+            for name, s in self._stats.items():
+                result[name] = dict(s)
+                result[name]['mean_latency'] = s['total_latency'] / s['runs'] if s['runs'] else None
+                del result[name]['total_latency']
+            return result
+
+    ## Stop the workers once they finish their current jobs
+    def shutdown(self):
+        with self._available:
+            self._stopped = True
+            self._available.notify_all()
+
+    ## Get the stats record for a name, with the lock held
+    def _stat(self, name):
+        if name not in self._stats:
+            self._stats[name] = { 'runs': 0, 'failures': 0, 'timeouts': 0, 'skipped': 0, 'last_latency': None,
+                                  'max_latency': None, 'total_latency': 0.0, 'last_queued': None }
+        return self._stats[name]
+
+    ## Take the next job a worker may run, waiting for one
+    #
+    #  @param critical_only True, if the worker is reserved for critical jobs
+    #  @return the Job, or None if the pool is stopped
+    def _next_job(self, critical_only):
+        with self._available:
+            while not self._stopped:
+                if self._heap and (not critical_only or self._heap[0][0] <= critical_priority):
+                    return heapq.heappop(self._heap)[2]
+                self._available.wait()
+        return None
+
+    ## The main loop of each worker
+    #
+    #  @param critical_only True, if the worker is reserved for critical jobs
+    def _work(self, critical_only):
+        while True:
+            job = self._next_job(critical_only)
+            if job is None:
+                return
+            job.started = time.time()
+            try:
+                job.function(*job.args)
+            except Exception as e:
+                job.error = e
+                logger.exception("exception encountered in notifier %s:  %r" %(job.name, e))
+            job.finished = time.time()
+            latency = job.finished - job.submitted
+            with self._available:
+                s = self._stat(job.name)
+                s['runs'] += 1
+                if job.error is not None:
+                    s['failures'] += 1
+                s['last_latency'] = latency
+                s['max_latency'] = latency if s['max_latency'] is None else max(s['max_latency'], latency)
+                s['total_latency'] += latency
+                s['last_queued'] = job.started - job.submitted
+                del self._in_flight[job.name]
+            job.done.set()
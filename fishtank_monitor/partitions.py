@@ -0,0 +1,295 @@
+## @package partitions
+#  Archiving of old readings into per-tank, per-month database files
+#
+#  Left alone, the database grows forever, and vacuuming it, backing it up or
+#  reporting over it all touch the whole history.  When
+#  config.partition_after_months is set, archive moves each calendar month of
+#  readings (in local time) out of the database once that many whole months
+#  have followed it, into a file of its own per tank:
+#
+#      <partition directory>/tank<tank>/<YYYY-MM>.db
+#
+#  holding a readings table just like the one in ::sensors.  The files are
+#  made read-only once written, so a backup only ever needs to copy each one
+#  once, and the database itself stays a few months long.
+#
+#  Queries over readings which may be archived go through query, the router:
+#  it runs the query against just the partitions covering the time range
+#  asked about, oldest first, and then against the database, so a report on
+#  last week opens no partitions at all.  A query ordering its rows by time
+#  goes through ordered_query instead, which merges the rows of each place
+#  into one ordered run.  The sensor registry, the stored ::summaries and the
+#  ::gaps index all stay in the database.
+#
+#  Readings added to an archived month later on (by a ::backfill, say) are
+#  stored in the database like any other and moved into the month's partition
+#  the next time archive runs, so until then the month's readings are split
+#  between the two.  Readings rewritten in place (by a ::calibration
+#  recomputing the ph) are rewritten wherever they are, by rewrite, which is
+#  the only time a partition is written after it is archived.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import re
+import stat
+import time
+import heapq
+import sqlite3
+import datetime
+import config
+import sensors
+from log import get_logger
+
+logger = get_logger(__name__)
+
+_partition_name = re.compile(r'^(\d{4})-(\d{2})\.db$')
+
+## Find the start of the month after the one starting at start
+#
+#  @param start the start of a month in seconds since the epoch
+#  @return the start of the next month
+def next_month(start):
+    d = datetime.datetime.fromtimestamp(start)
+    d = d.replace(year=d.year + d.month//12, month=d.month % 12 + 1)
+    return int(time.mktime(d.timetuple()))
+
+## Find the start of the month containing a time
+#
+#  @param t the time in seconds since the epoch
+#  @return the start of the month in seconds since the epoch
+def month_start(t):
+    d = datetime.datetime.fromtimestamp(t).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(time.mktime(d.timetuple()))
+
+## The file holding one month of one tank's readings
+#
+#  @param tank the tank
+#  @param start the start of the month
+#  @param directory the partition directory, defaults to the configured one
+#  @return the path of the file
+def partition_file(tank, start, directory=None):
+    directory = config.partition_directory if directory is None else directory
+    return os.path.join(directory, 'tank%d' %tank, time.strftime('%Y-%m.db', time.localtime(start)))
+
+## List the partitions of a tank covering a time range
+#
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank
+#  @param directory the partition directory, defaults to the configured one
+#  @return a list of (month start, path) tuples, oldest first
+def covering(start, end, tank=sensors.local_tank, directory=None):
+    directory = os.path.join(config.partition_directory if directory is None else directory, 'tank%d' %tank)
+    if not os.path.isdir(directory):
+        return []
+    result = []
+    for name in os.listdir(directory):
+        match = _partition_name.match(name)
+        if match:
+            first = int(time.mktime((int(match.group(1)), int(match.group(2)), 1, 0, 0, 0, 0, 0, -1)))
+            if first < end and next_month(first) > start:
+                result.append((first, os.path.join(directory, name)))
+    return sorted(result)
+
+## Run a query over the readings of a time range, wherever they are stored
+#
+#  The query is run as is against each partition covering the range and then
+#  against the database, so it should only refer to the readings table and
+#  should itself restrict the rows to the range.
+#
+#  @param conn the database connection to use
+#  @param sql the query
+#  @param params the query's parameters
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank
+#  @param database False to only query the partitions
+#  @return a generator of the rows of each partition, oldest first, then
+#          those of the database
+def query(conn, sql, params, start, end, tank=sensors.local_tank, database=True):
+    for first, path in covering(start, end, tank):
+        partition = sqlite3.connect(path)
+        try:
+            rows = partition.execute(sql, params).fetchall()
+        finally:
+            partition.close()
+        for row in rows:
+            yield row
+    if database:
+        for row in conn.execute(sql, params):
+            yield row
+
+## Key each row of a run by its time and its place in the merge
+#
+#  @param rows an iterable of rows, the first column the time
+#  @param i the run's place among the runs
+#  @return a generator of (key, row) tuples
+def _keyed(rows, i):
+    j = 0
+    for row in rows:
+        yield (row[0], i, j), row
+        j += 1
+
+## Run a query ordering its rows by time over a time range, wherever the
+#  readings are stored
+#
+#  As query, but the rows of each partition and of the database are merged
+#  into one run ordered by their first column, which should be the time the
+#  query orders by.  The runs are merged straight from their cursors, so
+#  however long the range only a row of each is held at a time;  the
+#  partitions stay open until the generator is exhausted or closed.
+#
+#  @param conn the database connection to use
+#  @param sql the query
+#  @param params the query's parameters
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank
+#  @return a generator of the rows in time order
+def ordered_query(conn, sql, params, start, end, tank=sensors.local_tank):
+    opened = []
+    try:
+        for first, path in covering(start, end, tank):
+            opened.append(sqlite3.connect(path))
+        runs = [partition.execute(sql, params) for partition in opened] + [conn.execute(sql, params)]
+        if len(runs) == 1:
+            for row in runs[0]:
+                yield row
+        else:
+            # each row is keyed by its time and its place, as rows may not compare
+            for key, row in heapq.merge(*[_keyed(run, i) for i, run in enumerate(runs)]):
+                yield row
+    finally:
+        for partition in opened:
+            partition.close()
+
+## Read the readings of one sensor over a time range as they are needed,
+#  wherever they are stored
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank the readings are from
+#  @return a generator of (time, value) tuples, oldest first
+def stream(conn, name, start, end, tank=sensors.local_tank):
+    row = conn.execute('select id from sensors where name=?', (name,)).fetchone()
+    if row is None:
+        return iter([])
+    return ordered_query(conn, 'select time, value from readings where tank=? and sensor=? and time >= ? '
+                               'and time < ? order by time', (tank, row[0], start, end), start, end, tank)
+
+## Read the readings of one sensor over a time range, wherever they are stored
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank the readings are from
+#  @return a list of (time, value) tuples, oldest first
+def series(conn, name, start, end, tank=sensors.local_tank):
+    return list(stream(conn, name, start, end, tank))
+
+## Write readings into a partition, creating it if need be, and leave it
+#  read-only
+#
+#  @param path the partition's file
+#  @param rows a list of (tank, sensor, time, value) readings
+def _write(path, rows):
+    if os.path.exists(path):
+        os.chmod(path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+    elif not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    partition = sqlite3.connect(path)
+    try:
+        partition.execute('create table if not exists readings (tank INT NOT NULL, sensor INT NOT NULL, '
+                          'time INT NOT NULL, value REAL, primary key (tank, sensor, time)) without rowid')
+        partition.executemany('insert or replace into readings values (?, ?, ?, ?)', rows)
+        partition.commit()
+    finally:
+        partition.close()
+    os.chmod(path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+## Rewrite readings in place, wherever they are stored
+#
+#  The query is run against each of the tank's partitions and then the
+#  database, as by query, and the readings update makes of each place's rows
+#  are written back to the same place, so a month split between a partition
+#  and the database stays split the same way.
+#
+#  @param conn the database connection to use
+#  @param sql the query reading the rows to rewrite
+#  @param params the query's parameters
+#  @param update a function of a list of the rows of one place, returning a
+#         list of (tank, sensor, time, value) readings to write
+#  @param tank the tank
+#  @return the number of rows read
+def rewrite(conn, sql, params, update, tank=sensors.local_tank):
+    count = 0
+    for first, path in covering(float('-inf'), float('inf'), tank):
+        partition = sqlite3.connect(path)
+        try:
+            rows = partition.execute(sql, params).fetchall()
+        finally:
+            partition.close()
+        if rows:
+            _write(path, update(rows))
+            count += len(rows)
+    rows = conn.execute(sql, params).fetchall()
+    with conn:
+        if rows:
+            conn.executemany('insert or replace into readings values (?, ?, ?, ?)', update(rows))
+            count += len(rows)
+        if count:
+            sensors.changed(conn)
+    return count
+
+## Move one month of one tank's readings into its partition
+#
+#  @param conn the database connection to use
+#  @param tank the tank
+#  @param start the start of the month
+#  @return the number of readings moved
+def _archive_month(conn, tank, start):
+    end = next_month(start)
+    rows = conn.execute('select tank, sensor, time, value from readings where tank=? and time >= ? and time < ?',
+                        (tank, start, end)).fetchall()
+    if not rows:
+        return 0
+    path = partition_file(tank, start)
+    _write(path, rows)
+    with conn:
+        conn.execute('delete from readings where tank=? and time >= ? and time < ?', (tank, start, end))
+        sensors.changed(conn)
+    logger.info("archived %d readings of tank %d to %s" %(len(rows), tank, path))
+    return len(rows)
+
+## Archive every month of readings old enough to be partitioned
+#
+#  Does nothing unless config.partition_after_months is set.
+#
+#  @param conn the database connection to use
+#  @param now the current time, defaults to time.time()
+#  @return the number of readings archived
+def archive(conn, now=None):
+    if config.partition_after_months <= 0:
+        return 0
+    cutoff = month_start(time.time() if now is None else now)
+    for i in range(config.partition_after_months):
+        cutoff = month_start(cutoff - 1)
+    archived = 0
+    for tank, first in conn.execute('select tank, min(time) from readings where time < ? group by tank',
+                                    (cutoff,)).fetchall():
+        start = month_start(first)
+        while start < cutoff:
+            archived += _archive_month(conn, tank, start)
+            start = next_month(start)
+    if archived:
+        try:
+            conn.execute('vacuum')
+        except sqlite3.OperationalError as e:
+            logger.warning("could not vacuum the database after archiving:  %r" %e)
+    return archived
@@ -0,0 +1,449 @@
+## @package processes
+#  Optional mode running the fishtank monitor as several cooperating processes
+#
+#  In the default mode every component shares one Python process and so one
+#  GIL, meaning a slow chart render or SMTP exchange can delay serial reads and
+#  light switching.  With multiprocess enabled in the config file the work is
+#  split across three child processes, leaving the parent free to supervise:
+#
+#  Process       | Runs
+#  ------------- | ------------------------------------------------------------
+#  ingestion     | the serial monitor, the light scheduler and the writer
+#  storage       | the reading log and the sqlite writes of readings and calibrations
+#  notification  | the notifiers, including report rendering and email, pushes to any ::collector and builds of any ::status_site, with their own sqlite writes
+#
+#  The processes hand readings to each other through shared memory:  the
+#  writer puts each measurement, with every sensor's reading, on a ReadingQueue consumed by the storage
+#  process, and the latest reading is published in a SharedReading the
+#  notification process reads.  Both live in memory owned by the parent, so
+#  neither is lost when a child is restarted.  Each child is a
+#  ::supervisor::Component of the parent's Supervisor, heartbeating through a
+#  shared value, and so is restarted on its own if it dies or hangs.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import errno
+import multiprocessing
+import time
+import config
+import supervisor
+import partitions
+import sensors
+import forecast
+import collector
+import status_site
+import fishtank_monitor as ftm
+from serial_monitor import Reading
+from notifications import get_notifiers
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## Seconds between publications of the latest reading by the ingestion process
+publish_interval = 5
+
+## Seconds without a heartbeat after which a child process is restarted
+process_heartbeat_timeout = 60
+
+## The most sensors one reading passed between processes can hold
+sensors_per_reading = 8
+
+## The most bytes of a sensor's name, encoded as UTF-8, passed between processes
+name_size = 32
+
+## Whether a process is still running
+#
+#  @param pid the process id
+#  @return True, if it is
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+## Fixed-size slots in shared memory, each holding one reading
+#
+#  Each slot holds the time of the reading and up to sensors_per_reading
+#  (sensor name, value) pairs, the names in a character array alongside.  An
+#  empty value is held as NaN.  The slots have no lock of their own.
+class ReadingSlots:
+
+    ## The constructor allocates the shared memory
+    #
+    #  @param count the number of slots
+    def __init__(self, count):
+        self._values = multiprocessing.Array('d', count * (1 + sensors_per_reading), lock=False)
+        self._names = multiprocessing.Array('c', count * sensors_per_reading * name_size, lock=False)
+
+    ## Write a reading into a slot
+    #
+    #  @param i the slot
+    #  @param reading a tuple of (time, a sequence of (sensor name, value) pairs)
+    def write(self, i, reading):
+        when, pairs = reading
+        if len(pairs) > sensors_per_reading:
+            raise ValueError('too many sensors in one reading:  %d' %len(pairs))
+        names = [name.encode('utf-8') for name, value in pairs]
+        for name in names:
+            if not name or len(name) > name_size:
+                raise ValueError('sensor name cannot be passed between processes:  %r' %name)
+        values = [when] + [float('nan') if value is None else value for name, value in pairs]
+        offset = i * (1 + sensors_per_reading)
+        self._values[offset:offset + len(values)] = values
+        offset = i * sensors_per_reading * name_size
+        names = b''.join(name.ljust(name_size, b'\0') for name in names)
+        self._names[offset:offset + sensors_per_reading * name_size] = names.ljust(sensors_per_reading * name_size, b'\0')
+
+    ## Read the reading in a slot
+    #
+    #  @param i the slot
+    #  @return a tuple of (time, a tuple of (sensor name, value) pairs)
+    def read(self, i):
+        offset = i * (1 + sensors_per_reading)
+        values = self._values[offset:offset + 1 + sensors_per_reading]
+        offset = i * sensors_per_reading * name_size
+        names = self._names[offset:offset + sensors_per_reading * name_size]
+        pairs = []
+        for j in range(sensors_per_reading):
+            name = names[j * name_size:(j + 1) * name_size].rstrip(b'\0')
+            if not name:
+                break
+            value = values[j + 1]
+            pairs.append((name.decode('utf-8'), None if value != value else value))
+        return values[0], tuple(pairs)
+
+## A fixed-capacity queue of readings in shared memory
+#
+#  A ring buffer of ReadingSlots, each holding the time of a reading and its
+#  (sensor name, value) pairs, usable from any process started after it was
+#  created.  put blocks while the queue is full and get while it is empty,
+#  each for at most the given timeout.
+#
+#  The head and tail are guarded by a lock held only for a few instructions,
+#  and the id of the process holding it is kept alongside.  A process killed
+#  while holding it, as a hung child is by its restart, would leave it held
+#  for good, so a process kept waiting more than lock_timeout checks whether
+#  the holder is still running, and takes the lock over only if it is not.
+#  A live holder is always waited for, however long it takes.
+class ReadingQueue:
+
+    ## Seconds between checks on the process holding the lock
+    lock_timeout = 5
+
+    ## The constructor allocates the shared memory
+    #
+    #  @param capacity the number of readings the queue can hold
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._slots = ReadingSlots(capacity)
+        self._head = multiprocessing.Value('l', 0, lock=False)
+        self._tail = multiprocessing.Value('l', 0, lock=False)
+        self._lock = multiprocessing.Lock()
+        self._owner = multiprocessing.Value('l', 0, lock=False)
+        self._takeover = multiprocessing.Lock()
+        self._free = multiprocessing.Semaphore(capacity)
+        self._used = multiprocessing.Semaphore(0)
+
+    ## Take the lock guarding the head and tail
+    #
+    #  A multiprocessing lock can be released by any process, so one abandoned
+    #  by a dead process is simply left held and released by the caller in its
+    #  place.  Only one waiter can take it over from the same dead holder.
+    def _acquire(self):
+        while not self._lock.acquire(True, self.lock_timeout):
+            owner = self._owner.value
+            if not owner or _running(owner):
+                continue
+            with self._takeover:
+                if self._owner.value != owner:
+                    continue
+                logger.error("reading queue lock abandoned by dead process %d, taking it over" %owner)
+                self._owner.value = os.getpid()
+                return
+        self._owner.value = os.getpid()
+
+    ## Release the lock guarding the head and tail
+    def _release(self):
+        self._owner.value = 0
+        self._lock.release()
+
+    ## Add a reading to the queue
+    #
+    #  @param reading a tuple of (time, a sequence of (sensor name, value)
+    #         pairs), within the limits of ReadingSlots
+    #  @param timeout seconds to wait for space, or None to wait forever
+    #  @return True, if the reading was queued
+    def put(self, reading, timeout=None):
+        if not self._free.acquire(True, timeout):
+            return False
+        self._acquire()
+        try:
+            self._slots.write(self._tail.value, reading)
+            self._tail.value = (self._tail.value + 1) % self.capacity
+        except:
+            self._free.release()
+            raise
+        finally:
+            self._release()
+        self._used.release()
+        return True
+
+    ## Remove the oldest reading from the queue
+    #
+    #  @param timeout seconds to wait for a reading, or None to wait forever
+    #  @return a tuple of (time, a tuple of (sensor name, value) pairs), or
+    #          None if the timeout expired
+    def get(self, timeout=None):
+        if not self._used.acquire(True, timeout):
+            return None
+        self._acquire()
+        try:
+            reading = self._slots.read(self._head.value)
+            self._head.value = (self._head.value + 1) % self.capacity
+        finally:
+            self._release()
+        self._free.release()
+        return reading
+
+## The latest reading, shared between processes
+#
+#  Presents the same reading attribute as the ::serial_monitor::SerialMonitor
+#  so that it can be handed to the notifiers, with every sensor the reading
+#  holds.  The reading is written and read under one lock, so it is never
+#  torn.
+class SharedReading:
+
+    ## The constructor allocates the shared memory
+    def __init__(self):
+        self._slots = ReadingSlots(1)
+        self._seq = multiprocessing.Value('l', 0, lock=False)
+        self._lock = multiprocessing.Lock()
+
+    ## Publish a new reading
+    #
+    #  @param reading the ::serial_monitor::Reading to publish
+    def publish(self, reading):
+        with self._lock:
+            self._slots.write(0, (reading.time, reading.values))
+            self._seq.value = reading.seq
+
+    ## The latest ::serial_monitor::Reading, or None if none has been published
+    @property
+    def reading(self):
+        with self._lock:
+            (t, values), seq = self._slots.read(0), self._seq.value
+        if not t:
+            return None
+        return Reading(seq, t, values)
+
+    ## The time of the latest reading, or 0 if none has been published
+    @property
+    def time(self):
+        with self._lock:
+            return self._slots.read(0)[0]
+
+    ## The latest temperature reading, or None if none has been published
+    @property
+    def temperature(self):
+        reading = self.reading
+        return reading.temperature if reading else None
+
+    ## The latest ph reading, or None if none has been published
+    @property
+    def ph(self):
+        reading = self.reading
+        return reading.ph if reading else None
+
+## A supervised child process
+#
+#  Adapts a multiprocessing.Process to the interface the Supervisor expects
+#  of a component.  The child's main function is passed a shared heartbeat
+#  value which it must keep updating.
+class ChildProcess:
+
+    ## The constructor starts the child process
+    #
+    #  @param name the name of the process
+    #  @param target the child's main function, called as target(heartbeat, *args)
+    #  @param args further arguments to the main function
+    def __init__(self, name, target, args=()):
+        self.heartbeat = multiprocessing.Value('d', time.time())
+        self.process = multiprocessing.Process(name=name, target=target, args=(self.heartbeat,) + tuple(args))
+        self.process.daemon = True
+        self.process.start()
+        logger.info("started %s process %r" %(name, self.process.pid))
+
+    ## The time of the child's last heartbeat
+    @property
+    def last_heartbeat(self):
+        return self.heartbeat.value
+
+    ## Determine whether the child process is still running
+    #
+    #  @return True, if it is
+    def is_alive(self):
+        return self.process.is_alive()
+
+    ## Stop the child process
+    def shutdown(self):
+        self.process.terminate()
+        self.process.join(5)
+
+## Run a supervisor in a child process, heartbeating to the parent
+#
+#  @param sup the Supervisor to run
+#  @param heartbeat the shared heartbeat value
+def _run_supervised(sup, heartbeat):
+    while True:
+        heartbeat.value = time.time()
+        sup.check()
+        time.sleep(sup.check_interval)
+
+## Main function of the ingestion process
+#
+#  Runs the serial monitor and light scheduler, publishes the latest reading
+#  and queues a measurement for storage every measurement interval.
+#
+#  @param heartbeat the shared heartbeat value
+#  @param queue the ReadingQueue to the storage process
+#  @param latest the SharedReading to publish to
+def ingestion_main(heartbeat, queue, latest):
+    def publish():
+        monitor = sup['serial'].instance
+        reading = monitor.reading if monitor is not None else None
+        if reading is not None and reading.temperature is not None and reading.ph is not None:
+            latest.publish(reading)
+
+    def write():
+        monitor = ftm.reading_monitor(sup)
+        if monitor is not None:
+            reading = monitor.reading
+            logger.info("queueing measurements ph is %r, temperature is %r" %(reading.ph, reading.temperature))
+            if not queue.put(ftm.sensor_readings(reading, monitor), ftm.first_reading_timeout):
+                logger.error("reading queue is full, dropping measurement")
+
+    sup = supervisor.Supervisor([
+        ftm.serial_component(),
+        supervisor.Component('scheduler', ftm.start_scheduler, 60),
+        supervisor.Component('publisher',
+                             lambda: ftm.start_task('publisher', publish, publish_interval),
+                             6*publish_interval),
+        supervisor.Component('writer',
+                             lambda: ftm.start_task('writer', write),
+                             2*ftm.measurement_interval + 2*ftm.first_reading_timeout),
+    ])
+    _run_supervised(sup, heartbeat)
+
+## Main function of the storage process
+#
+#  Appends queued readings to the reading log and applies the log to the
+#  database, recording any change to the configured calibration every
+#  measurement interval.  Any failure ends the process, to be restarted by the parent,
+#  which replays the reading log on the way back up.
+#
+#  @param heartbeat the shared heartbeat value
+#  @param queue the ReadingQueue from the ingestion process
+#  @param db_filename the database file to write to
+#  @param log_directory the reading log directory
+def storage_main(heartbeat, queue, db_filename, log_directory):
+    conn = ftm.open_database(db_filename)
+    readings = ftm.open_reading_log(log_directory)
+    readings.replay(conn)
+    last_applied = last_configured = time.time()
+    while True:
+        heartbeat.value = time.time()
+        if time.time() - last_configured > ftm.measurement_interval:
+            last_configured = time.time()
+            config.read_config()
+            ftm.update_calibration(conn)
+            partitions.archive(conn)
+        reading = queue.get(1)
+        if reading is not None:
+            readings.append(reading)
+        if time.time() - last_applied > ftm.apply_interval:
+            last_applied = time.time()
+            if readings.apply(conn):
+                readings.compact()
+
+## Main function of the notification process
+#
+#  Adds the latest reading published by the ingestion process to the shared
+#  ::forecast::TrendForecaster every measurement interval, as the writer does
+#  in the single process mode, and runs the notifiers every measurement
+#  interval against it, pushes the readings to any configured
+#  ::collector every push interval and builds any configured ::status_site
+#  every site interval.
+#
+#  @param heartbeat the shared heartbeat value
+#  @param latest the SharedReading published by the ingestion process
+#  @param db_filename the database file to read from
+def notification_main(heartbeat, latest, db_filename):
+    ftm.database_filename = db_filename
+    ftm.conn = ftm.open_database()
+    notifiers = get_notifiers()
+    forecaster = forecast.get_forecaster()
+    last_notified = last_pushed = last_built = last_forecast = 0
+    while True:
+        heartbeat.value = time.time()
+        reading = latest.reading
+        if reading is not None and reading.time - last_forecast >= ftm.measurement_interval:
+            last_forecast = reading.time
+            forecaster.add_reading(sensors.local_tank, reading)
+        if latest.time and time.time() - last_notified > ftm.measurement_interval:
+            last_notified = time.time()
+            config.read_config()
+            ftm.run_notifiers(latest, notifiers)
+        if time.time() - last_pushed > config.push_interval:
+            last_pushed = time.time()
+            collector.push(ftm.conn)
+        if time.time() - last_built > config.site_interval:
+            last_built = time.time()
+            status_site.build(ftm.conn)
+        time.sleep(1)
+
+## Build the supervisor owning the child processes
+#
+#  @param db_filename the database file to use
+#  @param log_directory the reading log directory
+#  @return the Supervisor
+def build_supervisor(db_filename, log_directory):
+    queue = ReadingQueue()
+    latest = SharedReading()
+    return supervisor.Supervisor([
+        supervisor.Component('ingestion',
+                             lambda: ChildProcess('ingestion', ingestion_main, (queue, latest)),
+                             process_heartbeat_timeout),
+        supervisor.Component('storage',
+                             lambda: ChildProcess('storage', storage_main, (queue, db_filename, log_directory)),
+                             process_heartbeat_timeout),
+        supervisor.Component('notification',
+                             lambda: ChildProcess('notification', notification_main, (latest, db_filename)),
+                             process_heartbeat_timeout),
+    ])
+
+## The multiprocess counterpart of ::fishtank_monitor::main_loop
+#
+#  The database and reading log opened by the bootstrap are closed, leaving
+#  the reading log to the storage process, then the child processes are
+#  started and supervised forever.  Both the storage process, writing the
+#  readings and calibrations, and the notification process, writing the
+#  summaries, alerts, settings, site pages and sketches, write to the
+#  database, each through a connection of its own from
+#  ::fishtank_monitor::connect that waits up to
+#  ::fishtank_monitor::database_timeout for the other's write to finish.
+#
+#  @param conn the database connection opened by the bootstrap
+#  @param readings the reading log opened by the bootstrap
+#  @param db_filename the database file to use
+#  @param log_directory the reading log directory
+def main_loop(conn, readings, db_filename=None, log_directory=None):
+    readings.close()
+    conn.close()
+    logger.debug("starting process supervisor")
+    sup = build_supervisor(db_filename or ftm.database_filename,
+                           log_directory or ftm.reading_log_directory)
+    sup.run()
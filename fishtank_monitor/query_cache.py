@@ -0,0 +1,162 @@
+## @package query_cache
+#  A cache of range-query results, invalidated by writes to the store
+#
+#  Reports (and anything else charting or tabulating the history) re-run the
+#  same range queries over and over while, most of the time, no new data has
+#  arrived.  The QueryCache keeps the results of recent queries, keyed by
+#  (sensors, range, resolution), in a bounded least-recently-used map.
+#
+#  Each entry remembers the store's write watermark when it was computed and
+#  is only served while the watermark is unchanged.  The watermark is the
+#  ::sensors::version of the readings, bumped by every write to them from any
+#  connection or process (the ingestion process, a backfill, a recalibration)
+#  in the same transaction, so a result is never served once the readings
+#  may have changed.  Writes to other tables (summaries, alerts, the status
+#  site's pages) leave it alone.  It is a single row, so checking an entry is
+#  cheap.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import weakref
+import threading
+import collections
+import downsample
+import sensors
+import partitions
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## Read the store's write watermark
+#
+#  @param conn the database connection to use
+#  @return a value which changes whenever the readings are written
+def watermark(conn):
+    return sensors.version(conn)
+
+## A bounded LRU cache of query results for one database connection
+class QueryCache:
+
+    ## The constructor
+    #
+    #  @param conn the database connection queries are run on
+    #  @param max_entries the most results held;  the least recently used is
+    #         evicted to make room
+    def __init__(self, conn, max_entries=64):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    ## Get a result, computing it on a miss
+    #
+    #  @param key the key identifying the query, e.g. (sensors, start, end,
+    #         resolution)
+    #  @param compute a function of the connection computing the result
+    #  @return the result
+    def get(self, key, compute):
+        mark = watermark(self.conn)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == mark:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+                self.invalidations += 1
+            self.misses += 1
+        result = compute(self.conn)
+        # a write during the query may or may not be reflected in the result
+        if watermark(self.conn) == mark:
+            with self._lock:
+                self._entries[key] = (mark, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return result
+
+    ## Drop every entry
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    ## Get the cache's counters
+    #
+    #  @return a dict of hits, misses, evictions, invalidations and entries
+    def stats(self):
+        with self._lock:
+            return { 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                     'invalidations': self.invalidations, 'entries': len(self._entries) }
+
+## The calling thread's cache, created on first use by get_cache
+_local = threading.local()
+
+## Every thread's cache, for stats
+_caches = weakref.WeakSet()
+
+## Lazy instantiator for the cache of a connection
+#
+#  Each thread keeps the cache of one connection, its own;  asking for
+#  another's replaces it.
+#
+#  @param conn the database connection
+#  @return the QueryCache
+def get_cache(conn):
+    cache = getattr(_local, 'cache', None)
+    if cache is None or cache.conn is not conn:
+        cache = _local.cache = QueryCache(conn)
+        _caches.add(cache)
+    return cache
+
+## Get the counters of every thread's cache, summed
+#
+#  @return a dict of hits, misses, evictions, invalidations and entries
+def stats():
+    total = { 'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'entries': 0 }
+    for cache in list(_caches):
+        for name, count in cache.stats().items():
+            total[name] += count
+    return total
+
+## Read the readings of sensors over a time range, through the cache
+#
+#  @param conn the database connection to use
+#  @param names the names of the sensors
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param resolution the point budget of each series (see
+#         ::downsample::MinMaxDownsampler), or None for every reading
+#  @param tank the tank the readings are from
+#  @return a list holding a list of (time, value) tuples per sensor
+def range_series(conn, names, start, end, resolution=None, tank=sensors.local_tank):
+    def compute(conn):
+        result = []
+        for name in names:
+            if resolution is None:
+                result.append(partitions.series(conn, name, start, end, tank))
+                continue
+            # the readings are streamed into the sampler rather than loaded
+            sampler = downsample.MinMaxDownsampler(start, end, resolution)
+            for t, v in partitions.stream(conn, name, start, end, tank):
+                sampler.add(t, v)
+            result.append(sampler.points())
+        return result
+    return get_cache(conn).get((tuple(names), tank, start, end, resolution), compute)
+
+## Read the most recent measurements, through the cache
+#
+#  @param conn the database connection to use
+#  @param count the number of measurements
+#  @return a list of (ph, temp) tuples, newest first
+def recent_measurements(conn, count):
+    def compute(conn):
+        return conn.execute('select ph, temp from measurements order by time desc limit ?', (count,)).fetchall()
+    return get_cache(conn).get((('ph', 'temperature'), sensors.local_tank, None, None, count), compute)
@@ -0,0 +1,479 @@
+## @package reading_log
+#  Durable append-only log of readings awaiting storage in the database
+#
+#  Readings are appended to the log before they go anywhere near sqlite, so a
+#  locked database, a full disk or a crash mid-transaction cannot lose them.
+#  The log is a directory of segment files, each holding binary records of one
+#  reading of every sensor:
+#
+#  Field  | Format | Meaning
+#  ------ | ------ | --------------------------------------------------
+#  length | uint16 | the size in bytes of the fields up to the CRC
+#  seq    | uint64 | sequence number, increasing across all segments
+#  time   | double | the time of the reading in seconds since the epoch
+#  count  | uint8  | the number of sensors read
+#  name   | uint8 length, then UTF-8 | a sensor's name, repeated count times with its value
+#  value  | double | the sensor's reading, NaN for none;  the ph raw, before calibration
+#  crc    | uint32 | CRC32 of the preceding fields
+#
+#  Segments written before the sensors were named hold fixed records of seq,
+#  time, temp, ph_raw and crc instead, and are given a different suffix;
+#  they are read as readings of the temperature and ph_raw and never appended
+#  to.
+#
+#  Appends are flushed and fsync'ed in batches rather than one at a time.
+#  apply writes the pending readings of every sensor to the ::sensors readings
+#  table (calibrating the ph with the ::calibration in effect at the time, noting any
+#  ::gaps and adding to the daily ::sketches) in a single transaction which
+#  also records the highest applied sequence number, so each reading is
+#  applied exactly once.  On start-up, replay applies whatever the log holds
+#  beyond that watermark.  Segments wholly applied are deleted by compact.
+#
+#  With a ::compression::Compressor, only the readings it keeps, each with all
+#  of its sensors, are written to the readings table.  The newest reading is held back until the next shows
+#  whether it is needed, and the watermark stops short of it, so it stays in
+#  the log until then.
+#
+#  Run as a script to inspect or compact a log:
+#
+#      python reading_log.py inspect [directory]
+#      python reading_log.py compact [directory] [database]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import sys
+import struct
+import threading
+import time
+import zlib
+import calibration
+import sensors
+import gaps
+import sketches
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The binary layout of the length leading each record
+_length = struct.Struct('<H')
+
+## The binary layout of a record's sequence number, time and sensor count
+_header = struct.Struct('<QdB')
+
+## The binary layout of a sensor's name length and value
+_name = struct.Struct('<B')
+_value = struct.Struct('<d')
+
+## The binary layout of a record written before the sensors were named, less
+#  its trailing CRC
+_legacy_record = struct.Struct('<Qddd')
+
+## The binary layout of the CRC trailing each record
+_crc = struct.Struct('<I')
+
+## The size in bytes of a complete record written before the sensors were named
+legacy_record_size = _legacy_record.size + _crc.size
+
+## The suffix given to segment files
+segment_suffix = '.rec'
+
+## The suffix of segment files written before the sensors were named
+legacy_segment_suffix = '.seg'
+
+## Encode a reading as a log record
+#
+#  @param seq the sequence number of the reading
+#  @param reading a tuple of (time, a sequence of (sensor name, value) pairs),
+#         the names at most 255 bytes and the pairs at most 255
+#  @return the record as bytes
+def encode_record(seq, reading):
+    when, pairs = reading
+    if len(pairs) > 255:
+        raise ValueError('too many sensors in one reading:  %d' %len(pairs))
+    body = [_header.pack(seq, when, len(pairs))]
+    for name, value in pairs:
+        name = name.encode('utf-8')
+        if len(name) > 255:
+            raise ValueError('sensor name too long:  %r' %name)
+        body.append(_name.pack(len(name)) + name + _value.pack(float('nan') if value is None else value))
+    body = b''.join(body)
+    body = _length.pack(len(body)) + body
+    return body + _crc.pack(zlib.crc32(body) & 0xffffffff)
+
+## Decode the body of a log record
+#
+#  @param body the bytes of a single record, less its trailing CRC
+#  @return a tuple of (seq, (time, a tuple of (sensor name, value) pairs))
+def _decode_body(body):
+    seq, when, count = _header.unpack_from(body, _length.size)
+    offset = _length.size + _header.size
+    pairs = []
+    for i in range(count):
+        size = _name.unpack_from(body, offset)[0]
+        offset += _name.size
+        name = body[offset:offset + size].decode('utf-8')
+        value = _value.unpack_from(body, offset + size)[0]
+        offset += size + _value.size
+        pairs.append((name, None if value != value else value))
+    return seq, (when, tuple(pairs))
+
+## Decode a log record
+#
+#  @param data the bytes of a single record
+#  @return a tuple of (seq, (time, a tuple of (sensor name, value) pairs)), or
+#          None if the record is torn or corrupt
+def decode_record(data):
+    if len(data) < _length.size + _crc.size:
+        return None
+    size = _length.size + _length.unpack_from(data)[0]
+    if len(data) != size + _crc.size:
+        return None
+    body = data[:size]
+    if _crc.unpack(data[size:])[0] != zlib.crc32(body) & 0xffffffff:
+        return None
+    try:
+        return _decode_body(body)
+    except (struct.error, UnicodeDecodeError):
+        return None
+
+## Decode a log record written before the sensors were named
+#
+#  @param data the bytes of a single record
+#  @return a tuple of (seq, (time, a tuple of (sensor name, value) pairs)), or
+#          None if the record is torn or corrupt
+def decode_legacy_record(data):
+    if len(data) != legacy_record_size:
+        return None
+    body = data[:_legacy_record.size]
+    if _crc.unpack(data[_legacy_record.size:])[0] != zlib.crc32(body) & 0xffffffff:
+        return None
+    seq, t, temp, ph = _legacy_record.unpack(body)
+    return seq, (t, (('temperature', temp), ('ph_raw', ph)))
+
+## Read the next record from an open segment file
+#
+#  @param f the segment file
+#  @param legacy True, if the segment was written before the sensors were named
+#  @return the record as decode_record returns it
+def _read_record(f, legacy):
+    if legacy:
+        return decode_legacy_record(f.read(legacy_record_size))
+    data = f.read(_length.size)
+    if len(data) < _length.size:
+        return None
+    return decode_record(data + f.read(_length.unpack(data)[0] + _crc.size))
+
+## Read every valid record from a segment file, and the size they take up
+#
+#  Reading stops at the first torn or corrupt record, which can only be the
+#  tail of a segment being written during a crash.
+#
+#  @param filename the segment file to read
+#  @return a tuple of (a list of (seq, (time, pairs)) tuples, the size in
+#          bytes of the valid records)
+def scan_segment(filename):
+    records, size = [], 0
+    with open(filename, 'rb') as f:
+        while True:
+            record = _read_record(f, filename.endswith(legacy_segment_suffix))
+            if record is None:
+                return records, size
+            records.append(record)
+            size = f.tell()
+
+## Read every valid record from a segment file
+#
+#  @param filename the segment file to read
+#  @return a generator of (seq, (time, pairs)) tuples
+def read_segment(filename):
+    with open(filename, 'rb') as f:
+        while True:
+            record = _read_record(f, filename.endswith(legacy_segment_suffix))
+            if record is None:
+                return
+            yield record
+
+## The first sequence number of a segment file
+#
+#  @param filename the segment file
+#  @return the sequence number
+def _first_seq(filename):
+    return int(os.path.splitext(os.path.basename(filename))[0])
+
+## Split a reading into its ph and temperature and the readings of any other
+#  sensors
+#
+#  @param reading a tuple of (time, pairs)
+#  @return a tuple of ((time, temp, ph_raw), a tuple of the other (sensor
+#          name, value) pairs)
+def _measurement(reading):
+    when, pairs = reading
+    values = dict(pairs)
+    others = tuple((name, value) for name, value in pairs if name not in ('temperature', 'ph_raw'))
+    return (when, values.get('temperature'), values.get('ph_raw')), others
+
+## The durable, append-only log of readings
+class ReadingLog:
+
+    ## The constructor opens (creating if necessary) the log directory
+    #
+    #  Any torn record left at the end of the newest segment by a crash is
+    #  truncated away.
+    #
+    #  @param directory the directory holding the segment files
+    #  @param segment_records the number of records after which a new segment
+    #         file is started
+    #  @param sync_every fsync after this many unsynced appends
+    #  @param sync_interval fsync when this many seconds have passed since the
+    #         last fsync
+    #  @param compressor the ::compression::Compressor deciding which readings
+    #         are stored, or None to store them all
+    def __init__(self, directory, segment_records=4096, sync_every=16, sync_interval=5, compressor=None):
+        self.directory = directory
+        self.compressor = compressor
+        ## The sequence number of the reading the compressor is holding back,
+        #  which is left unapplied until it is known whether to store it
+        self.held_seq = None
+        self.segment_records = segment_records
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.applied_seq = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._file = None
+        self._segment_count = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.next_seq = 1
+        segments = self.segments()
+        if segments:
+            last = segments[-1]
+            self.next_seq = _first_seq(last)
+            records, size = scan_segment(last)
+            if records:
+                self.next_seq = records[-1][0] + 1
+            if not last.endswith(legacy_segment_suffix):
+                if os.path.getsize(last) != size:
+                    logger.warning("truncating torn record at the end of %s" %last)
+                    with open(last, 'r+b') as f:
+                        f.truncate(size)
+                self._file = open(last, 'ab')
+                self._segment_count = len(records)
+
+    ## List the segment files, oldest first
+    #
+    #  @return a list of segment file paths
+    def segments(self):
+        names = sorted(n for n in os.listdir(self.directory)
+                       if n.endswith(segment_suffix) or n.endswith(legacy_segment_suffix))
+        return [os.path.join(self.directory, n) for n in names]
+
+    ## Append a reading to the log
+    #
+    #  The reading is fsync'ed with its batch, not necessarily immediately;
+    #  call sync to force it to disk.
+    #
+    #  @param reading a tuple of (time, a sequence of (sensor name, value)
+    #         pairs), the ph as raw, before calibration
+    #  @return the sequence number assigned to the reading
+    def append(self, reading):
+        with self._lock:
+            if self._file is None or self._segment_count >= self.segment_records:
+                self._roll()
+            seq = self.next_seq
+            record = encode_record(seq, reading)
+            self.next_seq += 1
+            self._file.write(record)
+            self._segment_count += 1
+            self._pending.append((seq, (reading[0], tuple(reading[1]))))
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+            return seq
+
+    ## Force every appended reading to disk
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    ## Flush and fsync the current segment;  the lock must be held
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    ## Close the current segment and start a new one;  the lock must be held
+    def _roll(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+        filename = os.path.join(self.directory, '%020d%s' %(self.next_seq, segment_suffix))
+        self._file = open(filename, 'ab')
+        self._segment_count = 0
+
+    ## Read every record held in the log, oldest first
+    #
+    #  @return a generator of (seq, (time, pairs)) tuples
+    def records(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            segments = self.segments()
+        for filename in segments:
+            for record in read_segment(filename):
+                yield record
+
+    ## Write the given records to the database in a single transaction
+    #
+    #  Each is stored as a (time, temp, ph, ph_raw, others) row, others the
+    #  (sensor name, value) pairs of any other sensors.
+    #
+    #  @param conn the database connection to use
+    #  @param records a list of (seq, (time, pairs)) tuples in seq order
+    def _store(self, conn, records):
+        measurements = [_measurement(r[1]) for r in records]
+        rows = [row + (others,) for row, (measurement, others) in
+                zip(calibration.corrected_rows(conn, [m[0] for m in measurements]), measurements)]
+        stored, applied = rows, records[-1][0]
+        if self.compressor is not None:
+            stored = self.compressor.feed(conn, rows)
+            held = self.compressor.held
+            self.held_seq = None if held is None else self.held_seq
+            for (seq, reading), row in zip(records, rows):
+                if row is held:
+                    self.held_seq = seq
+            if self.held_seq is not None:
+                applied = min(applied, self.held_seq - 1)
+        with conn:
+            sensors.store_measurements(conn, stored)
+            gaps.note(conn, [row[0] for row in stored])
+            # the sketches are of the stored readings, as a rebuild would see
+            sketches.record_measurements(conn, stored)
+            conn.execute('update reading_log_state set applied_seq=?', (applied,))
+        self.applied_seq = applied
+
+    ## Read the applied watermark from the database
+    #
+    #  @param conn the database connection to use
+    #  @return the highest sequence number already in the database
+    @staticmethod
+    def stored_seq(conn):
+        row = conn.execute('select applied_seq from reading_log_state').fetchone()
+        if row is None:
+            conn.execute('insert into reading_log_state values (0)')
+            conn.commit()
+            return 0
+        return row[0]
+
+    ## Apply to the database any logged readings it does not yet hold
+    #
+    #  Used at start-up to recover readings logged but never stored.  Should
+    #  the log directory have been lost, numbering resumes after the database's
+    #  watermark so that new readings are not mistaken for applied ones.
+    #
+    #  @param conn the database connection to use
+    #  @return the number of readings applied
+    def replay(self, conn):
+        self.applied_seq = self.stored_seq(conn)
+        self.next_seq = max(self.next_seq, self.applied_seq + 1)
+        with self._lock:
+            self._pending = []
+        records = [r for r in self.records() if r[0] > self.applied_seq]
+        if records:
+            logger.info("replaying %d readings from the reading log" %len(records))
+            self._store(conn, records)
+            # a reading held back by the compressor is applied with the next
+            with self._lock:
+                self._pending = [r for r in records if r[0] > self.applied_seq]
+        return len(records)
+
+    ## Apply the readings appended since the last apply to the database
+    #
+    #  If the database write fails, the readings stay pending and are retried
+    #  on the next call.
+    #
+    #  @param conn the database connection to use
+    #  @return the number of readings applied
+    def apply(self, conn):
+        with self._lock:
+            records = [r for r in self._pending if r[0] > self.applied_seq]
+        if not records or [r[0] for r in records] == [self.held_seq]:
+            return 0
+        self._store(conn, records)
+        with self._lock:
+            self._pending = [r for r in self._pending if r[0] > self.applied_seq]
+        return len(records)
+
+    ## Delete segments whose readings have all been applied
+    #
+    #  The newest segment, the one being appended to, is never deleted.
+    #
+    #  @param applied_seq the watermark to compact to, defaults to the last
+    #         applied sequence number
+    #  @return the list of deleted segment files
+    def compact(self, applied_seq=None):
+        applied_seq = self.applied_seq if applied_seq is None else applied_seq
+        deleted = []
+        with self._lock:
+            segments = self.segments()
+            for first, following in zip(segments, segments[1:]):
+                last_seq = _first_seq(following) - 1
+                if last_seq <= applied_seq:
+                    os.remove(first)
+                    deleted.append(first)
+        if deleted:
+            logger.info("compacted %d reading log segments" %len(deleted))
+        return deleted
+
+    ## Sync and close the log
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
+
+## Print a summary of each segment in a log directory
+#
+#  @param directory the log directory
+#  @param out the stream to print to
+def inspect(directory, out=sys.stdout):
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(segment_suffix) and not filename.endswith(legacy_segment_suffix):
+            continue
+        path = os.path.join(directory, filename)
+        records, size = scan_segment(path)
+        torn = os.path.getsize(path) - size
+        if records:
+            out.write("%s  %6d records  seq %d-%d  %s to %s%s\n"
+                      %(filename, len(records), records[0][0], records[-1][0],
+                        time.ctime(records[0][1][0]), time.ctime(records[-1][1][0]),
+                        '  (%d torn bytes)' %torn if torn else ''))
+        else:
+            out.write("%s  empty%s\n" %(filename, '  (%d torn bytes)' %torn if torn else ''))
+
+if __name__ == "__main__":
+    import fishtank_monitor
+    command = sys.argv[1] if len(sys.argv) > 1 else 'inspect'
+    directory = sys.argv[2] if len(sys.argv) > 2 else fishtank_monitor.reading_log_directory
+    if command == 'inspect':
+        inspect(directory)
+    elif command == 'compact':
+        # replay as the monitor would, holding back what its compressor holds back
+        import config
+        config.read_config()
+        conn = fishtank_monitor.open_database(sys.argv[3] if len(sys.argv) > 3 else None)
+        reading_log = fishtank_monitor.open_reading_log(directory)
+        reading_log.replay(conn)
+        for filename in reading_log.compact():
+            print("deleted %s" %filename)
+        reading_log.close()
+    else:
+        sys.exit("usage: reading_log.py inspect|compact [directory] [database]")
@@ -52,6 +52,8 @@ class LightScheduler(threading.Thread):
     ## The constructor builds the functors and calls them as the specified times
     def __init__(self):
         super().__init__()
+        self.last_heartbeat = time.time()
+        self._stopped = threading.Event()
         self._scheduler = schedule.Scheduler()
         self._on = LightFunctor()
         self._off = LightFunctor(False)
@@ -82,10 +84,15 @@ class LightScheduler(threading.Thread):
             return False
         return True
 
+    ## Ask the scheduler thread to stop
+    def shutdown(self):
+        self._stopped.set()
+
     ## The thread's run method - starts the scheduler
     def run(self):
         logger.info("light scheduler starting up")
-        while True:
+        while not self._stopped.is_set():
+            self.last_heartbeat = time.time()
             self._scheduler.run_pending()
-            time.sleep(1)
+            self._stopped.wait(1)
 
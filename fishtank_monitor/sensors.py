@@ -0,0 +1,183 @@
+## @package sensors
+#  The sensor registry and the narrow storage of sensor readings
+#
+#  Every reading of every sensor is stored as one row of the readings table,
+#  keyed by (tank, sensor, time), the sensor being the id of its entry in the
+#  sensors registry.  The table is created without a rowid so it is stored as
+#  its primary key index:  the readings of one sensor are contiguous and in
+#  time order, and range queries over them are index-only.  Adding a sensor
+#  (conductivity, ORP, water level...) only adds a row to the registry.
+#
+#  The built-in sensors have fixed ids:
+#
+#  Id | Name        | Contents
+#  -- | ----------- | ------------------------------------------------------
+#  1  | temperature | degrees C
+#  2  | ph          | ph, corrected by the ::calibration in effect
+#  3  | ph_raw      | the raw ph the calibration is applied to
+#
+#  For the code reading whole measurements, measurements is a view presenting
+#  the local tank's built-in sensors in the old (time, temp, ph, ph_raw)
+#  layout, one row per temperature reading, and inserting into it stores each
+#  column as a reading.  Databases holding the old measurements table are
+#  migrated by copying it into readings once, on open.
+#
+#  Every write to the readings, wherever it comes from, calls changed within
+#  its transaction, bumping the version in the readings_version table.  The
+#  ::query_cache compares versions to know whether a cached result is still
+#  good, so writes to any other table do not disturb it.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The tank this monitor's own readings are recorded against
+local_tank = 0
+
+## The id of the temperature sensor
+TEMPERATURE = 1
+
+## The id of the corrected ph sensor
+PH = 2
+
+## The id of the raw ph sensor
+PH_RAW = 3
+
+## The built-in sensors as (id, name, unit) tuples
+builtin = [(TEMPERATURE, 'temperature', 'C'), (PH, 'ph', 'pH'), (PH_RAW, 'ph_raw', 'pH')]
+
+_measurements_view = '''create view if not exists measurements as
+    select t.time as time, t.value as temp, p.value as ph, r.value as ph_raw from readings t
+    left join readings p on p.tank = t.tank and p.sensor = %d and p.time = t.time
+    left join readings r on r.tank = t.tank and r.sensor = %d and r.time = t.time
+    where t.tank = %d and t.sensor = %d''' %(PH, PH_RAW, local_tank, TEMPERATURE)
+
+_measurements_insert = '''create trigger if not exists measurements_insert instead of insert on measurements
+    begin
+        insert or replace into readings values (%d, %d, new.time, new.temp);
+        insert or replace into readings select %d, %d, new.time, new.ph where new.ph is not null;
+        insert or replace into readings select %d, %d, new.time, new.ph_raw where new.ph_raw is not null;
+        update readings_version set version = version + 1;
+    end''' %(local_tank, TEMPERATURE, local_tank, PH, local_tank, PH_RAW)
+
+## Create the registry, the readings table and the measurements view
+#
+#  An old measurements table is migrated first.
+#
+#  @param conn the database connection to use
+def create_tables(conn):
+    conn.execute('create table if not exists sensors (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, unit TEXT)')
+    conn.executemany('insert or ignore into sensors values (?, ?, ?)', builtin)
+    conn.execute('create table if not exists readings (tank INT NOT NULL, sensor INT NOT NULL, time INT NOT NULL, '
+                 'value REAL, primary key (tank, sensor, time)) without rowid')
+    conn.execute('create table if not exists readings_version (version INT)')
+    conn.execute('insert into readings_version select 0 where not exists (select 1 from readings_version)')
+    migrate(conn)
+    conn.execute(_measurements_view)
+    conn.execute(_measurements_insert)
+    conn.commit()
+
+## Move the rows of an old measurements table into readings
+#
+#  Where the old table holds more than one row for a time, the first is kept.
+#
+#  @param conn the database connection to use
+#  @return the number of measurements migrated
+def migrate(conn):
+    row = conn.execute("select type from sqlite_master where name='measurements'").fetchone()
+    if row is None or row[0] != 'table':
+        return 0
+    columns = [column[1] for column in conn.execute('pragma table_info(measurements)')]
+    with conn:
+        for sensor, column in [(TEMPERATURE, 'temp'), (PH, 'ph'), (PH_RAW, 'ph_raw')]:
+            if column in columns:
+                # temperature rows are kept even when empty as each anchors a measurement
+                missing = '' if sensor == TEMPERATURE else ' and %s is not null' %column
+                conn.execute('insert or ignore into readings select ?, ?, time, %s from measurements '
+                             'where time is not null%s order by rowid' %(column, missing), (local_tank, sensor))
+        count = conn.execute('select count(*) from measurements').fetchone()[0]
+        changed(conn)
+        conn.execute('drop index if exists measurements_time')
+        conn.execute('drop table measurements')
+    logger.info("migrated %d measurements to the readings table" %count)
+    return count
+
+## Note that the readings have been written
+#
+#  @param conn the database connection to use, within the writer's transaction
+def changed(conn):
+    conn.execute('update readings_version set version = version + 1')
+
+## Read the version of the readings, which changes whenever they are written
+#
+#  @param conn the database connection to use
+#  @return the version
+def version(conn):
+    return conn.execute('select version from readings_version').fetchone()[0]
+
+## Find a sensor's id, registering it if it is new
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param unit the sensor's unit, recorded only when registering
+#  @return the sensor's id
+def sensor_id(conn, name, unit=None):
+    row = conn.execute('select id from sensors where name=?', (name,)).fetchone()
+    if row is not None:
+        return row[0]
+    logger.info("registering sensor %r" %name)
+    return conn.execute('insert into sensors (name, unit) values (?, ?)', (name, unit)).lastrowid
+
+## List the registered sensors
+#
+#  @param conn the database connection to use
+#  @return a list of (id, name, unit) tuples in id order
+def registered(conn):
+    return conn.execute('select id, name, unit from sensors order by id').fetchall()
+
+## Store readings of the built-in sensors, and of any others taken with them
+#
+#  @param conn the database connection to use, within the caller's transaction
+#  @param rows a list of (time, temp, ph, ph_raw) tuples, or of (time, temp,
+#         ph, ph_raw, others) tuples, others the (sensor name, value) pairs of
+#         any other sensors
+#  @param tank the tank the readings are from
+def store_measurements(conn, rows, tank=local_tank):
+    for sensor, i in [(TEMPERATURE, 1), (PH, 2), (PH_RAW, 3)]:
+        # as in the measurements view, an empty temperature still anchors the row
+        conn.executemany('insert or replace into readings values (?, ?, ?, ?)',
+                         [(tank, sensor, row[0], row[i]) for row in rows if row[i] is not None or i == 1])
+    conn.executemany('insert or replace into readings values (?, ?, ?, ?)',
+                     [(tank, sensor_id(conn, name), row[0], value) for row in rows if len(row) > 4
+                      for name, value in row[4]])
+    if rows:
+        changed(conn)
+
+## Store the readings of any sensors taken at one time
+#
+#  @param conn the database connection to use
+#  @param when the time of the readings
+#  @param values a dict of sensor name to value
+#  @param tank the tank the readings are from
+def record(conn, when, values, tank=local_tank):
+    with conn:
+        conn.executemany('insert or replace into readings values (?, ?, ?, ?)',
+                         [(tank, sensor_id(conn, name), when, value) for name, value in sorted(values.items())])
+        changed(conn)
+
+## Read the readings of one sensor over a time range
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param start the start of the range
+#  @param end the end of the range (exclusive)
+#  @param tank the tank the readings are from
+#  @return a list of (time, value) tuples, oldest first
+def series(conn, name, start, end, tank=local_tank):
+    return conn.execute('select r.time, r.value from sensors s join readings r on r.sensor = s.id '
+                        'where s.name = ? and r.tank = ? and r.time >= ? and r.time < ? order by r.time',
+                        (name, tank, start, end)).fetchall()
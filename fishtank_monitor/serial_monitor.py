@@ -1,6 +1,34 @@
 ## @package serial_monitor
 #  Module responsible for communications between the raspberry pi and the alamode
 #
+#  Messages from the Alamode are JSON lines by default.  When the Pi offers
+#  ("framing": "binary" in its configuration) and the Alamode supports it, the
+#  Alamode acknowledges with a JSON message of {"framing": "binary"} and
+#  thereafter sends compact binary frames:
+#
+#  Field   | Size | Contents
+#  ------- | ---- | ----------------------------------------------------------
+#  sync    | 1    | FRAME_SYNC (0xA5)
+#  length  | 1    | the length of the payload
+#  payload | n    | a type byte then, for FRAME_READINGS, the readings or, for
+#          |      | FRAME_LOG, UTF8 text
+#  crc     | 2    | the CRC-16/CCITT of the length and payload, big-endian
+#
+#  The readings are a run of tag-length-value entries, one per sensor:  the
+#  sensor's code (see frame_sensors), the length of the value and the value,
+#  the reading in hundredths as a little-endian signed integer of that many
+#  bytes.  A sensor without a code is decoded as sensor_<code>, so readings
+#  from an Alamode knowing more sensors than the Pi are still stored.
+#
+#  The Pi does not keep track of which the Alamode is sending:  every message
+#  is read as a frame if it starts with the sync byte and as a JSON line if it
+#  starts with "{", neither of which can start the other, and anything else is
+#  skipped.  So nothing is lost when either end restarts, or when a corrupt
+#  frame throws the Pi out of step.  Messages from the Pi are always the JSON
+#  configuration, carrying a session number chosen by each new SerialMonitor
+#  when binary framing is offered, so the Alamode acknowledges the offer anew
+#  to each.
+#
 #  @author  Ed Willis
 #  @copyright Ed Willis, 2015, all rights reserved
 #  @license  This software is released into the public domain
@@ -9,11 +37,137 @@ import time
 import serial
 import threading
 import config
+import filters
 import json
+import struct
+import random
+import binascii
+import collections
 from log import get_logger
 
 logger = get_logger(__name__)
 
+## The byte starting each binary frame
+FRAME_SYNC = 0xA5
+
+## The payload type of a frame holding sensor readings
+FRAME_READINGS = 1
+
+## The payload type of a frame holding a log message
+FRAME_LOG = 2
+
+## The codes of the sensors whose readings can be framed
+frame_sensors = { 1: 'temperature', 2: 'ph' }
+
+_codes = dict((name, code) for code, name in frame_sensors.items())
+_crc = struct.Struct('>H')
+
+## Compute the CRC-16/CCITT of some bytes, as the Alamode does
+#
+#  @param data the bytes to check
+#  @return the CRC as an integer
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+## Encode a message as a binary frame
+#
+#  @param message a dict holding either readings of sensors in frame_sensors
+#         or a log entry
+#  @return the frame as bytes
+def encode_frame(message):
+    values = sensor_values(message)
+    if values:
+        payload = bytes([FRAME_READINGS])
+        for name, value in sorted(values.items()):
+            if name not in _codes:
+                raise ValueError('sensor has no frame code:  %r' %name)
+            hundredths = int(round(value * 100))
+            size = 2 if -0x8000 <= hundredths < 0x8000 else 4
+            payload += bytes([_codes[name], size]) + hundredths.to_bytes(size, 'little', signed=True)
+    elif 'log' in message:
+        payload = bytes([FRAME_LOG]) + message['log'].encode('UTF8')[:254]
+    else:
+        raise ValueError('message cannot be framed:  %r' %message)
+    body = bytes([len(payload)]) + payload
+    return bytes([FRAME_SYNC]) + body + _crc.pack(crc16(body))
+
+## Decode the tag-length-value readings of a FRAME_READINGS payload
+#
+#  @param payload the payload after its type byte
+#  @return a dict of sensor name to value
+#  @throw ValueError if an entry overruns the payload
+def _decode_readings(payload):
+    values = {}
+    i = 0
+    while i < len(payload):
+        if i + 2 > len(payload) or i + 2 + payload[i + 1] > len(payload) or not payload[i + 1]:
+            raise ValueError('malformed readings:  %r' %payload)
+        code, size = payload[i], payload[i + 1]
+        name = frame_sensors.get(code, 'sensor_%d' %code)
+        values[name] = int.from_bytes(payload[i + 2:i + 2 + size], 'little', signed=True) / 100.0
+        i += 2 + size
+    return values
+
+## Decode a binary frame
+#
+#  @param frame the frame as bytes, from the sync byte to the CRC
+#  @return the message as a dict, as if it had been sent as JSON
+#  @throw ValueError if the frame is truncated, corrupt or of an unknown type
+def decode_frame(frame):
+    if len(frame) < 5 or frame[0] != FRAME_SYNC or len(frame) != frame[1] + 4:
+        raise ValueError('truncated or malformed frame:  %r' %frame)
+    body = frame[1:-2]
+    if _crc.unpack(frame[-2:])[0] != crc16(body):
+        raise ValueError('frame failed its CRC check:  %r' %frame)
+    kind, payload = body[1], body[2:]
+    if kind == FRAME_READINGS:
+        return _decode_readings(payload)
+    if kind == FRAME_LOG:
+        return { 'log': payload.decode('UTF8', 'replace') }
+    raise ValueError('unknown frame type:  %r' %frame)
+
+## Pick the sensor readings out of a message from the Alamode
+#
+#  Every numeric entry of a message is a reading of the sensor it names, so
+#  the Alamode can report new sensors without any change here.
+#
+#  @param message the message as a dict
+#  @return a dict of sensor name to value
+def sensor_values(message):
+    return dict((name, value) for name, value in message.items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool))
+
+## An immutable snapshot of the Alamode's readings
+#
+#  Every message carrying sensor readings is published as a new Reading
+#  holding the latest value of every sensor, so a consumer holding one always
+#  sees values that belong together.  seq counts the readings published by
+#  a monitor, starting at 1, time is when the message was received and values
+#  is a tuple of (sensor name, value) pairs sorted by name.
+class Reading(collections.namedtuple('Reading', ['seq', 'time', 'values'])):
+    __slots__ = ()
+
+    ## Look up the value of one sensor
+    #
+    #  @param name the sensor's name
+    #  @param default the value to return if the sensor has not been read
+    #  @return the sensor's value
+    def get(self, name, default=None):
+        for n, value in self.values:
+            if n == name:
+                return value
+        return default
+
+    ## The temperature, or None if it has not been read
+    @property
+    def temperature(self):
+        return self.get('temperature')
+
+    ## The ph, or None if it has not been read
+    @property
+    def ph(self):
+        return self.get('ph')
+
 ## The SerialMonitor manages JSON encoded communications with the alamode
 #
 #  The communications protocol between the Alamode and the Pi starts with the
@@ -25,24 +179,86 @@ logger = get_logger(__name__)
 #  the fishtank_monitor is stopped.  All communications are encoded in simple
 #  JSON strings.  Logs entries from the alamode are prefixed to distinguish
 #  them from the fishtank_monitor logs but are emitted to those logs also.
-#  The SerialMonitor runs in its own thread.
+#  Messages from the Alamode may instead be binary frames, as negotiated
+#  above;  framing records which the Alamode sent last.
+#  Each sensor's readings pass through its configured noise filter (see
+#  ::filters) and the latest are published atomically as a Reading in reading;
+#  consumers should take it once rather than reading temperature and ph
+#  separately, and can block on wait_for_reading for the next one.
+#  The SerialMonitor runs in its own thread, recording a heartbeat each time
+#  it hears from the Alamode so the supervisor can detect a hung link.
 class SerialMonitor(threading.Thread):
 
+    ## The sensors which must all have been read before the monitor is started
+    required_sensors = ['temperature', 'ph']
+
     ## The constructor creates the SerialMonitor thread but does not start it
     #
     #  @param serial_device the serial device to read and write to
     #  @param configuration the arduino configuration json object to send
     def __init__(self, serial_device, configuration):
         super().__init__()
-        self.ph = None
-        self.temperature = None
+        self.reading = None
+        self._published = threading.Condition()
         self.started = threading.Event()
+        self.framing = 'json'
+        self.frame_errors = 0
+        ## The session number sent with the configuration when binary framing
+        #  is offered
+        self.session = random.randint(1, 9999)
+        self.filters = filters.FilterBank(config.sensor_filters)
+        self.last_heartbeat = time.time()
+        self._stopped = threading.Event()
         self.serial_device = serial_device
         self.ard = serial.Serial(self.serial_device)
         self.daemon = True
         self.configuration = configuration
         self._write_to_serial(self.configuration)
 
+    ## The latest temperature, or None if there is no reading yet
+    @property
+    def temperature(self):
+        reading = self.reading
+        return reading.temperature if reading else None
+
+    ## The latest ph, or None if there is no reading yet
+    @property
+    def ph(self):
+        reading = self.reading
+        return reading.ph if reading else None
+
+    ## The latest value of every sensor as a dict
+    @property
+    def values(self):
+        reading = self.reading
+        return dict(reading.values) if reading else {}
+
+    ## Publish a new Reading, waking anyone waiting for it
+    #
+    #  @param values a dict of the sensor values just received, which are
+    #         passed through their sensors' filters and merged into the latest
+    #         values of the other sensors
+    def _publish(self, values):
+        with self._published:
+            previous = self.reading
+            merged = dict(previous.values) if previous else {}
+            merged.update(self.filters(values))
+            self.reading = Reading(previous.seq + 1 if previous else 1, time.time(), tuple(sorted(merged.items())))
+            self._published.notify_all()
+        if all(name in merged for name in self.required_sensors) and not self.started.is_set():
+            self.started.set()
+
+    ## Wait for a reading newer than the one a consumer last saw
+    #
+    #  @param after_seq the seq of the last reading seen, 0 for none
+    #  @param timeout the most seconds to wait, None to wait indefinitely
+    #  @return the latest Reading, or None if there was no newer one in time
+    def wait_for_reading(self, after_seq=0, timeout=None):
+        with self._published:
+            if self._published.wait_for(lambda: self.reading is not None and self.reading.seq > after_seq, timeout):
+                return self.reading
+        return None
+
     ## Set the Alamode configuration object
     #
     #  The Alamode configuration is mutable - the user might have changed
@@ -59,17 +275,21 @@ class SerialMonitor(threading.Thread):
 
     ## Write a specified JSON object to the serial device
     #
+    #  A configuration offering binary framing is sent with this monitor's
+    #  session number.
+    #
     #  @param json_message the JSON messsage to send to the alamode
     def _write_to_serial(self, json_message):
+        if json_message.get('framing') == 'binary':
+            json_message = dict(json_message, session=self.session)
         logger.info("writing to serial:  %r" %json.dumps(json_message))
         self.ard.writelines([json.dumps(json_message).encode('UTF8')])
 
     ## Given a string read from the Alamode, construct a JSON object from it
     #
     #  The input is parsed and any extraneous characters (prefixes or unexpected
-    #  appendices) are discarded.  Sensor readings are assumed to be complete -
-    #  that is, when one appears, all sensor readings will appear - but log and
-    #  sensor entries can appear together in a message.  Log entries are
+    #  appendices) are discarded.  A message may hold the readings of any number
+    #  of sensors and a log entry together.  Log entries are
     #  immediately send to the fishtank_monitor log with a prefix making them
     #  easily distinguishable.
     #
@@ -80,36 +300,88 @@ class SerialMonitor(threading.Thread):
             logger.debug("input is %r" %input)
             message = json.loads(input[input.index('{') : input.rfind('}') + 1])
             logger.debug("received from alamode json is %r" %message)
-            if 'temperature' in message and 'ph' in message:
-                logger.info("measured temperature:  %r" %message['temperature'])
-                logger.info("measured ph:  %r" %message['ph'])
-            if 'log' in message:
-                logger.info("ALAMODE:  %s" %message.pop("log"))
-            return message
+            return self._log_message(message)
         return None
 
+    ## Log the readings and log entry in a message from the Alamode
+    #
+    #  @param message the message, from which any log entry is removed
+    #  @return the message
+    def _log_message(self, message):
+        for name, value in sorted(sensor_values(message).items()):
+            logger.info("measured %s:  %r" %(name, value))
+        if 'log' in message:
+            logger.info("ALAMODE:  %s" %message.pop("log"))
+        return message
+
+    ## Read a JSON line from the Alamode
+    #
+    #  @param prefix bytes of the line already read
+    #  @return None if nothing was read, otherwise the message (empty if
+    #          the line could not be parsed)
+    def _read_line(self, prefix=b''):
+        next = (prefix + self.ard.readline()).decode('UTF8', 'replace')
+        if not next:
+            return None
+        logger.debug("serial raw read %r"%next)
+        self.framing = 'json'
+        return self._parse_input(next) or {}
+
+    ## Read a binary frame from the Alamode
+    #
+    #  @param sync the sync byte already read
+    #  @return the message (empty if the frame was corrupt)
+    def _read_frame(self, sync):
+        length = self.ard.read(1)
+        frame = sync + length + (self.ard.read(length[0] + 2) if length else b'')
+        try:
+            message = self._log_message(decode_frame(frame))
+        except ValueError as e:
+            self.frame_errors += 1
+            logger.warning("discarding frame from alamode:  %s" %e)
+            return {}
+        self.framing = 'binary'
+        return message
+
+    ## Read the next message from the Alamode, a frame or a JSON line as its
+    #  first byte shows
+    #
+    #  Bytes before the start of a message are skipped.
+    #
+    #  @return None if nothing was read, otherwise the message (empty if
+    #          it was corrupt)
+    def _read_message(self):
+        while True:
+            first = self.ard.read(1)
+            if not first:
+                return None
+            if first[0] == FRAME_SYNC:
+                return self._read_frame(first)
+            if first == b'{':
+                return self._read_line(first)
+
     ## Manage the Pi to Alamode communications protocol
     #
-    #  The run method reads messages from the serial device and sets the sensor
-    #  measurements on itself in public members which parties interested in the
-    #  most recent observations can read.  Each received message trigger the send
+    #  The run method reads messages from the serial device and publishes the
+    #  sensor measurements as a Reading which parties interested in the most
+    #  recent observations can read.  Each received message trigger the send
     #  of configuration data back to the Alamode.
     def run(self):
         try:
-            stop = False
-            while not stop:
-                next = self.ard.readline().decode('UTF8')
-                if next:
-                    logger.debug("serial raw read %r"%next)
-                    message = self._parse_input(next)
-                    if message and 'temperature' in message and 'ph' in message:
-                        self.temperature = message['temperature']
-                        self.ph = message['ph']
-                        if not self.started.is_set():
-                            self.started.set()
+            while not self._stopped.is_set():
+                message = self._read_message()
+                if message is not None:
+                    self.last_heartbeat = time.time()
+                    values = sensor_values(message)
+                    if values:
+                        self._publish(values)
+                    if message.get('framing') == 'binary':
+                        logger.info("alamode acknowledged binary framing")
                     self._write_to_serial(self.configuration)
 
         except Exception as e:
+            if self._stopped.is_set():
+                return
             logger.exception("exception encountered in monitor_serial:  %r" %e)
             raise
 
@@ -121,8 +393,28 @@ class SerialMonitor(threading.Thread):
         monitor = SerialMonitor(config.serial_device, configuration)
         return monitor
 
+    ## Create the SerialMonitor object, opening the serial port afresh, and start it
+    #
+    #  @return the started SerialMonitor object
+    @classmethod
+    def create_and_start_monitor(cls, configuration):
+        monitor = cls.create_monitor(configuration)
+        monitor.start_monitor()
+        return monitor
+
     ## Start ourselves
     def start_monitor(self):
         logger.info("starting monitor")
         self.start()
 
+    ## Stop reading and close the serial port
+    #
+    #  Closing the port unblocks a pending readline so the thread exits
+    #  promptly and a replacement monitor can reopen the device.
+    def shutdown(self):
+        logger.info("shutting down monitor")
+        self._stopped.set()
+        close = getattr(self.ard, 'close', None)
+        if close:
+            close()
+
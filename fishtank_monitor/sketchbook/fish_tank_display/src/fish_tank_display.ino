@@ -186,6 +186,81 @@ float getPh()
   return ph;
 }
 
+/** Whether the Pi has asked for compact binary frames rather than JSON
+ */
+int framingRequested = 0;
+
+/** Whether measurements and logs are currently sent as binary frames
+ */
+int binaryFraming = 0;
+
+/** The session number of the Pi's monitor in its last configuration
+ */
+long framingSession = 0;
+
+/** The session number of the Pi's monitor whose request for binary frames
+ *  was last acknowledged
+ */
+long acknowledgedSession = -1;
+
+/** The byte starting each binary frame
+ */
+#define FRAME_SYNC 0xA5
+
+/** The payload type of a frame holding sensor readings
+ */
+#define FRAME_READINGS 1
+
+/** The payload type of a frame holding a log message
+ */
+#define FRAME_LOG 2
+
+/** The code of the temperature in a frame's readings
+ */
+#define SENSOR_TEMPERATURE 1
+
+/** The code of the ph in a frame's readings
+ */
+#define SENSOR_PH 2
+
+/** Append one tag-length-value reading to a frame's readings
+ *
+ *  @param buffer the readings
+ *  @param offset where in the buffer to append the reading
+ *  @param code the sensor's code
+ *  @param hundredths the reading in hundredths
+ *  @return the offset after the reading
+ */
+int appendReading(unsigned char* buffer, int offset, unsigned char code, int hundredths)
+{
+  buffer[offset] = code;
+  buffer[offset + 1] = 2;
+  buffer[offset + 2] = hundredths & 0xFF;
+  buffer[offset + 3] = (hundredths >> 8) & 0xFF;
+  return offset + 4;
+}
+
+/** Compute the CRC-16/CCITT of a buffer
+ *
+ *  @param data the bytes to check
+ *  @param length the number of bytes
+ *  @return the CRC
+ */
+unsigned int crc16(const unsigned char* data, int length)
+{
+  unsigned int crc = 0xFFFF;
+  int i, bit;
+  for (i = 0; i < length; i++)
+  {
+    crc ^= ((unsigned int) data[i]) << 8;
+    for (bit = 0; bit < 8; bit++)
+    {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
+  }
+  return crc & 0xFFFF;
+}
+
 /** handle a send/receive pair over Serial
  *
  *  @param toSend a JsonObject to send to the Pi
@@ -201,6 +276,53 @@ void handleSendReceivePair(JsonObject& toSend) {
   receiveConfigurationOverSerial();
 }
 
+/** handle a send/receive pair over Serial, sending a binary frame
+ *
+ *  The frame is the sync byte, the payload length, the payload (the type
+ *  followed by the body) and the big-endian CRC-16/CCITT of the length and
+ *  payload.
+ *
+ *  @param type the payload type
+ *  @param body the payload body
+ *  @param length the length of the body, truncated to fit a frame
+ */
+void handleSendReceiveFrame(unsigned char type, const unsigned char* body, int length)
+{
+  unsigned char frame[MAX_COLLECTION_SIZE];
+  if (length > MAX_COLLECTION_SIZE - 5)
+  {
+    length = MAX_COLLECTION_SIZE - 5;
+  }
+  frame[0] = FRAME_SYNC;
+  frame[1] = length + 1;
+  frame[2] = type;
+  memcpy(&frame[3], body, length);
+  unsigned int crc = crc16(&frame[1], length + 2);
+  frame[length + 3] = crc >> 8;
+  frame[length + 4] = crc & 0xFF;
+  Serial.write(frame, length + 5);
+  Serial.flush();
+  receiveConfigurationOverSerial();
+}
+
+/** Acknowledge a request from the Pi for binary frames, if there is one
+ *
+ *  The acknowledgement is sent as JSON, once to each session of the Pi's
+ *  monitor, so a monitor restarted on the Pi is acknowledged too.
+ */
+void negotiateFraming()
+{
+  if (framingRequested && (!binaryFraming || framingSession != acknowledgedSession))
+  {
+    StaticJsonBuffer<MAX_COLLECTION_SIZE> jsonBuffer;
+    JsonObject& root = jsonBuffer.createObject();
+    root["framing"] = "binary";
+    binaryFraming = 1;
+    acknowledgedSession = framingSession;
+    handleSendReceivePair(root);
+  }
+}
+
 /** send sensor measurements to the Raspberry Pi over serial
  *
  *  Send temperature and ph readings back to pi. Both arguments are 
@@ -212,6 +334,15 @@ void handleSendReceivePair(JsonObject& toSend) {
  */
 void printTempAndPhToSerial(int temp, int ph)
 {
+  negotiateFraming();
+  if (binaryFraming)
+  {
+    unsigned char readings[8];
+    int length = appendReading(readings, 0, SENSOR_TEMPERATURE, temp * 10);
+    length = appendReading(readings, length, SENSOR_PH, ph * 10);
+    handleSendReceiveFrame(FRAME_READINGS, readings, length);
+    return;
+  }
   StaticJsonBuffer<MAX_COLLECTION_SIZE> jsonBuffer;
   JsonObject& root = jsonBuffer.createObject();
   root["temperature"] = temp/10.0;
@@ -232,6 +363,12 @@ void logToSerial(const char * const message, ...)
   va_start(args, message);
   vsnprintf(msg_buffer, sizeof(msg_buffer), message, args);
   va_end(args);
+  negotiateFraming();
+  if (binaryFraming)
+  {
+    handleSendReceiveFrame(FRAME_LOG, (const unsigned char*) msg_buffer, strlen(msg_buffer));
+    return;
+  }
   JsonObject& root = jsonBuffer.createObject();
   root["log"] = msg_buffer;
   handleSendReceivePair(root);
@@ -349,6 +486,13 @@ void receiveConfigurationOverSerial() {
       if (root.containsKey("ip_address")) {
         strncpy((char*) IP_ADDRESS, root["ip_address"], sizeof(IP_ADDRESS));
       }
+      framingRequested = root.containsKey("framing") && strcmp(root["framing"], "binary") == 0;
+      if (root.containsKey("session")) {
+        framingSession = root["session"];
+      }
+      if (!framingRequested) {
+        binaryFraming = 0;
+      }
       receivedConfiguration = 1;
     }
   }
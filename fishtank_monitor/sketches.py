@@ -0,0 +1,317 @@
+## @package sketches
+#  Mergeable daily distribution sketches of the sensor readings
+#
+#  The ::summaries can say what the mean temperature was over a month, but not
+#  its 95th percentile or how much of the time the ph was in range, which
+#  would mean reading every reading.  Instead, the distribution of each
+#  sketched sensor's readings over each day (in local time) is kept as a
+#  Sketch:  a sparse histogram with fixed-width bins of the sensor's
+#  resolution, plus the total weight, minimum and maximum.  Two sketches are
+#  merged by adding their bins' weights, so the distribution over any range of
+#  days is the merge of the days' sketches, at a cost proportional to the
+#  number of days rather than readings.  Quantiles are accurate to within
+#  half a bin.
+#
+#  The distribution is over time rather than readings, and is built from the
+#  readings stored, so that it is the same whether built as they are stored or
+#  rebuilt later, and whether or not ::compression left some out.  Each
+#  reading adds the seconds since the sensor's previous reading to the day it
+#  is in, spread evenly over the values on the straight line between the two,
+#  as ::compression::interpolate would read them.  A reading with none before
+#  it within config.gap_threshold, the first or one after an outage, adds
+#  nothing but its value to the minimum and maximum.
+#
+#  The sketches are stored in the sketches table, keyed by (tank, sensor,
+#  day), and kept up to date as the ::reading_log stores each batch of
+#  readings.  Where readings are changed in bulk (a ::backfill, or a
+#  ::calibration recomputing the ph) the days affected are rebuilt from the
+#  readings, as is every day when the table is first created on a database
+#  which already has a history, or still holds the sketches of earlier
+#  versions, which counted readings rather than time.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import struct
+import itertools
+import config
+import sensors
+import summaries
+import partitions
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The bin width of each sketched sensor
+resolutions = { 'temperature': 0.05, 'ph': 0.01 }
+
+## The number of readings binned at a time by a rebuild
+rebuild_rows = 100000
+
+## The distribution of a set of readings
+class Sketch:
+
+    ## The constructor
+    #
+    #  @param resolution the width of each bin
+    def __init__(self, resolution):
+        self.resolution = resolution
+        ## The total weight, in seconds
+        self.seconds = 0
+        self.min = None
+        self.max = None
+        self.bins = {}
+
+    ## Fold another sketch of the same resolution into this one
+    #
+    #  @param other the Sketch
+    def merge(self, other):
+        if other.min is None:
+            return
+        self.seconds += other.seconds
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        for b, n in other.bins.items():
+            self.bins[b] = self.bins.get(b, 0) + n
+
+    ## Estimate a quantile of the readings
+    #
+    #  @param q the quantile, from 0 to 1
+    #  @return the estimate, or None if there are no readings
+    def quantile(self, q):
+        if not self.seconds:
+            return None
+        rank = q * (self.seconds - 1)
+        seen = 0
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            if seen > rank:
+                return min(self.max, max(self.min, b * self.resolution))
+        return self.max
+
+    ## Estimate the fraction of the time within a range
+    #
+    #  @param low the low end of the range
+    #  @param high the high end of the range
+    #  @return the fraction, or None if there are no readings
+    def fraction_between(self, low, high):
+        if not self.seconds:
+            return None
+        return sum(n for b, n in self.bins.items() if low <= b * self.resolution <= high) / float(self.seconds)
+
+    ## Encode the bins for storage
+    #
+    #  @return the bytes
+    def encode(self):
+        flat = [x for pair in sorted(self.bins.items()) for x in pair]
+        return struct.pack('<%di' %len(flat), *flat)
+
+    ## Rebuild a sketch from storage
+    #
+    #  @param resolution the width of each bin
+    #  @param seconds the total weight
+    #  @param low the lowest reading
+    #  @param high the highest reading
+    #  @param data the bins as encoded by encode
+    #  @return the Sketch
+    @staticmethod
+    def decode(resolution, seconds, low, high, data):
+        sketch = Sketch(resolution)
+        sketch.seconds, sketch.min, sketch.max = seconds, low, high
+        flat = struct.unpack('<%di' %(len(data) // 4), data)
+        sketch.bins = dict(zip(flat[0::2], flat[1::2]))
+        return sketch
+
+## Create the sketches table, building it from the existing history if it is
+#  new or holds sketches counting readings rather than time
+#
+#  @param conn the database connection to use
+def create_table(conn):
+    columns = [column[1] for column in conn.execute('pragma table_info(sketches)')]
+    if 'count' in columns:
+        logger.info("rebuilding the sketches weighted by time")
+        with conn:
+            conn.execute('drop table sketches')
+    conn.execute('create table if not exists sketches (tank INT NOT NULL, sensor INT NOT NULL, day INT NOT NULL, '
+                 'seconds INT, min REAL, max REAL, bins BLOB, primary key (tank, sensor, day)) without rowid')
+    if 'seconds' not in columns:
+        for tank in [row[0] for row in conn.execute('select distinct tank from readings')]:
+            rebuild(conn, tank=tank)
+
+## Load one stored day's sketch
+#
+#  @param conn the database connection to use
+#  @param tank the tank
+#  @param name the sensor's name
+#  @param day the start of the day
+#  @return the Sketch, empty if none is stored
+def _load(conn, tank, name, day):
+    row = conn.execute('select seconds, min, max, bins from sketches where tank=? and sensor=? and day=?',
+                       (tank, sensors.sensor_id(conn, name), day)).fetchone()
+    return Sketch(resolutions[name]) if row is None else Sketch.decode(resolutions[name], *row)
+
+## Store one day's sketch
+#
+#  @param conn the database connection to use
+#  @param tank the tank
+#  @param name the sensor's name
+#  @param day the start of the day
+#  @param sketch the Sketch
+def _store(conn, tank, name, day, sketch):
+    conn.execute('insert or replace into sketches values (?, ?, ?, ?, ?, ?, ?)',
+                 (tank, sensors.sensor_id(conn, name), day, sketch.seconds, sketch.min, sketch.max,
+                  sketch.encode()))
+
+## The latest reading of a sensor before a time, within config.gap_threshold
+#
+#  @param conn the database connection to use
+#  @param tank the tank
+#  @param name the sensor's name
+#  @param when the time
+#  @return the (time, value) tuple, or None if there is none
+def _previous(conn, tank, name, when):
+    start = when - config.gap_threshold
+    found = list(partitions.query(conn, 'select time, value from readings where tank=? and sensor=? and time >= ? '
+                                        'and time < ? and value is not null order by time desc limit 1',
+                                  (tank, sensors.sensor_id(conn, name), start, when), start, when, tank))
+    return max(found) if found else None
+
+## Add one sensor's stored readings to the sketches of their days
+#
+#  The readings are weighted and binned a whole batch at a time with numpy:
+#  each stretch from one reading to the next is expanded into the bins its
+#  line crosses, and the weights summed by day and bin, with the start of
+#  each day found once rather than for each reading.
+#
+#  @param conn the database connection to use, within the caller's transaction
+#  @param tank the tank
+#  @param name the sensor's name
+#  @param points a list of (time, value) tuples in time order
+#  @param previous the (time, value) of the reading before them, or None
+def _record_series(conn, tank, name, points, previous):
+    import numpy as np
+    resolution = resolutions[name]
+    t = np.array([p[0] for p in points], dtype=float)
+    v = np.array([p[1] for p in points], dtype=float)
+    pt, pv = np.empty_like(t), np.empty_like(v)
+    pt[1:], pv[1:] = t[:-1], v[:-1]
+    pt[0], pv[0] = previous if previous is not None else points[0]
+    # a reading with none before it within the gap threshold adds no weight
+    broken = t - pt > config.gap_threshold
+    pt[broken], pv[broken] = t[broken], v[broken]
+    seconds = (t - pt).astype(np.int64)
+    low, high = np.minimum(pv, v), np.maximum(pv, v)
+    starts = [summaries.period_start('day', t[0])]
+    while summaries.next_start('day', starts[-1]) <= t[-1]:
+        starts.append(summaries.next_start('day', starts[-1]))
+    day = np.searchsorted(np.array(starts, dtype=float), t, side='right') - 1
+    firsts = np.flatnonzero(np.r_[True, day[1:] != day[:-1]])
+    # each weighted stretch is spread over the bins from its low to its high
+    # value in proportion to the length of its line each holds
+    w = np.flatnonzero(seconds > 0)
+    first = np.rint(low[w] / resolution).astype(np.int64)
+    last = np.rint(high[w] / resolution).astype(np.int64)
+    spans = last - first + 1
+    segment = np.repeat(np.arange(len(w)), spans)
+    opening = np.cumsum(spans) - spans
+    b = first[segment] + np.arange(len(segment)) - opening[segment]
+    s, lo, hi = seconds[w][segment], low[w][segment], high[w][segment]
+    inner = b < last[segment]
+    top = np.where(inner, (b + 0.5) * resolution, hi)
+    upto = np.where(inner, np.rint(s * (top - lo) / np.where(hi > lo, hi - lo, 1.0)), s).astype(np.int64)
+    allotted = np.diff(np.r_[0, upto])
+    allotted[opening] = upto[opening]
+    kept = allotted > 0
+    bins = {}
+    if kept.any():
+        # the weights are summed over a single key of the day and the bin
+        base = b[kept].min()
+        width = b[kept].max() - base + 1
+        keys, where = np.unique(day[w][segment][kept] * width + b[kept] - base, return_inverse=True)
+        weights = np.rint(np.bincount(where, allotted[kept])).astype(np.int64)
+        for key, n in zip(keys.tolist(), weights.tolist()):
+            bins.setdefault(key // width, {})[int(key % width + base)] = n
+    for d, total, lowest, highest in zip(day[firsts].tolist(), np.add.reduceat(seconds, firsts).tolist(),
+                                         np.minimum.reduceat(low, firsts).tolist(),
+                                         np.maximum.reduceat(high, firsts).tolist()):
+        sketch = Sketch(resolution)
+        sketch.seconds, sketch.min, sketch.max, sketch.bins = total, lowest, highest, bins.get(d, {})
+        stored = _load(conn, tank, name, starts[d])
+        stored.merge(sketch)
+        _store(conn, tank, name, starts[d], stored)
+
+## Add stored readings to the sketches of their days
+#
+#  Each is weighted by the time since the sensor's previous reading, be it
+#  among the samples or already stored, so the samples should be the newest of
+#  their sensors.  Readings of sensors without a resolution, and empty
+#  readings, are ignored.
+#
+#  @param conn the database connection to use, within the caller's transaction
+#  @param samples an iterable of (sensor name, time, value) tuples
+#  @param tank the tank they are from
+def record(conn, samples, tank=sensors.local_tank):
+    series = {}
+    for name, when, value in samples:
+        if value is not None and name in resolutions:
+            series.setdefault(name, []).append((when, value))
+    for name, points in sorted(series.items()):
+        points.sort()
+        _record_series(conn, tank, name, points, _previous(conn, tank, name, points[0][0]))
+
+## Add stored measurements to the sketches of their days
+#
+#  @param conn the database connection to use, within the caller's transaction
+#  @param rows a list of (time, temp, ph, ph_raw) tuples
+#  @param tank the tank they are from
+def record_measurements(conn, rows, tank=sensors.local_tank):
+    record(conn, [(name, row[0], row[i]) for row in rows for name, i in (('temperature', 1), ('ph', 2))], tank)
+
+## Rebuild the sketches of the days overlapping a time range from the readings
+#
+#  The days up to config.gap_threshold after the range are rebuilt too, as the
+#  weight of their first readings may have changed.  The readings are read
+#  rebuild_rows at a time, so however long the range only a chunk of it is
+#  held in memory.
+#
+#  @param conn the database connection to use
+#  @param start the start of the range
+#  @param end the end of the range (exclusive), defaults to the end of time
+#  @param names the sensors to rebuild, defaults to every sketched sensor
+#  @param tank the tank
+def rebuild(conn, start=0, end=None, names=None, tank=sensors.local_tank):
+    first = summaries.period_start('day', start) if start > 0 else 0
+    last = summaries.next_start('day', summaries.period_start('day', end - 1 + config.gap_threshold)) \
+           if end is not None else float('inf')
+    with conn:
+        for name in sorted(resolutions) if names is None else names:
+            sensor = sensors.sensor_id(conn, name)
+            conn.execute('delete from sketches where tank=? and sensor=? and day >= ? and day < ?',
+                         (tank, sensor, first, last))
+            points = partitions.ordered_query(conn, 'select time, value from readings where tank=? and sensor=? '
+                                                    'and time >= ? and time < ? and value is not null order by time',
+                                              (tank, sensor, first, last), first, last, tank)
+            chunk = list(itertools.islice(points, rebuild_rows))
+            previous = _previous(conn, tank, name, chunk[0][0]) if chunk else None
+            while chunk:
+                _record_series(conn, tank, name, chunk, previous)
+                previous = chunk[-1]
+                chunk = list(itertools.islice(points, rebuild_rows))
+    logger.info("rebuilt the sketches of tank %d from %r to %r" %(tank, first, last))
+
+## Combine the sketches of the days within a time range
+#
+#  @param conn the database connection to use
+#  @param name the sensor's name
+#  @param start the start of the range, from which whole days are included
+#  @param end the end of the range (exclusive)
+#  @param tank the tank
+#  @return the merged Sketch
+def combine(conn, name, start, end, tank=sensors.local_tank):
+    merged = Sketch(resolutions[name])
+    for row in conn.execute('select seconds, min, max, bins from sketches where tank=? and sensor=? '
+                            'and day >= ? and day < ?',
+                            (tank, sensors.sensor_id(conn, name), summaries.period_start('day', start), end)):
+        merged.merge(Sketch.decode(resolutions[name], *row))
+    return merged
@@ -0,0 +1,283 @@
+## @package status_site
+#  A static HTML status site, rebuilt incrementally
+#
+#  Writes the tank's status as plain HTML files into config.site_directory,
+#  for any web server (or a browser pointed at the directory) to show:
+#
+#  Page                     | Contents
+#  ------------------------ | ------------------------------------------------
+#  index.html               | the latest reading, the recent alerts and links to the other pages
+#  alerts.html              | the history of alerts (see ::alerts)
+#  day/YYYY-MM-DD.html      | the chart, summaries, distribution and gaps of one day
+#  week/YYYY-MM-DD.html     | the same for the week starting on the date
+#  month/YYYY-MM.html       | the same for one month
+#
+#  with each period page's chart alongside it as an SVG file.  Pages are
+#  built for the most recent periods of each length (see periods);  older ones
+#  are left as they are.
+#
+#  Building every page each time would mean rendering dozens of charts a
+#  minute, so the site is rebuilt incrementally.  Each page is written along
+#  with a fingerprint of what it shows, kept in the site_pages table, and is
+#  only rewritten when its fingerprint changes.  A period page's fingerprint
+#  is its stored ::summaries::Summary, which costs one lookup to read for a
+#  finished period and changes whenever the period's readings do, a
+#  ::backfill or ::calibration included.  Pages of periods still in progress
+#  change with every reading, so they are rebuilt at most once per refresh
+#  interval.  A build with no new readings writes nothing at all.
+#
+#  The site is built by build every config.site_interval seconds, on a
+#  supervised task of its own, when config.site_directory is set, or can be
+#  built from cron:
+#
+#      python status_site.py [--database fishtank.db] [--directory www]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import time
+import html
+import config
+import alerts
+import gaps
+import summaries
+import notifications
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The periods pages are built for, and how many of the most recent of each
+periods = [('day', 14), ('week', 8), ('month', 12)]
+
+## Seconds a page of a period still in progress is kept before being rebuilt
+#  for newer readings
+refresh = { 'day': 5*60, 'week': 60*60, 'month': 6*60*60 }
+
+## How each period's pages are named
+name_formats = { 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m' }
+
+## How each period's pages are titled
+title_formats = { 'day': '%A %Y-%m-%d', 'week': 'week of %Y-%m-%d', 'month': '%B %Y' }
+
+## The most alerts listed on the alert history page
+alerts_listed = 100
+
+## The most alerts listed on the index
+index_alerts_listed = 10
+
+_template = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>%(title)s</title>
+<style>
+body { font-family: Arial, sans-serif; margin: 2em; }
+table { border-collapse: collapse; }
+td, th { padding: 0.2em 0.8em; text-align: left; }
+.unsafe { color: #c00; font-weight: bold; }
+</style>
+</head>
+<body>
+<h1>%(title)s</h1>
+%(body)s
+<p><small>Built %(built)s</small></p>
+</body>
+</html>
+'''
+
+## Create the table of the pages built and their fingerprints
+#
+#  @param conn the database connection to use
+def create_table(conn):
+    conn.execute('create table if not exists site_pages (page TEXT PRIMARY KEY, fingerprint TEXT, built REAL)')
+
+## Format a time for display
+#
+#  @param t the time in seconds since the epoch
+#  @return the text
+def _when(t):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(t))
+
+## Builds the site into a directory
+class StatusSite:
+
+    ## The constructor
+    #
+    #  @param directory the directory to write the site into
+    def __init__(self, directory):
+        self.directory = directory
+
+    ## Determine whether a page needs to be written
+    #
+    #  @param conn the database connection to use
+    #  @param page the page's path within the site
+    #  @param fingerprint the fingerprint of what the page would show
+    #  @param now the current time
+    #  @param wait seconds since the page was last written before it is
+    #         rewritten for a changed fingerprint
+    #  @return True, if the page is missing or out of date
+    def _stale(self, conn, page, fingerprint, now, wait=0):
+        row = conn.execute('select fingerprint, built from site_pages where page=?', (page,)).fetchone()
+        if row is None or not os.path.exists(os.path.join(self.directory, page)):
+            return True
+        return row[0] != fingerprint and now - row[1] >= wait
+
+    ## Write a file of the site, replacing any old one in a single step
+    #
+    #  @param page the file's path within the site
+    #  @param content the text or bytes to write
+    def _write(self, page, content):
+        path = os.path.join(self.directory, page)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content.encode('utf-8') if isinstance(content, str) else content)
+        os.rename(path + '.tmp', path)
+
+    ## Write a page and record its fingerprint
+    #
+    #  @param conn the database connection to use
+    #  @param page the page's path within the site
+    #  @param fingerprint the fingerprint of what the page shows
+    #  @param title the page's title
+    #  @param body the page's HTML body
+    #  @param now the current time
+    def _publish(self, conn, page, fingerprint, title, body, now):
+        self._write(page, _template %{ 'title': html.escape(title), 'body': body, 'built': _when(now) })
+        with conn:
+            conn.execute('insert or replace into site_pages values (?, ?, ?)', (page, fingerprint, now))
+
+    ## Render a chart to an SVG file of the site
+    #
+    #  @param pairs a list of (label, [(time, value), ...]) series to plot
+    #  @param page the file's path within the site
+    #  @return True, if there was anything to chart
+    def _render_chart(self, pairs, page):
+        chart = notifications.NotifyInformationalReports._chart(pairs)
+        if chart is None:
+            return False
+        self._write(page, chart.render())
+        return True
+
+    ## Build the page of one period, if it has changed
+    #
+    #  @param conn the database connection to use
+    #  @param period the length of the period, one of the keys of refresh
+    #  @param start the start of the period
+    #  @param now the current time
+    #  @return a tuple of the page's path within the site, or None if the
+    #          period has no readings, and whether it was written
+    def _period_page(self, conn, period, start, now):
+        end = summaries.next_start(period, start)
+        s = summaries.summary(conn, period, start, now)
+        if not s.count:
+            return None, False
+        name = '%s/%s' %(period, time.strftime(name_formats[period], time.localtime(start)))
+        fingerprint = repr((s.count, s.temp_min, s.temp_max, s.temp_sum, s.ph_min, s.ph_max, s.ph_sum))
+        if not self._stale(conn, name + '.html', fingerprint, now, 0 if end <= now else refresh[period]):
+            return name + '.html', False
+        report = notifications.NotifyInformationalReports(period)
+        last = min(end, now + 1)
+        history = summaries.children(conn, report.report_layout[period][0], start, last, now)
+        body = '<p><a href="../index.html">Latest</a></p>\n'
+        if self._render_chart(report._chart_series(conn, start, last), name + '.svg'):
+            body += '<p><img src="%s.svg" alt="chart"></p>\n' %os.path.basename(name)
+        text = report._summary_text(history) + report._distribution_text(conn, start, last) + \
+               report._outage_text(gaps.find(conn, start, last))
+        body += '<pre>%s</pre>\n' %html.escape(text)
+        self._publish(conn, name + '.html', fingerprint, 'Fishtank ' + time.strftime(title_formats[period],
+                      time.localtime(start)), body, now)
+        return name + '.html', True
+
+    ## Tabulate alerts
+    #
+    #  @param rows the alerts as returned by ::alerts::recent
+    #  @return the HTML table
+    @staticmethod
+    def _alert_table(rows):
+        lines = ['<table>', '<tr><th>Sent</th><th>Alert</th><th>Seen</th><th>From</th><th>To</th></tr>']
+        for sent, tank, sensor, condition, count, first, last, value, worst in rows:
+            text = 'tank %d ' %tank + alerts.descriptions[condition] %(sensor, value)
+            lines.append('<tr><td>%s</td><td>%s</td><td>%d</td><td>%s</td><td>%s</td></tr>'
+                         %(_when(sent), html.escape(text), count, _when(first), _when(last)))
+        lines.append('</table>')
+        return '\n'.join(lines) + '\n'
+
+    ## Describe the latest reading
+    #
+    #  @param latest a tuple of the (time, temperature, ph) of the reading
+    #  @return the HTML
+    @staticmethod
+    def _latest_html(latest):
+        cells = []
+        for label, name, value in [('Temperature', 'temperature', latest[1]), ('PH', 'ph', latest[2])]:
+            if value is not None:
+                low, high = notifications.NotifyWarnings.limits[name]
+                unsafe = ' class="unsafe"' if value < low or value > high else ''
+                cells.append('<tr><th>%s</th><td%s>%.2f</td></tr>' %(label, unsafe, value))
+        return '<p>Latest reading at %s</p>\n<table>\n%s\n</table>\n' %(_when(latest[0]), '\n'.join(cells))
+
+    ## Build the pages of the site which have changed
+    #
+    #  @param conn the database connection to use
+    #  @param now the current time, defaults to time.time()
+    #  @return the number of pages written
+    def build(self, conn, now=None):
+        now = time.time() if now is None else now
+        written = 0
+        links = []
+        for period, count in periods:
+            start = summaries.period_start(period, now)
+            pages = []
+            for i in range(count):
+                page, wrote = self._period_page(conn, period, start, now)
+                written += wrote
+                if page is not None:
+                    pages.append('<a href="%s">%s</a>' %(page, time.strftime(name_formats[period],
+                                                                            time.localtime(start))))
+                start = summaries.previous_start(period, start)
+            if pages:
+                links.append('<p>%s:  %s</p>' %(notifications.NotifyInformationalReports.adjectives[period],
+                                                ' | '.join(pages)))
+        recent = alerts.recent(conn, alerts_listed)
+        fingerprint = repr(recent[:1])
+        if self._stale(conn, 'alerts.html', fingerprint, now):
+            body = '<p><a href="index.html">Latest</a></p>\n' + self._alert_table(recent)
+            self._publish(conn, 'alerts.html', fingerprint, 'Fishtank alerts', body, now)
+            written += 1
+        latest = conn.execute('select time, temp, ph from measurements order by time desc limit 1').fetchone()
+        fingerprint = repr((latest, recent[:1], links))
+        if self._stale(conn, 'index.html', fingerprint, now):
+            body = '<p>No readings yet</p>\n' if latest is None else self._latest_html(latest)
+            body += '\n'.join(links) + '\n<h2>Recent alerts</h2>\n' + self._alert_table(recent[:index_alerts_listed])
+            body += '<p><a href="alerts.html">All alerts</a></p>\n'
+            self._publish(conn, 'index.html', fingerprint, 'Fishtank status', body, now)
+            written += 1
+        logger.info("built the status site in %s, %d pages written" %(self.directory, written))
+        return written
+
+## The most seconds a build is expected to take, beyond the site interval,
+#  before the task building the site is taken to have hung
+build_timeout = 5*60
+
+## Build the configured site, if there is one
+#
+#  @param conn the database connection to use
+#  @return the number of pages written
+def build(conn):
+    if not config.site_directory:
+        return 0
+    return StatusSite(config.site_directory).build(conn)
+
+if __name__ == "__main__":
+    import argparse
+    import fishtank_monitor
+    config.read_config()
+    parser = argparse.ArgumentParser(description='Build the fishtank status site')
+    parser.add_argument('--database', default=fishtank_monitor.database_filename)
+    parser.add_argument('--directory', default=config.site_directory or 'www')
+    args = parser.parse_args()
+    conn = fishtank_monitor.open_database(args.database)
+    print("%d pages written" %StatusSite(args.directory).build(conn))
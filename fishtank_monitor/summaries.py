@@ -0,0 +1,217 @@
+## @package summaries
+#  Persisted per-period summaries of the measurements
+#
+#  Reports covering long periods are built from summaries rather than from the
+#  raw measurements.  A summary holds the count, minimum, maximum and sum of
+#  the temperature and ph over one calendar period (in local time).  Periods
+#  form a hierarchy, each summarised from the one below it:
+#
+#  Period | Summarised from
+#  ------ | ---------------
+#  hour   | the measurements
+#  day    | hours
+#  week   | days (weeks start on Monday)
+#  month  | days
+#  year   | months
+#
+#  Once a period is over its summary is computed once and stored in the
+#  summaries table, so a yearly report only has to combine twelve stored
+#  monthly summaries with the summary of the current, partial, month.
+#
+#  Summaries are always computed from the measurements stored, so they are the
+#  same however often they are recomputed.  With ::compression, that means the
+#  count is of the measurements kept, and the mean is of those alone, which
+#  leans towards the times of change;  the ::sketches weight each reading by
+#  time, and are the better guide to what was typical.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import time
+import datetime
+import sensors
+import partitions
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## The period each period is summarised from, None meaning the measurements
+child_period = { 'hour': None, 'day': 'hour', 'week': 'day', 'month': 'day', 'year': 'month' }
+
+## Seconds after a period ends before its summary is considered final, giving
+#  readings still in the reading log time to reach the database
+settle_time = 5*60
+
+## Find the start of the period containing a time
+#
+#  @param period one of the keys of child_period
+#  @param t the time in seconds since the epoch
+#  @return the start of the period in seconds since the epoch
+def period_start(period, t):
+    d = datetime.datetime.fromtimestamp(t)
+    if period == 'hour':
+        d = d.replace(minute=0, second=0, microsecond=0)
+    elif period == 'day':
+        d = d.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif period == 'week':
+        d = d.replace(hour=0, minute=0, second=0, microsecond=0) - datetime.timedelta(days=d.weekday())
+    elif period == 'month':
+        d = d.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif period == 'year':
+        d = d.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        raise ValueError('unknown summary period:  %r' %period)
+    return int(time.mktime(d.timetuple()))
+
+## Find the start of the period following the one starting at start
+#
+#  @param period one of the keys of child_period
+#  @param start the start of a period
+#  @return the start of the next period
+def next_start(period, start):
+    if period == 'hour':
+        return start + 60*60
+    d = datetime.datetime.fromtimestamp(start)
+    if period == 'day':
+        d = d + datetime.timedelta(days=1)
+    elif period == 'week':
+        d = d + datetime.timedelta(days=7)
+    elif period == 'month':
+        d = d.replace(year=d.year + d.month//12, month=d.month % 12 + 1)
+    elif period == 'year':
+        d = d.replace(year=d.year + 1)
+    return period_start(period, time.mktime(d.timetuple()) + 60*60)
+
+## Find the start of the period preceding the one starting at start
+#
+#  @param period one of the keys of child_period
+#  @param start the start of a period
+#  @return the start of the previous period
+def previous_start(period, start):
+    return period_start(period, start - 1)
+
+## A summary of the measurements over one period
+class Summary:
+
+    ## The constructor
+    #
+    #  @param start the start of the period
+    #  @param end the end of the period (exclusive)
+    #  @param count the number of measurements
+    #  @param temp a tuple of the (minimum, maximum, sum) temperature
+    #  @param ph a tuple of the (minimum, maximum, sum) ph
+    def __init__(self, start, end, count=0, temp=(None, None, 0.0), ph=(None, None, 0.0)):
+        self.start = start
+        self.end = end
+        self.count = count
+        self.temp_min, self.temp_max, self.temp_sum = temp
+        self.ph_min, self.ph_max, self.ph_sum = ph
+
+    ## The mean temperature, or None if there were no measurements
+    @property
+    def temp_mean(self):
+        return self.temp_sum / self.count if self.count else None
+
+    ## The mean ph, or None if there were no measurements
+    @property
+    def ph_mean(self):
+        return self.ph_sum / self.count if self.count else None
+
+    ## Combine summaries of consecutive periods into one covering them all
+    #
+    #  @param summaries the summaries to combine, oldest first
+    #  @return the combined Summary
+    @staticmethod
+    def merge(summaries):
+        merged = Summary(summaries[0].start, summaries[-1].end)
+        for s in summaries:
+            if not s.count:
+                continue
+            merged.count += s.count
+            merged.temp_sum += s.temp_sum
+            merged.ph_sum += s.ph_sum
+            merged.temp_min = s.temp_min if merged.temp_min is None else min(merged.temp_min, s.temp_min)
+            merged.temp_max = s.temp_max if merged.temp_max is None else max(merged.temp_max, s.temp_max)
+            merged.ph_min = s.ph_min if merged.ph_min is None else min(merged.ph_min, s.ph_min)
+            merged.ph_max = s.ph_max if merged.ph_max is None else max(merged.ph_max, s.ph_max)
+        return merged
+
+## Summarise a period directly from the measurements
+#
+#  @param conn the database connection to use
+#  @param start the start of the period
+#  @param end the end of the period (exclusive)
+#  @return the Summary
+def _summarise_measurements(conn, start, end):
+    query = 'select count(*), min(value), max(value), total(value) from readings ' \
+            'where tank=? and sensor=? and time >= ? and time < ?'
+    totals = []
+    for sensor in (sensors.TEMPERATURE, sensors.PH):
+        # the period may span archived partitions as well as the database
+        count, low, high, total = 0, None, None, 0.0
+        for c, l, h, t in partitions.query(conn, query, (sensors.local_tank, sensor, start, end), start, end):
+            count += c
+            total += t
+            if l is not None:
+                low = l if low is None else min(low, l)
+                high = h if high is None else max(high, h)
+        totals.append((count, (low, high, total)))
+    return Summary(start, end, totals[0][0], totals[0][1], totals[1][1])
+
+## Get the summary of one period, computing and storing it if need be
+#
+#  @param conn the database connection to use
+#  @param period one of the keys of child_period
+#  @param start the start of the period
+#  @param now the current time, defaults to time.time()
+#  @return the Summary
+def summary(conn, period, start, now=None):
+    now = time.time() if now is None else now
+    end = next_start(period, start)
+    row = conn.execute('select count, temp_min, temp_max, temp_sum, ph_min, ph_max, ph_sum '
+                       'from summaries where period=? and start=?', (period, start)).fetchone()
+    if row is not None:
+        return Summary(start, end, row[0], row[1:4], row[4:7])
+    child = child_period[period]
+    if child is None:
+        s = _summarise_measurements(conn, start, end)
+    else:
+        s = Summary.merge(children(conn, child, start, end, now))
+    if end + settle_time <= now:
+        conn.execute('insert or replace into summaries values (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (period, start, s.count, s.temp_min, s.temp_max, s.temp_sum, s.ph_min, s.ph_max, s.ph_sum))
+        conn.commit()
+    return s
+
+## Get the summaries of consecutive periods covering a span of time
+#
+#  @param conn the database connection to use
+#  @param period one of the keys of child_period
+#  @param start the start of the first period
+#  @param end the time at which to stop
+#  @param now the current time, defaults to time.time()
+#  @return a list of Summary objects, oldest first, the last possibly partial
+def children(conn, period, start, end, now=None):
+    result = []
+    while start < end:
+        result.append(summary(conn, period, start, now))
+        start = next_start(period, start)
+    return result
+
+## Forget the stored summaries overlapping a span of time
+#
+#  To be called when measurements are added to or changed in periods already
+#  summarised, for example by a backfill or a calibration change.
+#
+#  @param conn the database connection to use
+#  @param start the start of the span
+#  @param end the end of the span (exclusive), defaults to the end of time
+def invalidate(conn, start=0, end=None):
+    for period in child_period:
+        first = period_start(period, start) if start > 0 else 0
+        if end is None:
+            conn.execute('delete from summaries where period=? and start>=?', (period, first))
+        else:
+            conn.execute('delete from summaries where period=? and start>=? and start<?', (period, first, end))
+    conn.commit()
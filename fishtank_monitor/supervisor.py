@@ -0,0 +1,229 @@
+## @package supervisor
+#  Health checking and automatic restart of the fishtank monitor's components
+#
+#  Every long-running part of the fishtank monitor (the serial reader, the light
+#  scheduler, the measurement writer and the notifiers) is a thread exposing
+#  is_alive, a last_heartbeat timestamp and a shutdown method.  The Supervisor
+#  owns one Component per such thread.  A component is unhealthy when its
+#  thread has died or its heartbeat has gone stale, in which case the
+#  Supervisor shuts it down and rebuilds it from its factory, backing off
+#  exponentially while the rebuild keeps failing (say, because the serial
+#  device has not reappeared yet after a USB glitch).  The time from failure
+#  detection to the component being healthy again is recorded so that
+#  recovery times can be reported.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import threading
+import time
+from log import get_logger
+
+logger = get_logger(__name__)
+
+## A periodic job run in its own thread
+#
+#  The function is called every interval seconds until shutdown is called.
+#  Exceptions raised by the function are logged and end the thread, leaving
+#  it to the Supervisor to restart it.
+class PeriodicTask(threading.Thread):
+
+    ## The constructor creates the thread but does not start it
+    #
+    #  @param name the name of the task, used in logs
+    #  @param function the callable to run each period
+    #  @param interval the number of seconds between calls
+    def __init__(self, name, function, interval):
+        super().__init__(name=name)
+        self.function = function
+        self.interval = interval
+        self.last_heartbeat = time.time()
+        self._stopped = threading.Event()
+        self.daemon = True
+
+    ## Ask the task to stop at the end of its current period
+    def shutdown(self):
+        self._stopped.set()
+
+    ## The thread's run method - calls the function each period
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                self.last_heartbeat = time.time()
+                self.function()
+                self._stopped.wait(self.interval)
+        except Exception as e:
+            logger.exception("exception encountered in task %s:  %r" %(self.name, e))
+            raise
+
+## A supervised component of the system
+#
+#  Wraps the factory used to build (and start) the component's thread along
+#  with its restart bookkeeping.
+class Component:
+
+    ## The constructor
+    #
+    #  @param name the name of the component, used in logs and metrics
+    #  @param factory a callable returning a newly started component thread
+    #  @param heartbeat_timeout seconds without a heartbeat after which the
+    #         component is considered hung, or None to only check is_alive
+    def __init__(self, name, factory, heartbeat_timeout=None):
+        self.name = name
+        self.factory = factory
+        self.heartbeat_timeout = heartbeat_timeout
+        self.instance = None
+        self.failures = 0
+        self.restarts = 0
+        self.backoff = 0
+        self.next_restart = 0
+        self.failed_at = None
+        ## The running count, total, longest and latest of the times taken to
+        #  recover, kept rather than every time so the supervisor's memory
+        #  stays fixed however long it runs
+        self.recoveries = 0
+        self.total_recovery_time = 0
+        self.max_recovery_time = None
+        self.last_recovery_time = None
+
+    ## Record the time taken to recover from a failure
+    #
+    #  @param seconds the time from the failure being detected to the
+    #         component being healthy again
+    def recovered(self, seconds):
+        self.recoveries += 1
+        self.total_recovery_time += seconds
+        self.max_recovery_time = seconds if self.max_recovery_time is None else max(self.max_recovery_time, seconds)
+        self.last_recovery_time = seconds
+
+    ## Determine whether the component is running and heartbeating
+    #
+    #  @param now the current time
+    #  @return True, if the component is healthy
+    def is_healthy(self, now):
+        instance = self.instance
+        if instance is None or not instance.is_alive():
+            return False
+        if self.heartbeat_timeout is not None and \
+           now - getattr(instance, 'last_heartbeat', now) > self.heartbeat_timeout:
+            return False
+        return True
+
+## Owns the system's components and keeps them running
+class Supervisor:
+
+    ## The constructor
+    #
+    #  @param components the list of Component objects to supervise
+    #  @param initial_backoff seconds to wait before the second restart attempt
+    #  @param max_backoff the upper bound on the wait between restart attempts
+    #  @param check_interval seconds between health checks in run
+    def __init__(self, components, initial_backoff=1, max_backoff=300, check_interval=1):
+        self.components = components
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self._stopped = threading.Event()
+
+    ## Look up a component by name
+    #
+    #  @param name the name of the component
+    #  @return the Component object
+    def __getitem__(self, name):
+        for c in self.components:
+            if c.name == name:
+                return c
+        raise KeyError(name)
+
+    ## Start any component not yet started, then check and restart them all
+    #
+    #  This is a single pass over the components;  run calls it repeatedly.
+    #  The first restart after a failure is immediate, later attempts back off.
+    #
+    #  @param now the current time, defaults to time.time()
+    def check(self, now=None):
+        now = time.time() if now is None else now
+        for c in self.components:
+            if c.is_healthy(now):
+                if c.failed_at is not None:
+                    c.recovered(now - c.failed_at)
+                    logger.info("component %s recovered after %.1f seconds" %(c.name, now - c.failed_at))
+                    c.failed_at = None
+                    c.backoff = 0
+                continue
+            if c.failed_at is None and c.instance is not None:
+                c.failed_at = now
+                c.failures += 1
+                logger.error("component %s is unhealthy, restarting" %c.name)
+                self._shutdown(c)
+            if now >= c.next_restart:
+                self._restart(c, now)
+
+    ## Stop a component's thread, tolerating failures since it is already broken
+    #
+    #  @param c the Component to stop
+    @staticmethod
+    def _shutdown(c):
+        try:
+            c.instance.shutdown()
+        except Exception as e:
+            logger.exception("exception encountered shutting down %s:  %r" %(c.name, e))
+        c.instance = None
+
+    ## Attempt to rebuild a component, scheduling the next attempt on failure
+    #
+    #  @param c the Component to restart
+    #  @param now the current time
+    def _restart(self, c, now):
+        if c.instance is not None:
+            self._shutdown(c)
+        c.backoff = min(self.max_backoff, c.backoff * 2) if c.backoff else self.initial_backoff
+        c.next_restart = now + c.backoff
+        try:
+            logger.info("starting component %s" %c.name)
+            c.instance = c.factory()
+            c.restarts += 1
+        except Exception as e:
+            logger.exception("could not start %s, next attempt in %r seconds:  %r" %(c.name, c.backoff, e))
+
+    ## Report the health and recovery statistics of every component
+    #
+    #  @param now the current time, defaults to time.time()
+    #  @return a dict of per-component dicts of metrics, keyed by component name
+    def metrics(self, now=None):
+        now = time.time() if now is None else now
+        m = {}
+        for c in self.components:
+            heartbeat = getattr(c.instance, 'last_heartbeat', None)
+            m[c.name] = {
+                'healthy': c.is_healthy(now),
+                'failures': c.failures,
+                'starts': c.restarts,
+                'heartbeat_age': now - heartbeat if heartbeat is not None else None,
+                'down_for': now - c.failed_at if c.failed_at is not None else 0,
+                'recoveries': c.recoveries,
+                'last_recovery_time': c.last_recovery_time,
+                'max_recovery_time': c.max_recovery_time,
+                'mean_recovery_time': c.total_recovery_time/c.recoveries if c.recoveries else None,
+            }
+        return m
+
+    ## Supervise the components until stop is called
+    #
+    #  @param metrics_interval seconds between logging of the metrics
+    def run(self, metrics_interval=60*60):
+        last_logged = 0
+        while not self._stopped.is_set():
+            self.check()
+            if time.time() - last_logged > metrics_interval:
+                last_logged = time.time()
+                logger.info("supervisor metrics:  %r" %self.metrics())
+            self._stopped.wait(self.check_interval)
+
+    ## Stop supervising and shut down every component
+    def stop(self):
+        self._stopped.set()
+        for c in self.components:
+            if c.instance is not None:
+                self._shutdown(c)
@@ -8,11 +8,46 @@
 import sys
 import os
 import unittest
+import subprocess
+import tempfile
+import shutil
 import fishtank_monitor as ftm
 import config
+import log
 import notifications
 import serial_monitor
 import scheduler
+import supervisor
+import reading_log
+import processes
+import calibration
+import summaries
+import downsample
+import export
+import backfill
+import sensors
+import notifier_pool
+import channels
+import alerts
+import query_cache
+import forecast
+import filters
+import gaps
+import partitions
+import sketches
+import backtest
+import status_site
+import collector
+import compression
+import stub_servers
+import io
+import struct
+import zlib
+import math
+import gzip
+import json
+import sqlite3
+import multiprocessing
 import threading
 import time
 import datetime
@@ -39,26 +74,68 @@ class FakeSerial():
         except:
             return b''
 
+    ## Read mock method
+    #
+    #  Reads from the same fake serial output as readline, a byte at a time if
+    #  need be, as when receiving binary frames
+    #  @param size the number of bytes to read
+    #  @return up to size bytes of the fake serial output
+    def read(self, size=1):
+        data = b''
+        while len(data) < size and self.lines:
+            take = size - len(data)
+            data += self.lines[0][:take]
+            self.lines = ([self.lines[0][take:]] if self.lines[0][take:] else []) + self.lines[1:]
+        return data
+
     @staticmethod
     def writelines(_):
         pass
 
+## Helper class standing in for a supervised component thread
+class FakeComponent():
+
+    def __init__(self):
+        self.alive = True
+        self.last_heartbeat = time.time()
+
+    def is_alive(self):
+        return self.alive
+
+    def shutdown(self):
+        self.alive = False
+
 SLEEP_INT = 0.25
 
+## The longest to wait for the monitor to publish a reading, which it
+#  normally does at once
+READING_TIMEOUT = 5
+
+## Child process helper putting readings on a shared queue and publishing the last
+def put_readings(heartbeat, queue, latest):
+    for i in range(5):
+        queue.put((1000 + i, [('temperature', 21.0 + i), ('ph_raw', 6.5), ('ammonia', None)]))
+    latest.publish(serial_monitor.Reading(1, time.time(), (('ph', 6.5), ('temperature', 25.0), ('ammonia', 0.25))))
+
+## Take a reading queue's lock and hang, to be killed holding it
+def hold_queue_lock(heartbeat, queue):
+    queue._acquire()
+    time.sleep(60)
+
 ## The suite of unit tests covering the python portion of the Fishtank Monitor
 class TestFishTankMonitor(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
+        log.init_logging()
         config.config_filename = './test/fishtank_monitor.cfg'
         config.read_config()
+        ftm.conn = ftm.open_database(':memory:')
 
     def setUp(self):
         self.monitor = serial_monitor.SerialMonitor(config.serial_device, {})
         self.monitor.stop = False
         notifications.time_last_warned = 0
-        self.monitor.ph = None
-        self.monitor.temperature = None
         self.monitor.ard = None
 
     ## @test Test parsing the serial json object in a perfect case
@@ -66,7 +143,7 @@ class TestFishTankMonitor(unittest.TestCase):
         lines = [b'{"temperature":21.0, "ph":6.5}']
         self.monitor.ard = FakeSerial(lines)
         self.monitor.start()
-        time.sleep(SLEEP_INT)
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
         self.assertEqual(self.monitor.ph, 6.5)
         self.assertEqual(self.monitor.temperature, 21.0)
         self.assertEqual(notifications.time_last_warned, 0)
@@ -77,7 +154,7 @@ class TestFishTankMonitor(unittest.TestCase):
         lines = [b'.0, "ph" :5.5}\n{"temperature":21.0, "ph":6.5}']
         self.monitor.ard = FakeSerial(lines)
         self.monitor.start()
-        time.sleep(SLEEP_INT)
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
         self.assertEqual(self.monitor.ph, 6.5)
         self.assertEqual(self.monitor.temperature, 21.0)
         self.assertEqual(notifications.time_last_warned, 0)
@@ -88,7 +165,7 @@ class TestFishTankMonitor(unittest.TestCase):
         lines = [b'.0, "ph":5.5}\n{"temperature":21.0, "ph":6.5}\n{"temperature":20.5, "ph":4.0']
         self.monitor.ard = FakeSerial(lines)
         self.monitor.start()
-        time.sleep(SLEEP_INT)
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
         self.assertEqual(self.monitor.ph, 6.5)
         self.assertEqual(self.monitor.temperature, 21.0)
         self.assertEqual(notifications.time_last_warned, 0)
@@ -99,7 +176,7 @@ class TestFishTankMonitor(unittest.TestCase):
         lines = [b'{"temperature":1.0, "ph":6.5}\n']
         self.monitor.ard = FakeSerial(lines)
         self.monitor.start()
-        time.sleep(SLEEP_INT)
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
         notifier = notifications.NotifyWarnings()
         notifier(ftm.conn, self.monitor)
         self.assertEqual(self.monitor.ph, 6.5)
@@ -112,7 +189,7 @@ class TestFishTankMonitor(unittest.TestCase):
         lines = [b'{"temperature":21.0, "ph":5.5}']
         self.monitor.ard = FakeSerial(lines)
         self.monitor.start()
-        time.sleep(SLEEP_INT)
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
         notifier = notifications.NotifyWarnings()
         notifier(ftm.conn, self.monitor)
         self.assertEqual(self.monitor.ph, 5.5)
@@ -147,6 +224,7 @@ class TestFishTankMonitor(unittest.TestCase):
         self.assertEqual(config.send_warnings_interval, 0)
         self.assertEqual(config.email_to_address, 'you@domain.com')
         self.assertEqual(config.email_from_address, 'pi@domain.com')
+        self.assertEqual(config.report_periods, ['day', 'week', 'month', 'year'])
         self.assertEqual(config.months_between_calibrations, 0)
         self.assertEqual(config.x10_retries, 3)
         self.assertEqual(config.x10_light_code, 'i8')
@@ -161,6 +239,8 @@ class TestFishTankMonitor(unittest.TestCase):
         self.assertEqual(config.ph_pin, 'A2')
         self.assertEqual(config.temperature_pin, 'A1')
         self.assertEqual(config.ph_offset, -0.23)
+        self.assertEqual(config.ph_slope, 1.0)
+        self.assertEqual(config.multiprocess, False)
 
     ## @test Test the time series parsing for the LightScheduler
     def test_scheduler_time_parsing(self):
@@ -216,8 +296,955 @@ class TestFishTankMonitor(unittest.TestCase):
             config.lights_on_times = old_config_on_times
             config.lights_off_times = old_config_off_times
 
+    ## @test Test that importing the application performs no I/O and does not
+    #  pull in the heavy reporting and email modules
+    def test_import_has_no_side_effects(self):
+        src_dir = os.path.dirname(os.path.abspath(ftm.__file__))
+        code = "import sys, fishtank_monitor; print('pygal' in sys.modules, 'smtplib' in sys.modules)"
+        env = dict(os.environ, PYTHONPATH=src_dir)
+        with tempfile.TemporaryDirectory() as cwd:
+            out = subprocess.check_output([sys.executable, '-c', code], cwd=cwd, env=env)
+            self.assertEqual(out.split(), [b'False', b'False'])
+            self.assertEqual(os.listdir(cwd), [])
+
+    ## @test Test the supervisor restarts a dead component, backing off while
+    #  the restart fails, and records the recovery time
+    def test_supervisor_restart(self):
+        started = []
+        failing = [False]
+        def factory():
+            if failing[0]:
+                raise IOError('no such device')
+            started.append(FakeComponent())
+            return started[-1]
+        sup = supervisor.Supervisor([supervisor.Component('fake', factory, 10)], initial_backoff=1, max_backoff=4)
+        sup.check(now=100)
+        self.assertEqual(len(started), 1)
+        started[0].alive = False
+        failing[0] = True
+        sup.check(now=101)
+        failing[0] = False
+        sup.check(now=102)
+        self.assertEqual(len(started), 1)
+        sup.check(now=103)
+        self.assertEqual(len(started), 2)
+        sup.check(now=104)
+        metrics = sup.metrics(now=104)['fake']
+        self.assertTrue(metrics['healthy'])
+        self.assertEqual(metrics['failures'], 1)
+        self.assertEqual(metrics['last_recovery_time'], 3)
+        started[1].alive = False
+        sup.check(now=110)
+        sup.check(now=111)
+        metrics = sup.metrics(now=111)['fake']
+        self.assertEqual(len(started), 3)
+        self.assertEqual((metrics['recoveries'], metrics['last_recovery_time']), (2, 1))
+        self.assertEqual((metrics['max_recovery_time'], metrics['mean_recovery_time']), (3, 2))
+
+    ## @test Test the supervisor restarts a component whose heartbeat is stale
+    def test_supervisor_stale_heartbeat(self):
+        started = []
+        def factory():
+            started.append(FakeComponent())
+            return started[-1]
+        sup = supervisor.Supervisor([supervisor.Component('fake', factory, 10)])
+        sup.check(now=100)
+        started[0].last_heartbeat = 100
+        sup.check(now=111)
+        self.assertFalse(started[0].alive)
+        self.assertEqual(len(started), 2)
+        self.assertEqual(sup.metrics(now=111)['fake']['failures'], 1)
+
+    ## @test Test binary frames round trip and corrupt frames are rejected
+    def test_frame_codec(self):
+        for message in [{'temperature': 21.5, 'ph': 6.75}, {'temperature': -3.0, 'ph': 14.0}, {'temperature': 400.0},
+                        {'log': 'hello'}]:
+            self.assertEqual(serial_monitor.decode_frame(serial_monitor.encode_frame(message)), message)
+        frame = bytearray(serial_monitor.encode_frame({'temperature': 21.5, 'ph': 6.75}))
+        frame[4] ^= 0x01
+        self.assertRaises(ValueError, serial_monitor.decode_frame, bytes(frame))
+        self.assertRaises(ValueError, serial_monitor.decode_frame, bytes(frame[:-1]))
+        self.assertRaises(ValueError, serial_monitor.encode_frame, {'conductivity': 1.0})
+        body = bytes([10, serial_monitor.FRAME_READINGS, 1, 2, 0x34, 0x08, 7, 3, 0x10, 0x27, 0x00])
+        frame = bytes([serial_monitor.FRAME_SYNC]) + body + struct.pack('>H', serial_monitor.crc16(body))
+        self.assertEqual(serial_monitor.decode_frame(frame), {'temperature': 21.0, 'sensor_7': 100.0})
+
+    ## @test Test the monitor reads binary frames without being acknowledged,
+    #  as after a restart, skips stray bytes and corrupt frames and reads JSON
+    #  lines between them
+    def test_binary_framing(self):
+        good = serial_monitor.encode_frame({'temperature': 22.25, 'ph': 6.5})
+        corrupt = good[:-1] + bytes([good[-1] ^ 0xFF])
+        self.monitor.configuration = {'framing': 'binary'}
+        self.monitor.ard = FakeSerial([b'\x00{\x13\n', serial_monitor.encode_frame({'log': 'framed'}) + corrupt + good])
+        self.monitor.start()
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
+        self.assertEqual(self.monitor.framing, 'binary')
+        self.assertEqual(self.monitor.temperature, 22.25)
+        self.assertEqual(self.monitor.ph, 6.5)
+        self.assertEqual(self.monitor.frame_errors, 1)
+        self.monitor.ard.lines.append(b'{"temperature":21.0, "ph":7.0}\n')
+        self.monitor.wait_for_reading(1, READING_TIMEOUT)
+        self.assertEqual(self.monitor.framing, 'json')
+        self.assertEqual(self.monitor.temperature, 21.0)
+        self.monitor.ard.lines.append(serial_monitor.encode_frame({'ph': 6.8}))
+        self.monitor.wait_for_reading(2, READING_TIMEOUT)
+        self.assertEqual(self.monitor.framing, 'binary')
+        self.assertEqual((self.monitor.temperature, self.monitor.ph), (21.0, 6.8))
+
+    ## @test Test each message is published as one immutable reading and that
+    #  waiting for a reading returns as soon as it arrives
+    def test_reading_snapshot(self):
+        self.monitor.ard = FakeSerial([b'{"temperature":21.0, "ph":6.5}\n'])
+        self.assertEqual(self.monitor.wait_for_reading(0, 0.01), None)
+        self.monitor.start()
+        first = self.monitor.wait_for_reading(0, READING_TIMEOUT)
+        self.assertEqual((first.seq, first.temperature, first.ph), (1, 21.0, 6.5))
+        self.assertRaises(AttributeError, setattr, first, 'ph', 7.0)
+        started = time.time()
+        threading.Timer(0.05, self.monitor.ard.lines.append, [b'{"ph":7.0}\n']).start()
+        second = self.monitor.wait_for_reading(first.seq, 5)
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual((second.seq, second.temperature, second.ph), (2, 21.0, 7.0))
+        self.assertEqual(first.ph, 6.5)
+
+    ## @test Test critical notifiers run while reports are stuck, and that late,
+    #  failing and skipped notifiers are all counted
+    def test_notifier_pool(self):
+        pool = notifier_pool.NotifierPool(workers=1, critical_workers=1)
+        release = threading.Event()
+        slow = pool.submit('report', release.wait, (5,), 10, 0.05)
+        queued = pool.submit('other report', lambda: None, (), 10, 5)
+        warned = []
+        warning = pool.submit('warning', warned.append, ('too hot',), 0, 1)
+        self.assertEqual(pool.wait([warning]), [])
+        self.assertEqual(warned, ['too hot'])
+        self.assertFalse(queued.done.is_set())
+        self.assertEqual(pool.wait([slow]), [slow])
+        self.assertEqual(pool.submit('report', release.wait, (5,)), None)
+        release.set()
+        self.assertEqual(pool.wait([queued]), [])
+        def broken():
+            raise ValueError('broken')
+        pool.wait([pool.submit('broken', broken)])
+        stats = pool.stats()
+        self.assertEqual((stats['report']['timeouts'], stats['report']['skipped']), (1, 1))
+        self.assertEqual(stats['broken']['failures'], 1)
+        self.assertEqual(stats['warning']['runs'], 1)
+        self.assertTrue(stats['warning']['max_latency'] < 1)
+        pool.shutdown()
+
+    ## @test Test one message fans out to every kind of channel, delivered to the
+    #  local stub servers, and that a failing channel does not affect the others
+    def test_channels(self):
+        smtp = stub_servers.StubSMTPServer()
+        web = stub_servers.StubHTTPServer()
+        old_smtp = config.SMTP_host, config.SMTP_port, config.SMTP_use_ttls
+        config.SMTP_host, config.SMTP_port, config.SMTP_use_ttls = '127.0.0.1', smtp.port, False
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                syslog = stub_servers.StubSyslogServer(os.path.join(directory, 'log'))
+                broken = channels.WebhookChannel('http://127.0.0.1:1/')
+                fanout = [channels.SMTPChannel(), channels.WebhookChannel(web.url), broken,
+                          channels.SyslogChannel(syslog.path), channels.FileDropChannel(os.path.join(directory, 'drop'))]
+                channels.send(channels.Message('Fishtank monitor warning', 'ph is\nbad', [('chart.png', b'PNG')],
+                                               urgent=True), fanout)
+                for channel in fanout:
+                    self.assertTrue(channel.flush(5))
+                self.assertEqual(broken.stats()['failed'], 1)
+                self.assertEqual([c.stats()['sent'] for c in fanout if c is not broken], [1, 1, 1, 1])
+                self.assertIn(b'Subject: Fishtank monitor warning', smtp.messages[0])
+                posted = json.loads(web.requests[0][2].decode('UTF8'))
+                self.assertEqual((posted['subject'], posted['urgent']), ('Fishtank monitor warning', True))
+                self.assertEqual(posted['attachments'][0]['content'], 'UE5H')
+                syslog.received.wait(5)
+                self.assertEqual(syslog.messages, [b'<12>fishtank_monitor: Fishtank monitor warning: ph is bad'])
+                dropped = sorted(os.listdir(os.path.join(directory, 'drop')))
+                self.assertEqual([name.split('-', 2)[-1] for name in dropped], ['chart.png', '1.txt'])
+                for channel in fanout:
+                    channel.shutdown()
+                syslog.close()
+        finally:
+            config.SMTP_host, config.SMTP_port, config.SMTP_use_ttls = old_smtp
+            smtp.close()
+            web.close()
+
+    ## @test Test alerts are deduplicated into one digest per window with
+    #  bounded memory
+    def test_alert_digest(self):
+        digest = alerts.AlertDigest(60, max_entries=2)
+        digest.add(alerts.Alert(0, 'ph', alerts.LOW, 5.5, 1000))
+        entries, dropped = digest.take(1000)
+        self.assertEqual((len(entries), dropped), (1, 0))
+        for i in range(50):
+            digest.add(alerts.Alert(0, 'ph', alerts.LOW, 5.5 - i/100, 1010 + i))
+            digest.add(alerts.Alert(1, 'temperature', alerts.HIGH, 29.0, 1010 + i))
+            digest.add(alerts.Alert(2, 'temperature', alerts.HIGH, 29.0, 1010 + i))
+        self.assertEqual((len(digest), digest.dropped), (2, 50))
+        self.assertEqual(digest.take(1059), ([], 0))
+        entries, dropped = digest.take(1060)
+        self.assertEqual([(e.tank, e.sensor, e.count) for e in entries], [(0, 'ph', 50), (1, 'temperature', 50)])
+        self.assertEqual((entries[0].first, entries[0].last, entries[0].worst), (1010, 1059, 5.01))
+        subject, text = alerts.format_digest(entries, dropped)
+        self.assertEqual(subject, 'Fishtank monitor warnings (150)')
+        self.assertIn('50 further alerts were dropped', text)
+        self.assertEqual(len(digest), 0)
+
+    ## @test Test warning notifiers share one digest across calls
+    def test_warning_digest(self):
+        digest = alerts.AlertDigest(60*60)
+        self.monitor.ard = FakeSerial([b'{"temperature":30.0, "ph":5.5}'])
+        self.monitor.start()
+        reading = self.monitor.wait_for_reading(0, READING_TIMEOUT)
+        notifier = notifications.NotifyWarnings(digest)
+        notifier(ftm.conn, reading)
+        warned = notifier.time_last_warned
+        self.assertNotEqual(warned, 0)
+        notifier(ftm.conn, reading)
+        notifications.NotifyWarnings(digest)(ftm.conn, reading)
+        self.assertEqual(notifier.time_last_warned, warned)
+        self.assertEqual(len(digest), 2)
+
+    ## @test Test query results are cached until the readings are written, with
+    #  least recently used entries evicted
+    def test_query_cache(self):
+        conn = ftm.open_database(':memory:')
+        sensors.store_measurements(conn, [(1000 + i*60, 21.0 + i, 6.5, 6.4) for i in range(100)])
+        conn.commit()
+        cache = query_cache.QueryCache(conn, max_entries=2)
+        calls = []
+        def compute(conn):
+            calls.append(1)
+            return conn.execute('select count(*) from readings').fetchone()[0]
+        self.assertEqual(cache.get('a', compute), 300)
+        self.assertEqual(cache.get('a', compute), 300)
+        self.assertEqual(len(calls), 1)
+        # writes to anything but the readings leave the results good
+        conn.execute('insert into settings values (1)')
+        summaries.invalidate(conn)
+        self.assertEqual(cache.get('a', compute), 300)
+        self.assertEqual(len(calls), 1)
+        sensors.record(conn, 7000, { 'temperature': 25.0 })
+        self.assertEqual(cache.get('a', compute), 301)
+        cache.get('b', compute)
+        cache.get('c', compute)
+        self.assertEqual(cache.get('c', compute), 301)
+        self.assertEqual(cache.stats(), { 'hits': 3, 'misses': 4, 'evictions': 1, 'invalidations': 1, 'entries': 2 })
+        other = sqlite3.connect(':memory:')
+        self.assertEqual(query_cache.range_series(conn, ['ph', 'temperature'], 1000, 1120),
+                         [[(1000, 6.5), (1060, 6.5)], [(1000, 21.0), (1060, 22.0)]])
+        self.assertEqual(query_cache.range_series(conn, ['temperature'], 1000, 7001, 4),
+                         [[(1000, 21.0), (4000, 71.0), (6940, 120.0), (7000, 25.0)]])
+        self.assertEqual(query_cache.recent_measurements(conn, 2), [(None, 25.0), (6.5, 120.0)])
+        query_cache.recent_measurements(conn, 2)
+        self.assertEqual(query_cache.get_cache(conn).stats()['hits'], 1)
+        report = notifications.NotifyInformationalReports('day')
+        hour = summaries.period_start('hour', 1000)
+        self.assertEqual(report._chart_series(conn, hour, 4000.25), report._chart_series(conn, hour, 5000.5))
+        self.assertEqual(query_cache.get_cache(conn).stats()['hits'], 2)
+        self.assertIsNot(query_cache.get_cache(other), query_cache.get_cache(conn))
+        # as do writes from other connections, the ingestion process's say
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'fishtank.db')
+            writer = ftm.open_database(filename)
+            reader = ftm.connect(filename)
+            cache = query_cache.QueryCache(reader)
+            self.assertEqual(cache.get('a', compute), 0)
+            sensors.record(writer, 7000, { 'temperature': 25.0 })
+            self.assertEqual(cache.get('a', compute), 1)
+            writer.close()
+            reader.close()
+
+    ## @test Test trends are fitted incrementally and breaches forecast with
+    #  the time remaining
+    def test_forecast(self):
+        forecaster = forecast.TrendForecaster(half_life=3*60*60, horizon=2*60*60)
+        for i in range(6):
+            forecaster.add(0, 'temperature', 1000 + i*3600, 22.0 + i)
+            forecaster.add(0, 'ph', 1000 + i*3600, 7.0 + (i % 2)/10)
+            forecaster.add(1, 'ph', 1000 + i*3600, 7.5 - i/10)
+        forecaster.add(0, 'temperature', 1000, 40.0)
+        breach = forecaster.forecast(0, 'temperature', 20, 28)
+        self.assertEqual((breach.limit, round(breach.value, 6), round(breach.seconds)), (28, 27.0, 3600))
+        self.assertIsNone(forecaster.forecast(0, 'ph', 6.0, 8.0))
+        self.assertIsNone(forecaster.forecast(1, 'ph', 6.0, 8.0))
+        self.assertIsNone(forecaster.forecast(2, 'ph', 6.0, 8.0))
+        now = time.time()
+        digest = alerts.AlertDigest(60*60)
+        digest.next_digest = now + 60*60
+        forecaster = forecast.TrendForecaster(config.forecast_half_life, config.forecast_horizon)
+        notifier = notifications.NotifyWarnings(digest, forecaster)
+        unfed = notifications.NotifyWarnings(alerts.AlertDigest(60*60), forecast.TrendForecaster())
+        for i in range(5):
+            reading = serial_monitor.Reading(i + 1, now - (5 - i)*3600, (('ph', 7.5 - i/4),))
+            unfed(ftm.conn, reading)
+            forecaster.add_reading(0, reading)
+            notifier(ftm.conn, reading)
+        self.assertEqual(len(unfed.digest), 0)
+        entries, dropped = digest.take(now + 60*60)
+        self.assertEqual([(e.sensor, e.condition, e.count) for e in entries], [('ph', alerts.FALLING, 2)])
+        self.assertIn('ph falling, forecast too low in 2.0 hours', entries[0].describe())
+
+    ## @test Test each noise filter's batch form matches it filtering one
+    #  reading at a time
+    def test_filters(self):
+        values = [21.0 + ((i * 37) % 11) / 10 for i in range(1000)]
+        values[500] = 85.0
+        for spec in ['median 5', 'median 4', 'ewma 0.3', 'ewma 0.999', 'kalman 0.0001 0.01']:
+            streamed = list(map(filters.parse_filter(spec), values))
+            batch = filters.parse_filter(spec).filter_series(values)
+            self.assertEqual(len(batch), len(values))
+            for a, b in zip(streamed, batch):
+                self.assertAlmostEqual(a, b, 9)
+        self.assertEqual(len(filters.parse_filter('kalman 0.0001 0.01').filter_series([])), 0)
+        self.assertRaises(ValueError, filters.parse_filter, 'boxcar 3')
+        self.assertRaises(ValueError, filters.parse_filter, 'ewma 1.5')
+
+    ## @test Test a spike is filtered out before a reading is published
+    def test_filtered_reading(self):
+        self.monitor.filters = filters.FilterBank({ 'temperature': 'median 3' })
+        lines = [b'{"temperature":21.0, "ph":6.5}\n', b'{"temperature":21.2, "ph":6.5}\n', b'{"temperature":95.0, "ph":6.5}\n']
+        self.monitor.ard = FakeSerial(lines)
+        self.monitor.start()
+        reading = self.monitor.wait_for_reading(2, READING_TIMEOUT)
+        self.assertEqual((reading.temperature, reading.ph), (21.2, 6.5))
+
+    ## @test Test the gap index is kept as readings arrive in any order, and
+    #  matches a rebuild from the history
+    def test_gaps(self):
+        conn = ftm.open_database(':memory:')
+        times = [1000 + i*600 for i in range(20)] + [30000 + i*600 for i in range(10)] + [60000]
+        with conn:
+            for when in times[::2] + times[1::2]:
+                sensors.store_measurements(conn, [(when, 21.0, 6.5, 6.5)])
+                gaps.note(conn, [when], threshold=3600)
+        expected = [(12400, 30000), (35400, 60000)]
+        self.assertEqual(gaps.find(conn, 0, 100000), expected)
+        self.assertEqual(gaps.find(conn, 20000, 20001), expected[:1])
+        self.assertEqual(gaps.find(conn, 30000, 35400), [])
+        self.assertEqual(gaps.find(conn, 50000, 60001), expected[1:])
+        with conn:
+            self.assertEqual(gaps.rebuild(conn, threshold=3600), 2)
+            self.assertEqual(gaps.rebuild(conn, 31000, 32000, threshold=3600), 0)
+            self.assertEqual(gaps.rebuild(conn, 40000, 50000, threshold=3600), 1)
+        self.assertEqual(gaps.find(conn, 0, 100000), expected)
+        self.assertIn('(13.9 hours)', notifications.NotifyInformationalReports()._outage_text([(978300000, 978350000)]))
+        series = notifications.NotifyInformationalReports._interrupt([(1, 1.0), (9, 2.0)], [(2, 8)])
+        self.assertEqual(series, [(1, 1.0), (5, None), (9, 2.0)])
+
+    ## @test Test old months are archived to read-only partitions which
+    #  range queries are routed to
+    def test_partitions(self):
+        conn = ftm.open_database(':memory:')
+        march, april, may = [int(time.mktime((2015, m, 1, 0, 0, 0, 0, 0, -1))) for m in (3, 4, 5)]
+        rows = [(t, 20.0 + (t - march) / 86400.0, 6.5, 6.4) for t in range(march, may + 86400*10, 6*60*60)]
+        sensors.store_measurements(conn, rows)
+        conn.commit()
+        before = summaries._summarise_measurements(conn, march, may + 86400)
+        old = config.partition_directory, config.partition_after_months
+        with tempfile.TemporaryDirectory() as directory:
+            config.partition_directory, config.partition_after_months = directory, 1
+            try:
+                self.assertEqual(partitions.archive(conn, may + 86400*40), 4 * 31*3 + 4 * 30*3)
+                self.assertEqual(partitions.archive(conn, may + 86400*40), 0)
+                self.assertEqual([path for start, path in partitions.covering(0, float('inf'))],
+                                 [partitions.partition_file(0, march), partitions.partition_file(0, april)])
+                self.assertEqual(os.stat(partitions.partition_file(0, march)).st_mode & 0o222, 0)
+                self.assertEqual(conn.execute('select min(time) from readings').fetchone()[0], may)
+                self.assertEqual([p for s, p in partitions.covering(april + 1, may)], [partitions.partition_file(0, april)])
+                self.assertEqual(partitions.covering(may, may + 86400), [])
+                self.assertEqual(partitions.series(conn, 'temperature', march, may + 86400*10),
+                                 [(t, temp) for t, temp, ph, ph_raw in rows])
+                # streamed straight from the partitions' cursors, which are closed with the stream
+                stream = partitions.stream(conn, 'temperature', march, may + 86400*10)
+                self.assertEqual(next(stream), rows[0][:2])
+                stream.close()
+                self.assertEqual(query_cache.range_series(conn, ['temperature'], march, may + 86400*10, 2),
+                                 [[rows[0][:2], rows[-1][:2]]])
+                after = summaries._summarise_measurements(conn, march, may + 86400)
+                self.assertEqual((after.count, after.temp_min, after.temp_max, after.ph_sum),
+                                 (before.count, before.temp_min, before.temp_max, before.ph_sum))
+            finally:
+                config.partition_directory, config.partition_after_months = old
+
+    ## @test Test exports, backfills and calibrations reach archived readings,
+    #  and that readings split between a partition and the database are read
+    #  in time order
+    def test_partition_routing(self):
+        conn = ftm.open_database(':memory:')
+        march, may = [int(time.mktime((2015, m, 1, 0, 0, 0, 0, 0, -1))) for m in (3, 5)]
+        rows = [(t, 21.0, 6.5, 6.4) for t in range(march, may + 86400, 60*60)]
+        hole = rows[100:105]
+        with conn:
+            sensors.store_measurements(conn, rows[:100] + rows[105:])
+            gaps.rebuild(conn)
+        old = config.partition_directory, config.partition_after_months
+        with tempfile.TemporaryDirectory() as directory:
+            config.partition_directory, config.partition_after_months = directory, 1
+            try:
+                partitions.archive(conn, may + 86400*40)
+                self.assertEqual(len(list(export.rows(conn))), len(rows) - len(hole))
+                self.assertEqual(gaps.find(conn, march, may), [(hole[0][0] - 60*60, hole[-1][0] + 60*60)])
+                self.assertEqual(backfill.import_rows(conn, hole + rows[:1]), (len(hole), 1))
+                self.assertEqual(gaps.find(conn, march, may), [])
+                self.assertEqual([row[0] for row in export.rows(conn)], [row[0] for row in rows])
+                self.assertEqual(partitions.series(conn, 'temperature', march, may), [row[:2] for row in rows[:-24]])
+                calibration.record_calibration(conn, 0.3)
+                self.assertEqual(set(round(v, 6) for t, v in partitions.series(conn, 'ph', march, may + 86400)), {6.7})
+            finally:
+                config.partition_directory, config.partition_after_months = old
+
+    ## @test Test daily sketches kept at ingest merge into the distribution
+    #  over a range of days, weighted by time, and match a rebuild from the
+    #  readings
+    def test_sketches(self):
+        conn = ftm.open_database(':memory:')
+        start = int(time.mktime((2015, 6, 1, 0, 0, 0, 0, 0, -1)))
+        rows = [(start + i*900, 20.0 + abs(i % 200 - 100) / 10.0, 5.5 + abs(i % 60 - 30) / 10.0, None)
+                for i in range(96*10)]
+        with conn:
+            sensors.store_measurements(conn, rows)
+            for i in range(0, len(rows), 50):
+                sketches.record_measurements(conn, rows[i:i + 50])
+        self.assertEqual(conn.execute('select count(*) from sketches').fetchone()[0], 20)
+        sketch = sketches.combine(conn, 'temperature', start, start + 86400*10)
+        temps = sorted(row[1] for row in rows)
+        self.assertEqual((sketch.seconds, sketch.min, sketch.max), (959*900, 20.0, 30.0))
+        for q in (0.05, 0.5, 0.95):
+            self.assertAlmostEqual(sketch.quantile(q), temps[int(q * (len(temps) - 1))], delta=0.05)
+        ph = sketches.combine(conn, 'ph', start + 86400*2 + 1, start + 86400*4)
+        self.assertEqual(ph.seconds, 192*900)
+        # the ph sweeps evenly from 5.5 to 8.5 and back, so is in range two thirds of the time
+        self.assertAlmostEqual(ph.fraction_between(6.0, 8.0), 2 / 3.0, delta=0.03)
+        stored = conn.execute('select bins from sketches order by sensor, day').fetchall()
+        sketches.rebuild(conn, start + 86400, start + 86400*3)
+        self.assertEqual(conn.execute('select bins from sketches order by sensor, day').fetchall(), stored)
+        self.assertIn('in range', notifications.NotifyInformationalReports()._distribution_text(conn, start, start + 86400))
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'fishtank.db')
+            upgraded = ftm.open_database(filename)
+            with upgraded:
+                sensors.store_measurements(upgraded, rows)
+                upgraded.execute('drop table sketches')
+            upgraded.close()
+            # the sketches are built from the history when the table is new
+            upgraded = ftm.open_database(filename)
+            self.assertEqual(sketches.combine(upgraded, 'temperature', start, start + 86400*10).seconds, 959*900)
+            # as are sketches which counted readings
+            with upgraded:
+                upgraded.execute('drop table sketches')
+                upgraded.execute('create table sketches (tank INT NOT NULL, sensor INT NOT NULL, day INT NOT NULL, '
+                                 'count INT, min REAL, max REAL, bins BLOB, primary key (tank, sensor, day)) without rowid')
+            upgraded.close()
+            upgraded = ftm.open_database(filename)
+            self.assertEqual(sketches.combine(upgraded, 'temperature', start, start + 86400*10).seconds, 959*900)
+            upgraded.close()
+
+    ## @test Test backtesting candidate alert configurations over a rising and
+    #  falling temperature
+    def test_backtest(self):
+        import numpy
+        conn = ftm.open_database(':memory:')
+        start = 1425168000
+        rows = [(start + i*900, 24.01 + 6.0 * min(i, 192 - i) / 96.0, 7.0, 7.0) for i in range(192)]
+        with conn:
+            sensors.store_measurements(conn, rows)
+        times = numpy.array([row[0] for row in rows], dtype=float)
+        values = numpy.array([row[1] for row in rows])
+        value, slope, trusted = backtest.fit_trends(numpy, times, values, 3*60*60)
+        forecaster = forecast.TrendForecaster(3*60*60)
+        for i, row in enumerate(rows):
+            forecaster.add(0, 'temperature', row[0], row[1])
+            if i in (10, 95, 150):
+                fit = forecaster._trends[(0, 'temperature')].line()
+                self.assertAlmostEqual(value[i], fit[0], places=6)
+                self.assertAlmostEqual(slope[i], fit[1], places=9)
+        candidates = [backtest.parse_candidate('temperature=20:28,window=3600,horizon=0'),
+                      backtest.parse_candidate('temperature=20:28,window=3600,horizon=21600,half_life=10800'),
+                      backtest.parse_candidate('temperature=20:31,ph=6.5:7.5,horizon=0')]
+        late, early, quiet = backtest.backtest(conn, candidates)
+        excursion = start + 64*900
+        self.assertEqual(late.excursions, [('temperature', excursion)])
+        self.assertEqual((late.fired[0], late.leads), (excursion, [0.0]))
+        self.assertEqual(len(late.fired), 17)
+        self.assertTrue(all(b - a >= 3600 for a, b in zip(late.fired, late.fired[1:])))
+        self.assertGreater(early.leads[0], 3*60*60)
+        self.assertEqual((quiet.fired, quiet.excursions), ([], []))
+        self.assertIn('1 excursions, 1 heard of in advance', backtest.format_result(early))
+        self.assertRaises(ValueError, backtest.parse_candidate, 'conductivity=1:2')
+        old = config.warning_digest_window, config.send_warnings_interval
+        try:
+            config.warning_digest_window = config.send_warnings_interval = None
+            self.assertEqual(backtest.current().window, backtest.default_window)
+            self.assertTrue(backtest.backtest(conn, [backtest.current()])[0].fired)
+        finally:
+            config.warning_digest_window, config.send_warnings_interval = old
+
+    ## @test Test the status site only rewrites the pages whose readings or
+    #  alerts have changed
+    def test_status_site(self):
+        class Site(status_site.StatusSite):
+            charts = 0
+            def _render_chart(self, pairs, page):
+                Site.charts += 1
+                self._write(page, 'chart')
+                return True
+        conn = ftm.open_database(':memory:')
+        now = time.mktime((2015, 6, 10, 12, 0, 0, 0, 0, -1))
+        start = time.mktime((2015, 6, 7, 0, 0, 0, 0, 0, -1))
+        with conn:
+            sensors.store_measurements(conn, [(t, 25.0, 7.0, 7.0) for t in range(int(start), int(now), 600)])
+        old = config.site_directory, config.site_interval
+        build, database = status_site.build, ftm.database_filename
+        directory = tempfile.mkdtemp()
+        try:
+            site = Site(directory)
+            # four days, two weeks and a month, then the alerts and the index
+            self.assertEqual(site.build(conn, now), 9)
+            self.assertEqual(Site.charts, 7)
+            self.assertEqual(site.build(conn, now), 0)
+            with conn:
+                sensors.store_measurements(conn, [(now + 30, 26.0, 7.0, 7.0)])
+            # only the index shows the new reading until the day's page is due a refresh
+            self.assertEqual(site.build(conn, now + 60), 1)
+            self.assertEqual(site.build(conn, now + 400), 1)
+            changed = time.mktime((2015, 6, 8, 12, 5, 0, 0, 0, -1))
+            with conn:
+                sensors.store_measurements(conn, [(changed, 30.0, 7.0, 7.0)])
+            summaries.invalidate(conn, changed, changed + 1)
+            self.assertEqual(site.build(conn, now + 400), 1)
+            alerts.record(conn, [alerts.Entry(alerts.Alert(0, 'temperature', alerts.HIGH, 30.0, changed))], now + 400)
+            self.assertEqual(site.build(conn, now + 400), 2)
+            self.assertEqual(Site.charts, 9)
+            with open(os.path.join(directory, 'index.html')) as f:
+                index = f.read()
+            self.assertIn('day/2015-06-08.html', index)
+            self.assertIn('temperature too high', index)
+            config.site_directory = ''
+            self.assertEqual(status_site.build(conn), 0)
+            config.site_directory, config.site_interval = os.path.join(directory, 'live'), 0.05
+            # the component is handed a connection of its own to the database file
+            ftm.database_filename = os.path.join(directory, 'fishtank.db')
+            builds, connections = [], []
+            status_site.build = lambda conn: (connections.append(conn), builds.append(build(ftm.conn)))
+            component = [c for c in ftm.build_supervisor([]).components if c.name == 'site'][0]
+            task = component.factory()
+            deadline = time.time() + READING_TIMEOUT
+            while len(builds) < 3 and time.time() < deadline:
+                time.sleep(0.05)
+            task.shutdown()
+            status_site.build = build
+            self.assertGreater(len(builds), 2)
+            self.assertEqual((builds[0] > 0, builds[-1]), (True, 0))
+            self.assertEqual(len(set(id(c) for c in connections)), 1)
+            self.assertIsNot(connections[0], ftm.conn)
+            self.assertEqual(connections[0].execute('pragma database_list').fetchone()[2], ftm.database_filename)
+            connections[0].close()
+            self.assertTrue(os.path.exists(os.path.join(directory, 'live', 'index.html')))
+        finally:
+            status_site.build = build
+            config.site_directory, config.site_interval = old
+            ftm.database_filename = database
+            shutil.rmtree(directory)
+
+    ## @test Test agents pushing their readings to a collector over loopback,
+    #  concurrently and resuming where they left off
+    def test_collector(self):
+        store = ftm.open_database(':memory:')
+        server = collector.Collector(('127.0.0.1', 0), store)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        saved = collector.batch_rows, collector.batches_per_push
+        collector.batch_rows, collector.batches_per_push = 40, 2
+        try:
+            agents = []
+            for name in ('left', 'right'):
+                conn = ftm.open_database(':memory:')
+                with conn:
+                    sensors.store_measurements(conn, [(1000 + i*60, 20.0 + i/100.0, 7.0, 6.9) for i in range(300)])
+                agents.append((collector.PushAgent(server.server_address, name), conn))
+            # each push is cut short after two batches, the next resuming from the watermark
+            pushes = [threading.Thread(target=lambda a=agent, c=conn: [a.push(c) for i in range(4)])
+                      for agent, conn in agents]
+            for push in pushes:
+                push.start()
+            for push in pushes:
+                push.join()
+            self.assertEqual([agent.watermarks for agent, conn in agents],
+                             [{ 'temperature': 1000 + 299*60, 'ph': 1000 + 299*60, 'ph_raw': 1000 + 299*60 }]*2)
+            # the agents are given tanks of their own, in whichever order they first connected
+            known = store.execute('select tank, name from agents').fetchall()
+            self.assertEqual((sorted(tank for tank, name in known), sorted(name for tank, name in known)),
+                             ([1, 2], ['left', 'right']))
+            for tank in (1, 2):
+                self.assertEqual(store.execute('select count(*) from readings where tank=?', (tank,)).fetchone()[0], 900)
+                self.assertEqual(sketches.combine(store, 'ph', 0, 10**6, tank).seconds, 299*60)
+            agent, conn = agents[0]
+            self.assertEqual(agent.push(conn), 0)
+            with conn:
+                sensors.store_measurements(conn, [(100000, 21.0, 7.1, 7.0)])
+            self.assertEqual(agent.push(conn), 3)
+            self.assertEqual(sensors.series(store, 'temperature', 99999, 100001, collector.agent_tank(store, 'left')),
+                             [(100000, 21.0)])
+            # an extra sensor is stored before the temperature and ph of the same time
+            sensors.record(conn, 100060, { 'conductivity': 350.0 })
+            self.assertEqual(agent.push(conn), 1)
+            with conn:
+                sensors.store_measurements(conn, [(100060, 21.5, 7.1, 7.0)])
+            self.assertEqual(agent.push(conn), 3)
+            self.assertEqual(sensors.series(store, 'temperature', 100000, 100061, collector.agent_tank(store, 'left')),
+                             [(100000, 21.0), (100060, 21.5)])
+        finally:
+            collector.batch_rows, collector.batches_per_push = saved
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(collector.PushAgent(server.server_address, 'gone').push(agents[1][1]), 0)
+
+    ## @test Test the serial monitor thread exits when shut down
+    def test_monitor_shutdown(self):
+        self.monitor.ard = FakeSerial([b'{"temperature":21.0, "ph":6.5}'])
+        self.monitor.start()
+        self.monitor.started.wait(SLEEP_INT)
+        self.monitor.shutdown()
+        self.monitor.join(SLEEP_INT)
+        self.assertFalse(self.monitor.is_alive())
+
+    ## @test Test readings in the reading log are applied to the database
+    #  exactly once, including after a torn write and a restart
+    def test_reading_log_replay(self):
+        with tempfile.TemporaryDirectory() as directory:
+            conn = ftm.open_database(':memory:')
+            readings = reading_log.ReadingLog(directory, segment_records=2)
+            readings.replay(conn)
+            for i in range(5):
+                readings.append((1000 + i, [('temperature', 21.0), ('ph_raw', 6.5)]))
+            self.assertEqual(readings.apply(conn), 5)
+            self.assertEqual(readings.apply(conn), 0)
+            readings.append((1005, [('temperature', 22.0), ('ph_raw', 7.0)]))
+            readings.close()
+            with open(readings.segments()[-1], 'ab') as f:
+                f.write(b'torn')
+            readings = reading_log.ReadingLog(directory, segment_records=2)
+            self.assertEqual(readings.replay(conn), 1)
+            self.assertEqual(readings.replay(conn), 0)
+            self.assertEqual(readings.append((1006, [('temperature', 22.0), ('ph_raw', 7.0)])), 7)
+            rows = conn.execute('select time, temp from measurements order by time').fetchall()
+            self.assertEqual([r[0] for r in rows], list(range(1000, 1006)))
+            readings.close()
+
+    ## @test Test every sensor's readings pass through the reading log, and the
+    #  compressor keeps what any sensor with a tolerance needs, and that a log
+    #  written before the sensors were named is still replayed
+    def test_reading_log_sensors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, '%020d.seg' %1), 'wb') as f:
+                for seq in (1, 2):
+                    body = struct.pack('<Qddd', seq, 1000 + seq*60, 21.0, 6.5)
+                    f.write(body + struct.pack('<I', zlib.crc32(body) & 0xffffffff))
+            conn = ftm.open_database(':memory:')
+            compressor = compression.Compressor({ 'temperature': 0.05, 'ammonia': 0.1 })
+            readings = reading_log.ReadingLog(directory, compressor=compressor)
+            self.assertEqual(readings.replay(conn), 2)
+            for i in range(3, 20):
+                readings.append((1000 + i*60, [('temperature', 21.0), ('ph_raw', 6.5),
+                                               ('ammonia', 1.0 if i == 10 else 0.0 if i > 3 else None)]))
+            self.assertEqual(readings.apply(conn), 17)
+            self.assertEqual([os.path.splitext(f)[1] for f in readings.segments()], ['.seg', '.rec'])
+            self.assertEqual([r[1] for r in readings.records()][2], (1180, (('temperature', 21.0), ('ph_raw', 6.5),
+                                                                             ('ammonia', None))))
+            ammonia = conn.execute('select r.time, r.value from readings r join sensors s on s.id = r.sensor '
+                                   'where s.name = ? order by r.time', ('ammonia',)).fetchall()
+            self.assertEqual(ammonia, [(1180, None), (1240, 0.0), (1540, 0.0), (1600, 1.0), (1660, 0.0)])
+            self.assertEqual(compression.interpolate(conn, 'ammonia', [1570])[0], 0.5)
+            readings.close()
+            readings = reading_log.ReadingLog(directory)
+            self.assertEqual(readings.append((2200, [('temperature', 21.0)])), 20)
+            readings.close()
+        self.assertRaises(ValueError, reading_log.encode_record, 1, (1000, [('x' * 256, 1.0)]))
+
+    ## @test Test compressed measurements can be rebuilt within each sensor's
+    #  tolerance from a small fraction of them
+    def test_compression(self):
+        rows = [(1000 + i*60, 25.0 + math.sin(i / 300.0) + 0.01 * math.sin(i * 7.0), 7.0 + 0.3 * math.sin(i / 500.0),
+                 7.0) for i in range(3000)]
+        for method, fraction in [('swinging door', 0.02), ('deadband', 0.1)]:
+            conn = ftm.open_database(':memory:')
+            compressor = compression.Compressor({ 'temperature': 0.1, 'ph': 0.02 }, method, 7200)
+            stored = [row for row in compressor.feed(conn, rows) + [compressor.held] if row is not None]
+            self.assertLess(len(stored), fraction * len(rows))
+            with conn:
+                sensors.store_measurements(conn, stored)
+            times = [row[0] for row in rows]
+            for name, column, tolerance in [('temperature', 1, 0.1), ('ph', 2, 0.02)]:
+                values = compression.interpolate(conn, name, times)
+                self.assertLessEqual(max(abs(v - row[column]) for v, row in zip(values, rows)), tolerance)
+            self.assertEqual(compression.resample(conn, 'ph', 880, 1001, 60), [(880, None), (940, None), (1000, 7.0)])
+        self.assertRaises(ValueError, compression.Compressor, { 'ph_raw': 0.01 })
+        self.assertRaises(ValueError, compression.Compressor, { 'ph': 0.01 }, 'zigzag')
+
+    ## @test Test the reading log only stores what the compressor keeps, holding
+    #  back the newest reading across a restart without losing or double
+    #  counting it, and that its sketches survive a rebuild from what was kept
+    def test_compressed_reading_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            conn = ftm.open_database(':memory:')
+            readings = reading_log.ReadingLog(directory, compressor=compression.Compressor({ 'temperature': 0.05 }))
+            readings.replay(conn)
+            for batch in range(6):
+                for i in range(batch*100, batch*100 + 100):
+                    readings.append((1000 + i*60, [('temperature', 24.0 + i * 0.001), ('ph_raw', 7.0)]))
+                self.assertEqual(readings.apply(conn), 100 if batch == 0 else 101)
+                self.assertEqual(readings.apply(conn), 0)
+                self.assertEqual(readings.applied_seq, batch*100 + 99)
+            stored = conn.execute('select count(*) from measurements').fetchone()[0]
+            self.assertLess(stored, 10)
+            readings.close()
+            readings = reading_log.ReadingLog(directory, compressor=compression.Compressor({ 'temperature': 0.05 }))
+            readings.replay(conn)
+            self.assertEqual(readings.applied_seq, 599)
+            self.assertEqual(readings.held_seq, 600)
+            readings.append((1000 + 600*60, [('temperature', 30.0), ('ph_raw', 7.0)]))
+            readings.apply(conn)
+            self.assertEqual(conn.execute('select max(time) from measurements').fetchone()[0], 1000 + 599*60)
+            temperature = sketches.combine(conn, 'temperature', 0, 10**6)
+            self.assertEqual((temperature.seconds, sketches.combine(conn, 'ph', 0, 10**6).seconds), (599*60, 599*60))
+            # spread along the ramp, not heaped on the few readings kept
+            self.assertAlmostEqual(temperature.quantile(0.5), 24.3, delta=0.05)
+            self.assertAlmostEqual(temperature.fraction_between(24.0, 24.2), 0.33, delta=0.1)
+            stored = conn.execute('select * from sketches order by sensor, day').fetchall()
+            sketches.rebuild(conn)
+            self.assertEqual(conn.execute('select * from sketches order by sensor, day').fetchall(), stored)
+            self.assertAlmostEqual(compression.interpolate(conn, 'temperature', [1000 + 299*60])[0], 24.299, 2)
+            readings.close()
+            tolerances = config.compression_tolerances
+            try:
+                config.compression_tolerances = { 'temperature': 0.05 }
+                readings = ftm.open_reading_log(directory)
+                self.assertEqual(sorted(readings.compressor.doors), ['temperature'])
+                readings.close()
+            finally:
+                config.compression_tolerances = tolerances
+
+    ## @test Test compaction only removes segments which have been applied
+    def test_reading_log_compact(self):
+        with tempfile.TemporaryDirectory() as directory:
+            conn = ftm.open_database(':memory:')
+            readings = reading_log.ReadingLog(directory, segment_records=2)
+            readings.replay(conn)
+            for i in range(5):
+                readings.append((1000 + i, [('temperature', 21.0), ('ph_raw', 6.5)]))
+            self.assertEqual(len(readings.segments()), 3)
+            self.assertEqual(readings.compact(), [])
+            readings.apply(conn)
+            self.assertEqual(len(readings.compact()), 2)
+            self.assertEqual([r[0] for r in readings.records()], [5])
+            readings.close()
+
+    ## @test Test readings pass between processes through shared memory, in order
+    #  and wrapping around the end of the ring buffer
+    def test_reading_queue(self):
+        queue = processes.ReadingQueue(capacity=3)
+        latest = processes.SharedReading()
+        self.assertEqual(latest.temperature, None)
+        child = processes.ChildProcess('test', put_readings, (queue, latest))
+        received = [queue.get(5) for i in range(5)]
+        child.process.join(5)
+        self.assertEqual([r[0] for r in received], [1000, 1001, 1002, 1003, 1004])
+        self.assertEqual(received[-1], (1004, (('temperature', 25.0), ('ph_raw', 6.5), ('ammonia', None))))
+        self.assertEqual(queue.get(0), None)
+        self.assertEqual(latest.temperature, 25.0)
+        self.assertEqual(latest.reading.get('ammonia'), 0.25)
+        self.assertFalse(child.is_alive())
+        self.assertRaises(ValueError, queue.put, (1005, [('x' * 40, 1.0)]), 1)
+        self.assertRaises(ValueError, queue.put, (1005, [('s%d' % i, 1.0) for i in range(9)]), 1)
+        self.assertEqual(queue.get(0), None)
+        self.assertTrue(queue.put((1005, [('temperature', 21.0)]), 1))
+        self.assertEqual(queue.get(1), (1005, (('temperature', 21.0),)))
+
+    ## @test Test a reading queue waits on a live process holding its lock
+    #  however long it takes, and outlives one killed while holding it
+    def test_reading_queue_abandoned_lock(self):
+        queue = processes.ReadingQueue(capacity=3)
+        queue.lock_timeout = 0.5
+        child = processes.ChildProcess('test', hold_queue_lock, (queue,))
+        while queue._owner.value != child.process.pid:
+            time.sleep(0.01)
+        put = threading.Thread(target=queue.put, args=((1000, [('temperature', 21.0)]), 1))
+        put.start()
+        put.join(2)
+        self.assertTrue(put.is_alive())
+        child.shutdown()
+        self.assertFalse(child.is_alive())
+        put.join(5)
+        self.assertFalse(put.is_alive())
+        self.assertTrue(queue.put((1001, [('temperature', 21.0)]), 1))
+        self.assertEqual([queue.get(1)[0], queue.get(1)[0]], [1000, 1001])
+        self.assertEqual(queue._owner.value, 0)
+        self.assertTrue(queue._lock.acquire(False))
+        queue._lock.release()
+
+    ## @test Test an old database is migrated and its raw ph derived from the
+    #  first calibration, and that each calibration is applied to its own span
+    #  of history when recomputed
+    def test_calibration_history(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'fishtank.db')
+            old = sqlite3.connect(filename)
+            old.execute('create table measurements (time INT, temp REAL, ph REAL)')
+            old.executemany('insert into measurements values (?, ?, ?)', [(1000, 21.0, 6.8), (1001, 21.0, 6.9)])
+            old.commit()
+            old.close()
+            conn = ftm.open_database(filename)
+            self.assertTrue(calibration.record_calibration(conn, -0.2))
+            self.assertFalse(calibration.record_calibration(conn, -0.2))
+            conn.executemany('insert into measurements (time, temp, ph, ph_raw) values (?, ?, ?, ?)',
+                             calibration.corrected_rows(conn, [(1002, 21.0, 7.0), (1003, 21.0, 7.1)]))
+            calibration.record_calibration(conn, 0.1, 2.0, when=1002)
+            rows = conn.execute('select time, ph, ph_raw from measurements order by time').fetchall()
+            self.assertEqual([r[0] for r in rows], [1000, 1001, 1002, 1003])
+            self.assertAlmostEqual(rows[0][2], 7.0)
+            self.assertAlmostEqual(rows[1][1], 6.9)
+            self.assertAlmostEqual(rows[2][1], 14.1)
+            self.assertAlmostEqual(rows[3][1], 14.3)
+            self.assertEqual(config.last_calibration, 1002)
+            conn.close()
+
+    ## @test Test period summaries combine correctly and only complete periods
+    #  are stored
+    def test_summaries(self):
+        conn = ftm.open_database(':memory:')
+        month = time.mktime(datetime.datetime(2015, 3, 1).timetuple())
+        rows = [(month + i*6*60*60, 20.0 + i % 4, 7.0) for i in range(4*31)]
+        conn.executemany('insert into measurements (time, temp, ph) values (?, ?, ?)', rows)
+        now = month + 40*24*60*60
+        s = summaries.summary(conn, 'month', int(month), now)
+        self.assertEqual(s.count, 4*31)
+        self.assertEqual((s.temp_min, s.temp_max), (20.0, 23.0))
+        self.assertAlmostEqual(s.temp_mean, 21.5)
+        stored = dict(conn.execute('select period, count(*) from summaries group by period').fetchall())
+        self.assertEqual(stored, {'hour': 31*24, 'day': 31, 'month': 1})
+        week = summaries.period_start('week', month + 10*24*60*60)
+        self.assertEqual(datetime.datetime.fromtimestamp(week).weekday(), 0)
+        partial = summaries.summary(conn, 'week', week, week + 24*60*60)
+        self.assertEqual(partial.count, 28)
+        self.assertEqual(conn.execute("select count(*) from summaries where period='week'").fetchone()[0], 0)
+        summaries.invalidate(conn, month + 15*24*60*60)
+        self.assertEqual(conn.execute("select count(*) from summaries where period='day'").fetchone()[0], 15)
+
+    ## @test Test a yearly report is due once per year and tabulates its months
+    def test_inform_yearly(self):
+        notifier = notifications.NotifyInformationalReports('year')
+        conn = ftm.open_database(':memory:')
+        conn.execute('insert into measurements (time, temp, ph) values (?, ?, ?)', (time.time() - 40*24*60*60, 24.0, 7.0))
+        history = notifier._history(conn, time.time())
+        self.assertEqual(len(history), 13)
+        self.assertIn('Overall', notifier._summary_text(history))
+        notifier(conn, self.monitor)
+        self.assertNotEqual(notifier.time_last_informed, 0)
+        self.assertFalse(notifier._is_due(time.time()))
+
+    ## @test Test downsampling keeps to the point budget and keeps spikes
+    def test_downsample(self):
+        samples = [(t, 25.0 + (t % 7) / 10.0) for t in range(20000)]
+        samples[12345] = (12345, 40.0)
+        minmax = downsample.MinMaxDownsampler(0, 20000, 100)
+        for t, v in samples:
+            minmax.add(t, v)
+        points = minmax.points()
+        self.assertTrue(len(points) <= 100)
+        self.assertIn((12345, 40.0), points)
+        self.assertEqual(points, sorted(points))
+        points = list(downsample.lttb(iter(samples), len(samples), 100))
+        self.assertEqual(len(points), 100)
+        self.assertEqual((points[0], points[-1]), (samples[0], samples[-1]))
+        self.assertIn((12345, 40.0), points)
+
+    ## @test Test a report's chart series are drawn from its window within the budget
+    def test_report_chart_series(self):
+        conn = ftm.open_database(':memory:')
+        conn.executemany('insert into measurements (time, temp, ph) values (?, ?, ?)',
+                         [(t, 24.0, 7.0) for t in range(0, 100000, 10)])
+        notifier = notifications.NotifyInformationalReports('week')
+        series = dict(notifier._chart_series(conn, 50000, 100000))
+        self.assertTrue(0 < len(series['PH']) <= notifier.chart_points)
+        self.assertTrue(min(t for t, v in series['Temperature']) >= 50000)
+
+    ## @test Test exporting a time range in each format, across batch boundaries
+    def test_export(self):
+        conn = ftm.open_database(':memory:')
+        rows = [(1000 + i, 20.0 + i, 7.0, None if i % 3 else 7.2) for i in range(25)]
+        conn.executemany('insert into measurements (time, temp, ph, ph_raw) values (?, ?, ?, ?)', rows)
+        old_batch_rows, old_block_rows = export.batch_rows, export.block_rows
+        try:
+            export.batch_rows, export.block_rows = 4, 3
+            self.assertEqual(list(export.rows(conn, 1002, 1020)), rows[2:20])
+            out = io.BytesIO()
+            self.assertEqual(export.export(conn, out, 'columnar', compress=True), 25)
+            self.assertEqual(list(export.read_columnar(gzip.GzipFile(fileobj=io.BytesIO(out.getvalue())))), rows)
+            out = io.BytesIO()
+            export.export(conn, out, 'csv', end=1002)
+            self.assertEqual(out.getvalue().decode('UTF8').splitlines(),
+                             ['time,temp,ph,ph_raw', '1000,20.0,7.0,7.2', '1001,21.0,7.0,'])
+            out = io.BytesIO()
+            export.export(conn, out, 'jsonl', start=1024)
+            self.assertEqual(json.loads(out.getvalue().decode('UTF8').splitlines()[0]),
+                             {'time': 1024, 'temp': 44.0, 'ph': 7.0, 'ph_raw': 7.2})
+        finally:
+            export.batch_rows, export.block_rows = old_batch_rows, old_block_rows
+
+    ## @test Test importing CSV and gzipped exports skips duplicate timestamps and
+    #  invalidates the summaries of the imported range
+    def test_backfill(self):
+        conn = ftm.open_database(':memory:')
+        conn.executemany('insert into measurements (time, temp, ph) values (?, ?, ?)', [(1000, 20.0, 7.0), (1001, 20.0, 7.0)])
+        conn.execute("insert into summaries (period, start, count) values ('hour', 0, 2)")
+        csv_data = b'time,ph,temp\n1001,6.0,21.0\n1003,6.5,22.0\n1002,6.4,22.5\n1003,6.6,23.0\n'
+        self.assertEqual(backfill.import_rows(conn, backfill.read_rows(io.BytesIO(csv_data))), (2, 2))
+        rows = conn.execute('select time, temp, ph from measurements order by time').fetchall()
+        self.assertEqual(rows, [(1000, 20.0, 7.0), (1001, 20.0, 7.0), (1002, 22.5, 6.4), (1003, 22.0, 6.5)])
+        self.assertEqual(conn.execute('select count(*) from summaries').fetchone()[0], 0)
+        other = ftm.open_database(':memory:')
+        other.executemany('insert into measurements (time, temp, ph, ph_raw) values (?, ?, ?, ?)',
+                          [(t, 24.0, 7.0, 7.1) for t in range(1000, 1100)])
+        for fmt in sorted(export.writers):
+            data = io.BytesIO()
+            export.export(other, data, fmt, compress=True)
+            imported, skipped = backfill.import_rows(conn, backfill.read_rows(io.BytesIO(data.getvalue())))
+            self.assertEqual(imported + skipped, 100)
+        self.assertEqual(conn.execute('select count(*) from measurements').fetchone()[0], 100)
+        self.assertEqual(conn.execute('select count(*) from readings where sensor=?', (sensors.PH_RAW,)).fetchone()[0], 96)
+
+    ## @test Test an old measurements table is migrated to readings and that new
+    #  sensors reported by the Alamode are registered and stored without schema changes
+    def test_sensors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'old.db')
+            old = sqlite3.connect(filename)
+            old.execute('create table measurements (time INT, temp REAL, ph REAL, ph_raw REAL)')
+            old.executemany('insert into measurements values (?, ?, ?, ?)',
+                            [(1000, 21.0, 6.8, 7.0), (1000, 22.0, 6.9, 7.1), (1001, 21.5, None, None)])
+            old.commit()
+            old.close()
+            conn = ftm.open_database(filename)
+            self.assertEqual(conn.execute('select * from measurements order by time').fetchall(),
+                             [(1000, 21.0, 6.8, 7.0), (1001, 21.5, None, None)])
+            conn.close()
+        lines = [b'{"temperature":21.0, "ph":6.5, "orp":310, "conductivity":512.5}']
+        self.monitor.ard = FakeSerial(lines)
+        self.monitor.start()
+        self.monitor.wait_for_reading(0, READING_TIMEOUT)
+        self.assertEqual(self.monitor.values['orp'], 310)
+        sensors.record(ftm.conn, 2000, dict((k, v) for k, v in self.monitor.values.items()
+                                            if k not in self.monitor.required_sensors))
+        self.assertIn('conductivity', [name for i, name, unit in sensors.registered(ftm.conn)])
+        self.assertEqual(sensors.series(ftm.conn, 'orp', 0, 3000), [(2000, 310.0)])
+        plan = ' '.join(str(row) for row in ftm.conn.execute('explain query plan select time, value from readings '
+                                                            'where tank=0 and sensor=4 and time >= 0 and time < 10'))
+        self.assertIn('PRIMARY KEY', plan)
+
     def tearDown(self):
-        self.monitor.stop = True
+        self.monitor.shutdown()
         self.monitor = None
 
 unittest.main()
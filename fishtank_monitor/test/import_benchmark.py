@@ -0,0 +1,51 @@
+## @package import_benchmark
+#  Measures the bulk import rate of the backfill module
+#
+#  Generates a history of per-minute readings, writes it in each import format
+#  and times importing it into a scratch database which already holds part of
+#  that history, so that duplicate detection is exercised too.  Run from the
+#  fishtank_monitor directory:
+#
+#      python test/import_benchmark.py [rows]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import sys
+import io
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fishtank_monitor
+import export
+import backfill
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    start = 1420070400
+    rows = [(start + 60*i, 24.0 + (i % 100) / 100.0, 7.0 + (i % 50) / 100.0, 7.2) for i in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        source = fishtank_monitor.open_database(os.path.join(directory, 'source.db'))
+        source.executemany('insert into measurements (time, temp, ph, ph_raw) values (?, ?, ?, ?)', rows)
+        source.commit()
+        for fmt in sorted(export.writers):
+            for compress in (False, True):
+                data = io.BytesIO()
+                export.export(source, data, fmt, compress=compress)
+                target = fishtank_monitor.open_database(os.path.join(directory, '%s%d.db' %(fmt, compress)))
+                target.executemany('insert into measurements (time, temp, ph, ph_raw) values (?, ?, ?, ?)',
+                                   rows[:count//10])
+                target.commit()
+                began = time.time()
+                imported, skipped = backfill.import_rows(target, backfill.read_rows(io.BytesIO(data.getvalue())))
+                elapsed = time.time() - began
+                print("%-8s %-5s %8d imported %8d skipped %8.2f s %10.0f rows/s"
+                      %(fmt, 'gzip' if compress else '', imported, skipped, elapsed, count / elapsed))
+                target.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+## @package startup_benchmark
+#  Measures how long the fishtank monitor takes to come up
+#
+#  Each sample runs in a fresh interpreter so that module caching does not
+#  flatter the results.  Two phases are timed:  importing the application
+#  (which must do no I/O) and running the bootstrap against a scratch
+#  database.  Run from the fishtank_monitor directory:
+#
+#      python test/startup_benchmark.py [runs]
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import os
+import sys
+import subprocess
+import tempfile
+
+## Script run in the child interpreter, printing import and bootstrap times
+_child = """
+import time, os
+start = time.time()
+import fishtank_monitor
+imported = time.time()
+import config
+config.config_filename = %r
+os.mkdir('log')
+fishtank_monitor.bootstrap('./fishtank.db')
+booted = time.time()
+print(imported - start, booted - imported)
+"""
+
+## Time a single cold start of the application in a scratch directory
+#
+#  @param src_dir the directory holding the fishtank monitor modules
+#  @return a tuple of (import seconds, bootstrap seconds)
+def time_startup(src_dir):
+    cfg = os.path.join(src_dir, 'test', 'fishtank_monitor.cfg')
+    env = dict(os.environ, PYTHONPATH=src_dir)
+    with tempfile.TemporaryDirectory() as cwd:
+        out = subprocess.check_output([sys.executable, '-c', _child %cfg], cwd=cwd, env=env)
+    imported, booted = out.split()
+    return float(imported), float(booted)
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    samples = [time_startup(src_dir) for i in range(runs)]
+    for label, column in (('import', 0), ('bootstrap', 1)):
+        values = sorted(s[column] for s in samples)
+        print("%-10s min %7.1f ms  median %7.1f ms  max %7.1f ms"
+              %(label, values[0]*1000, values[len(values)//2]*1000, values[-1]*1000))
+
+if __name__ == "__main__":
+    main()
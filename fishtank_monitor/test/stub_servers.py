@@ -0,0 +1,139 @@
+## @package stub_servers
+#  Local stand-ins for the services the notification channels deliver to
+#
+#  Each server listens on the loopback interface (or a UNIX socket in a
+#  directory of the caller's choosing), runs in a daemon thread and records
+#  what it receives, so every ::channels channel can be tested offline.
+#
+#  @author  Ed Willis
+#  @copyright Ed Willis, 2015, all rights reserved
+#  @license  This software is released into the public domain
+
+import socket
+import threading
+import socketserver
+import http.server
+
+## Speaks just enough SMTP for smtplib to send a message
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self._reply('220 stub ESMTP')
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line.rstrip(b'\r\n') == b'.':
+                    self.server.messages.append(b''.join(data))
+                    data = None
+                    self._reply('250 OK')
+                else:
+                    data.append(line[1:] if line.startswith(b'..') else line)
+                continue
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self._reply('250-stub')
+                self._reply('250 AUTH PLAIN')
+            elif command == b'AUTH':
+                self._reply('235 OK')
+            elif command == b'DATA':
+                data = []
+                self._reply('354 go ahead')
+            elif command == b'QUIT':
+                self._reply('221 bye')
+                return
+            elif command in (b'HELO', b'MAIL', b'RCPT', b'RSET', b'NOOP'):
+                self._reply('250 OK')
+            else:
+                self._reply('502 not implemented')
+
+## Records the body of each POST and answers with a configurable status
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.headers['Content-Type'], body))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+## Base of the TCP stub servers, serving from a daemon thread
+class _StubServer:
+
+    def _serve(self, server):
+        self.server = server
+        self.port = server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    ## Stop serving and close the listening socket
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+## An SMTP server recording the messages sent to it
+class StubSMTPServer(_StubServer):
+
+    def __init__(self):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), _SMTPHandler)
+        server.daemon_threads = True
+        server.messages = []
+        self._serve(server)
+
+    ## The raw messages received, as bytes
+    @property
+    def messages(self):
+        return self.server.messages
+
+## An HTTP server recording the requests POSTed to it
+class StubHTTPServer(_StubServer):
+
+    ## The constructor
+    #
+    #  @param status the HTTP status to answer every request with
+    def __init__(self, status=200):
+        server = http.server.HTTPServer(('127.0.0.1', 0), _HTTPHandler)
+        server.requests = []
+        server.status = status
+        self._serve(server)
+        self.url = 'http://127.0.0.1:%d/notify' %self.port
+
+    ## The requests received, as (path, content type, body) tuples
+    @property
+    def requests(self):
+        return self.server.requests
+
+## A syslog daemon recording the datagrams sent to its UNIX socket
+class StubSyslogServer:
+
+    ## The constructor
+    #
+    #  @param path the path of the socket to create
+    def __init__(self, path):
+        self.path = path
+        self.messages = []
+        self.received = threading.Event()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(path)
+        thread = threading.Thread(target=self._receive)
+        thread.daemon = True
+        thread.start()
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._socket.recv(65536)
+            except OSError:
+                return
+            self.messages.append(data)
+            self.received.set()
+
+    ## Close the socket
+    def close(self):
+        self._socket.close()